@@ -1,58 +1,40 @@
+# this is the script we use to export a server's Discord messages for analytics and indexing
+# messages are read a page at a time and written to Parquet files partitioned by date (or channel) in
+# data/archive/<server>/; each run only exports the messages newer than the last one it exported
+# usage: python -m data.bigquery --server talentDAO
+#        python -m data.bigquery --source csv --path data/csv/talentDAO.csv --server talentDAO
+
 import os
-from google.cloud import bigquery 
-from google.oauth2 import service_account 
-import pandas_gbq
-import pandas as pd 
-import re
+import logging
+import argparse
 
+from src.archive import BigQuerySource, SQLiteSource, CSVSource, export
 
 # get the parent directory of the current file
 LEO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
 #BQ Config
-key_path = LEO_DIR+r"/data/cfg/project_lion_BQ.json".format(os.getcwd())
-credentials = service_account.Credentials.from_service_account_file(key_path, scopes=["https://www.googleapis.com/auth/cloud-platform"],)
-client = bigquery.Client(credentials = credentials, project=credentials.project_id,)
-
-
-#SQL Query
-#You can either used these parameters to type out the query or just write out an SQL manually.
-#Note: FROM Statement must be in the form {credentials.project_id}.discord.{server_name}.
-    # Leave it blank and place the desired server in tthe server name parameter.
-server_name = 'talentDAO' #@param {type:"string"}
-SQL_Query_SELECT = 'SELECT *' #@param {type:"string"}
-SQL_Query_WHERE = "WHERE username = 'k3nn.eth'" #@param {type:"string"}
-
-# Query1: select all from the talentDAO server
-query1 = \
-f"""SELECT
-    username
-    , message_content
-    , mentions
-    , channel_name
-    , time_stamp
---  , CAST(time_stamp AS DATE) time_stamp
-FROM {credentials.project_id}.discord.{server_name}
-ORDER BY time_stamp ASC;
-"""
-
-df1 = pandas_gbq.read_gbq(query1, project_id = credentials.project_id, credentials = credentials)
-
-df1.to_csv(LEO_DIR+f'/data/csv/{server_name}.csv', index=False)
-# # Query2: select k3nn.eth messages
-# query2 = \
-# f"""{SQL_Query_SELECT}
-# FROM {credentials.project_id}.discord.{server_name}
-# {SQL_Query_WHERE};
-# """
-# df2 = pandas_gbq.read_gbq(query2, 
-#                           project_id = credentials.project_id, 
-#                           credentials = credentials, 
-#                           )
-
-#print info on querys for import
-print('Importing data from the following queries:\n\n', query1)
-print('Columns:\n', df1.columns)
-print()
-# print(query2)
-# print('Columns:\n', df2.columns)
\ No newline at end of file
+key_path = LEO_DIR+r"/data/cfg/project_lion_BQ.json"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a server's Discord messages to partitioned Parquet files")
+    parser.add_argument("--server", default="talentDAO", help="server table name, the BigQuery table is discord.<server>")
+    parser.add_argument("--source", choices=["bigquery", "sqlite", "csv"], default="bigquery")
+    parser.add_argument("--path", help="database or csv file, for the sqlite and csv sources")
+    parser.add_argument("--out", help="archive folder, defaults to data/archive/<server>")
+    parser.add_argument("--partition-by", choices=["date", "channel"], default="date")
+    parser.add_argument("--page-size", type=int, default=50_000, help="messages read and written at a time")
+    args = parser.parse_args()
+    # show the export's progress
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.source == "bigquery":
+        source = BigQuerySource(f"discord.{args.server}", key_path)
+    elif args.source == "sqlite":
+        source = SQLiteSource(args.path, args.server)
+    else:
+        source = CSVSource(args.path)
+    out = args.out or os.path.join(LEO_DIR, "data", "archive", args.server)
+    exported = export(source, out, partition_by=args.partition_by, page_size=args.page_size)
+    print(f"Exported {exported} new messages to {out}")
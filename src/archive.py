@@ -0,0 +1,241 @@
+# Description: This file contains the incremental export of a server's Discord message history to Parquet
+# Messages are read from a source a page at a time, in time_stamp order, and written to Parquet files partitioned by
+# date or channel. The last exported time_stamp is saved with the archive, with the messages exported at that time, so
+# the next run only exports newer messages, including ones sharing that time_stamp that arrived after the last run.
+# The archive is read back the same way, a row group at a time, and grouped into conversation windows to be indexed.
+import os
+import re
+import json
+import logging
+import hashlib
+import sqlite3
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import pandas as pd
+
+# Columns of the exported message tables
+ARCHIVE_COLUMNS = ["username", "message_content", "mentions", "channel_name", "time_stamp"]
+
+WATERMARK_FILE = "_watermark.json"
+
+# logger
+logger = logging.getLogger(__name__)
+
+
+class MessageSource:
+    """A table of Discord messages. pages() yields the messages at or after `since`, oldest first."""
+    def pages(self, since: Optional[pd.Timestamp], page_size: int) -> Iterator[pd.DataFrame]:
+        raise NotImplementedError
+
+
+class BigQuerySource(MessageSource):
+    def __init__(self, table: str, key_path: str):
+        # the BigQuery client libraries are only needed for this source
+        from google.cloud import bigquery
+        from google.oauth2 import service_account
+        credentials = service_account.Credentials.from_service_account_file(key_path, scopes=["https://www.googleapis.com/auth/cloud-platform"])
+        self.bigquery = bigquery
+        self.client = bigquery.Client(credentials=credentials, project=credentials.project_id)
+        # table name relative to the project, e.g. discord.talentDAO
+        self.table = f"{credentials.project_id}.{table}"
+
+    def pages(self, since: Optional[pd.Timestamp], page_size: int) -> Iterator[pd.DataFrame]:
+        query = f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM `{self.table}`"
+        parameters = []
+        if since is not None:
+            query += " WHERE time_stamp >= @since"
+            parameters.append(self.bigquery.ScalarQueryParameter("since", "TIMESTAMP", since.to_pydatetime()))
+        query += " ORDER BY time_stamp ASC"
+        job = self.client.query(query, job_config=self.bigquery.QueryJobConfig(query_parameters=parameters))
+        # the result is downloaded one page at a time instead of all at once
+        yield from job.result(page_size=page_size).to_dataframe_iterable()
+
+
+class SQLiteSource(MessageSource):
+    def __init__(self, path: str, table: str):
+        self.path = path
+        self.table = table
+
+    def pages(self, since: Optional[pd.Timestamp], page_size: int) -> Iterator[pd.DataFrame]:
+        query = f'SELECT {", ".join(ARCHIVE_COLUMNS)} FROM "{self.table}"'
+        params = ()
+        # datetime() compares the time stamps as times, whatever ISO format they are stored in
+        if since is not None:
+            query += " WHERE datetime(time_stamp) >= datetime(?)"
+            params = (since.isoformat(),)
+        query += " ORDER BY datetime(time_stamp) ASC"
+        with sqlite3.connect(self.path) as conn:
+            yield from pd.read_sql_query(query, conn, params=params, chunksize=page_size)
+
+
+class CSVSource(MessageSource):
+    """A CSV export, e.g. one written by the previous version of data/bigquery.py, sorted by time_stamp."""
+    def __init__(self, path: str):
+        self.path = path
+
+    def pages(self, since: Optional[pd.Timestamp], page_size: int) -> Iterator[pd.DataFrame]:
+        for page in pd.read_csv(self.path, usecols=ARCHIVE_COLUMNS, chunksize=page_size):
+            if since is not None:
+                page = page[pd.to_datetime(page["time_stamp"], utc=True) >= since]
+            if len(page):
+                yield page
+
+
+def read_watermark(out: str) -> Optional[dict]:
+    path = os.path.join(out, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_watermark(out: str, time_stamp: pd.Timestamp, partition_by: str, keys: List[str]) -> None:
+    # written after the page's files, a crash in between only exports that page again
+    path = os.path.join(out, WATERMARK_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"time_stamp": time_stamp.isoformat(), "partition_by": partition_by, "keys": keys}, f)
+    os.replace(path + ".tmp", path)
+
+
+def message_keys(page: pd.DataFrame) -> pd.Series:
+    # the message tables have no message ID, a message is identified by its author, channel, time and content
+    rows = ("\x1f".join(map(str, values)) for values in zip(*(page[column] for column in ARCHIVE_COLUMNS)))
+    return pd.Series([hashlib.sha1(row.encode("utf-8")).hexdigest()[:16] for row in rows], index=page.index, dtype=object)
+
+
+def partition_value(value) -> str:
+    # partition folder names can only hold a limited set of characters
+    return re.sub(r"[^\w.-]+", "_", str(value)) or "_"
+
+
+def export(source: MessageSource, out: str, partition_by: str = "date", page_size: int = 50_000) -> int:
+    """Exports the messages newer than the archive's watermark to Parquet.
+        Args:
+            source: where the messages are read from
+            out: archive folder, with one date=YYYY-MM-DD/ or channel=<name>/ folder per partition
+            partition_by: "date" or "channel"
+            page_size: messages read and written at a time, memory use is proportional to it
+        Returns:
+            the number of messages exported
+    """
+    if partition_by not in ("date", "channel"):
+        raise ValueError("partition_by must be 'date' or 'channel'")
+    os.makedirs(out, exist_ok=True)
+    watermark = read_watermark(out)
+    since = None
+    # keys of the messages exported at the watermark's time_stamp, the sources return them again
+    exported_keys: set = set()
+    if watermark is not None:
+        if watermark["partition_by"] != partition_by:
+            raise ValueError(f"{out} is partitioned by {watermark['partition_by']}, export to another folder to partition by {partition_by}")
+        since = pd.Timestamp(watermark["time_stamp"])
+        exported_keys = set(watermark.get("keys", []))
+    # file names are unique per run and page, so an incremental run never overwrites earlier files
+    run = pd.Timestamp.now(tz="UTC").strftime("%Y%m%dT%H%M%S%f")
+    exported = 0
+    for page_number, page in enumerate(source.pages(since, page_size)):
+        page = page[ARCHIVE_COLUMNS].copy()
+        page["time_stamp"] = pd.to_datetime(page["time_stamp"], utc=True)
+        page_keys = message_keys(page)
+        if since is not None:
+            # messages sharing the last exported time_stamp that were already exported
+            seen = (page["time_stamp"] == since) & page_keys.isin(exported_keys)
+            page, page_keys = page[~seen], page_keys[~seen]
+        if not len(page):
+            continue
+        keys = page["time_stamp"].dt.strftime("%Y-%m-%d") if partition_by == "date" else page["channel_name"].map(partition_value)
+        for key, rows in page.groupby(keys, sort=False):
+            folder = os.path.join(out, f"{partition_by}={key}")
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, f"part-{run}-{page_number:05d}.parquet")
+            rows.to_parquet(path + ".tmp", index=False)
+            os.replace(path + ".tmp", path)
+        exported += len(page)
+        last = page["time_stamp"].max()
+        if last != since:
+            since, exported_keys = last, set()
+        exported_keys.update(page_keys[page["time_stamp"] == last])
+        write_watermark(out, last, partition_by, sorted(exported_keys))
+        logger.info(f"Exported {exported} messages, up to {last}")
+    return exported
+
+
+def archive_files(out: str) -> List[str]:
+    """Returns the Parquet files of an archive, in partition order."""
+    return sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(out)
+        for name in names
+        if name.endswith(".parquet")
+    )
+
+
+def read_pages(path: str, page_size: int = 50_000) -> Iterator[pd.DataFrame]:
+    """Reads an archive file (Parquet, or a CSV export) a page at a time, with time_stamp parsed as UTC."""
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        pages = (batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(batch_size=page_size, columns=ARCHIVE_COLUMNS))
+    else:
+        pages = pd.read_csv(path, usecols=ARCHIVE_COLUMNS, chunksize=page_size)
+    for page in pages:
+        page["time_stamp"] = pd.to_datetime(page["time_stamp"], utc=True)
+        yield page
+
+
+# ConversationWindow: consecutive messages of a channel, indexed as one chunk
+@dataclass
+class ConversationWindow:
+    channel: str
+    start: pd.Timestamp
+    lines: List[str]
+    tokens: int
+    last: pd.Timestamp
+
+    @property
+    def text(self) -> str:
+        return f"#{self.channel}, {self.start:%Y-%m-%d %H:%M} UTC\n" + "\n".join(self.lines)
+
+
+def conversation_windows(pages: Iterable[pd.DataFrame], gap_minutes: float, max_tokens: int) -> Iterator[ConversationWindow]:
+    """Groups messages into conversation windows.
+        Args:
+            pages: messages in time_stamp order, as returned by read_pages
+            gap_minutes: a message this long after the previous one of its channel starts a new window
+            max_tokens: a window is closed once the next message would take it over this many tokens
+        Returns:
+            the windows, in the order they are closed
+    """
+    # imported here so exporting the archive doesn't need the OpenAI settings
+    from src.embeddings import get_encoding
+    encoding = get_encoding()
+    gap = pd.Timedelta(minutes=gap_minutes)
+    # one open window per channel, so memory depends on the number of channels, not of messages
+    open_windows: Dict[str, ConversationWindow] = {}
+    for page in pages:
+        page = page.dropna(subset=["message_content", "time_stamp"])
+        for username, content, channel, time_stamp in zip(page["username"], page["message_content"], page["channel_name"], page["time_stamp"]):
+            content = str(content).strip()
+            if not content:
+                continue
+            line = f"{username}: {content}"
+            line_tokens = encoding.encode(line, disallowed_special=())
+            if len(line_tokens) > max_tokens:
+                line = encoding.decode(line_tokens[:max_tokens])
+                line_tokens = line_tokens[:max_tokens]
+            channel = str(channel)
+            window = open_windows.get(channel)
+            if window is not None and (time_stamp - window.last > gap or window.tokens + len(line_tokens) > max_tokens):
+                yield open_windows.pop(channel)
+                window = None
+            if window is None:
+                window = open_windows[channel] = ConversationWindow(channel, time_stamp, [], 0, time_stamp)
+            window.lines.append(line)
+            window.tokens += len(line_tokens)
+            window.last = time_stamp
+        # close the windows of the channels that went quiet, they can't grow any more
+        if len(page):
+            now = page["time_stamp"].iloc[-1]
+            for channel in [c for c, w in open_windows.items() if now - w.last > gap]:
+                yield open_windows.pop(channel)
+    yield from open_windows.values()
@@ -62,32 +62,89 @@ class Prompt:
 
 # building the BaseRetriever class for docuemnt search (QA). /ask command
 
+# langchain, numpy and the index are slow to import, so they are only imported when the retriever and llm are built
 from abc import ABC, abstractmethod
-from src.constants import OPENAI_API_KEY
-from langchain import OpenAI
-from langchain.schema import Document
-from langchain.indexes import VectorstoreIndexCreator
-from langchain.document_loaders import DirectoryLoader, TextLoader
+# src.constants imports Config from this module, so its values are read when used rather than at import
+from src import constants
+from src.registry import registry
 # get the parent directory of the current file
 LEO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-# Initialize the OpenAI instance
-llm = OpenAI(openai_api_key=OPENAI_API_KEY)
 
-## OG implementation with chroma vectorstore
+# The prompt langchain's "stuff" QA chain used, filled with the retrieved chunks and the question
+QA_PROMPT_TEMPLATE = """Use the following pieces of context to answer the question at the end. If you don't know the answer, just say that you don't know, don't try to make up an answer.
+
+{context}
+
+Question: {question}
+Helpful Answer:"""
+
+def build_llm():
+    from langchain import OpenAI
+    return OpenAI(openai_api_key=constants.OPENAI_API_KEY)
+
+# Register the OpenAI instance, it is built on first use and shared by every command
+registry.register("llm", build_llm)
+
+## Vector index over a folder of .txt documents (see src/index.py)
 class BaseRetriever(ABC):
-    def __init__(self):
-        path = LEO_DIR + r'/text/'
-        self.loader = DirectoryLoader(path, glob="**/*.txt", loader_cls=TextLoader)
-        self.index = VectorstoreIndexCreator().from_loaders([self.loader])
+    def __init__(self, root: Optional[str] = None, previous: Optional["BaseRetriever"] = None):
+        from src.index import VectorIndex, docs_snapshot
+        self.root = root or constants.DEFAULT_DOCS_DIR
+        # taken before loading, so edits made while the index builds are picked up by the next reload
+        self.snapshot = docs_snapshot(self.root)
+        archive_dir = os.path.join(self.root, constants.ARCHIVE_INDEX_DIRNAME)
+        has_archive = os.path.isdir(archive_dir)
+        # the documents are compressed once, after being joined with the archive
+        dtype = "float32" if has_archive else constants.INDEX_VECTOR_DTYPE
+        # documents ingested by utils/ingest.py are loaded as they are, otherwise they are chunked and embedded here
+        documents = VectorIndex.load_ingested(self.root, constants.INGESTED_INDEX_DIR, dtype=dtype)
+        if documents is None:
+            documents = VectorIndex.from_directory(self.root, previous=previous.index if previous else None, dtype=dtype)
+        if has_archive:
+            # the server's Discord history, ingested by utils/ingest_archive.py, is searched with the documents
+            self.index = VectorIndex.concat([documents, VectorIndex.load(archive_dir, dtype="float32")])
+        else:
+            self.index = documents
     @abstractmethod
-    def search(self, query: str) -> List[Document]:
+    def search(self, query: str, query_vector=None, filters: Optional[dict] = None, since=None, until=None, guild_id: Optional[int] = None) -> List[str]:
         """Responds to a query about the users documents.
             Args:
                 query: string to find relevant docs for
+                query_vector: embedding of the query, embedded here if not given
+                filters: facet -> value(s) the chunks must have, e.g. {"channel": "general"} or {"domain": "talentdao.substack.com"}
+                since, until: only search the Discord archive conversations started in this time range
+                guild_id: the guild asking, the archives of other guilds are not searched
             Returns:
                 response to query
         """
-        result = self.index.query(query)
+        import numpy as np
+        from src.embeddings import embed_texts, count_tokens
+        from src.context import build_context
+        from src.metrics import span, record_tokens
+        if query_vector is None:
+            with span("embedding"):
+                query_vector = embed_texts([query])[0]
+        with span("retrieval"):
+            # the filters pick the rows before the vector search, so only the matching chunks are scored
+            rows = self.index.filter_rows(filters=filters, since=since, until=until, guild_id=guild_id)
+            rows, scores = self.index.search_rows(query_vector, k=constants.QA_CANDIDATE_CHUNKS, rows=rows)
+            # drop near-duplicate chunks and pack the rest into the token budget
+            context = build_context(
+                query_vector,
+                chunks=[self.index.chunks[row] for row in rows],
+                vectors=np.asarray(self.index.vectors[rows]),
+                max_tokens=constants.QA_CONTEXT_MAX_TOKENS,
+                lambda_mult=constants.QA_MMR_LAMBDA,
+                max_similarity=constants.QA_DUPLICATE_SIMILARITY,
+            )
+        prompt = QA_PROMPT_TEMPLATE.format(context=context, question=query)
+        llm = registry.get("llm")
+        with span("llm"):
+            result = llm(prompt).strip()
+        # the completion API's usage isn't returned by langchain, the tokens are counted here
+        model = getattr(llm, "model_name", "unknown")
+        record_tokens("prompt", count_tokens(prompt), model=model)
+        record_tokens("completion", count_tokens(result), model=model)
         return result.split('\n')
     
 
@@ -0,0 +1,72 @@
+# Description: This file contains the channel resolver used instead of calling fetch_channel directly
+# Channels are taken from the gateway cache when it has them, otherwise fetched over REST once and kept
+# for CHANNEL_CACHE_TTL_SECONDS. Entries are dropped when Discord tells us a channel changed or was deleted.
+import time
+import logging
+from typing import Dict, Tuple, Union
+
+import discord
+
+from src.constants import CHANNEL_CACHE_TTL_SECONDS
+from src.shards import shard_for
+from src.metrics import record_cache
+
+# logger
+logger = logging.getLogger(__name__)
+
+
+class ChannelResolver:
+    def __init__(self, ttl_seconds: float = CHANNEL_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        # channel id -> (channel, time it was fetched, shard of its guild)
+        self._fetched: Dict[int, Tuple[discord.abc.GuildChannel, float, int]] = {}
+        # lookups served by the gateway cache, by a fetched channel, and by a REST request
+        self.gateway_hits = 0
+        self.cache_hits = 0
+        self.fetches = 0
+
+    async def resolve(self, source: Union[discord.Client, discord.Guild], channel_id: int):
+        """Returns the channel with the given ID.
+            Args:
+                source: the client, or the guild the channel belongs to
+                channel_id: ID of the channel or thread
+            Returns:
+                the channel, raises discord.NotFound if it doesn't exist
+        """
+        # discord.py caches channels by int ID, a str ID (e.g. from an environment variable) would never hit
+        channel_id = int(channel_id)
+        channel = source.get_channel(channel_id)
+        if channel is None and isinstance(source, discord.Guild):
+            # threads are not returned by Guild.get_channel
+            channel = source.get_thread(channel_id)
+        if channel is not None:
+            self.gateway_hits += 1
+            record_cache("channel", hit=True)
+            return channel
+
+        cached = self._fetched.get(channel_id)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl_seconds:
+            self.cache_hits += 1
+            record_cache("channel", hit=True)
+            return cached[0]
+
+        self.fetches += 1
+        record_cache("channel", hit=False)
+        channel = await source.fetch_channel(channel_id)
+        guild = getattr(channel, "guild", None)
+        self._fetched[channel_id] = (channel, time.monotonic(), shard_for(guild.id if guild else None))
+        return channel
+
+    def invalidate(self, channel_id: int) -> None:
+        channel_id = int(channel_id)
+        if self._fetched.pop(channel_id, None) is not None:
+            logger.debug(f"Dropped cached channel {channel_id}")
+
+    def invalidate_shard(self, shard_id: int) -> None:
+        # a shard that reconnected may have missed channel updates while it was disconnected
+        for channel_id in [c for c, (_, _, shard) in self._fetched.items() if shard == shard_id]:
+            del self._fetched[channel_id]
+
+
+# Initialize the shared channel resolver instance
+channels = ChannelResolver()
@@ -0,0 +1,55 @@
+# Description: This file contains the token based document chunker used by the index and utils/ingest.py
+# Files are read a block of lines at a time, so a large document is never fully loaded in memory.
+from typing import Iterator, List, Tuple
+
+from src.constants import CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS
+from src.embeddings import get_encoding
+
+# Characters read from a file at a time, the block is extended to the end of its line
+READ_BLOCK_CHARS = 64 * 1024
+
+
+def iter_blocks(path: str) -> Iterator[str]:
+    # yield a file in blocks of whole lines, so tokens are never split across blocks mid-word
+    with open(path, encoding="utf-8", errors="replace") as f:
+        while True:
+            block = f.read(READ_BLOCK_CHARS)
+            if not block:
+                return
+            block += f.readline()
+            yield block
+
+
+def iter_token_chunks(blocks: Iterator[str], chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[Tuple[str, int]]:
+    """Splits a stream of text into chunks of at most chunk_tokens tokens.
+        Args:
+            blocks: the text, in pieces
+            chunk_tokens: tokens per chunk
+            overlap_tokens: tokens each chunk repeats from the end of the previous one
+        Returns:
+            (chunk text, token count of the text) pairs
+    """
+    if not 0 <= overlap_tokens < chunk_tokens:
+        raise ValueError("overlap_tokens must be smaller than chunk_tokens")
+    encoding = get_encoding()
+    buffer: List[int] = []
+    # tokens at the start of the buffer that were already emitted as the previous chunk's overlap
+    emitted = 0
+    for block in blocks:
+        buffer.extend(encoding.encode(block, disallowed_special=()))
+        while len(buffer) >= chunk_tokens:
+            text = encoding.decode(buffer[:chunk_tokens]).strip()
+            if text:
+                # counted again, the stripped whitespace and re-encoded split tokens change the count
+                yield text, len(encoding.encode(text, disallowed_special=()))
+            buffer = buffer[chunk_tokens - overlap_tokens :]
+            emitted = overlap_tokens
+    if len(buffer) > emitted:
+        text = encoding.decode(buffer).strip()
+        if text:
+            yield text, len(encoding.encode(text, disallowed_special=()))
+
+
+def chunk_file(path: str, chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[Tuple[str, int]]:
+    """Chunks a text file by tokens, see iter_token_chunks. Picklable, so it can run in a process pool."""
+    return list(iter_token_chunks(iter_blocks(path), chunk_tokens, overlap_tokens))
@@ -14,6 +14,9 @@ from src.constants import (
 import discord
 from src.base import Message, Prompt, Conversation
 from src.utils import split_into_shorter_messages, close_thread, logger
+from src.outbound import send_queue
+from src.workers import worker_pool
+from src.metrics import record_tokens
 from src.moderation import (
     send_moderation_flagged_message,
     send_moderation_blocked_message,
@@ -55,6 +58,14 @@ async def generate_chat_completion_response(messages: List[Message], user) -> Co
 
     logger.debug("Calling OpenAI API with generated inputs")
 
+    if worker_pool.running:
+        # a worker process makes the call, the gateway only waits for the complete reply
+        response = await worker_pool.submit("chat_completion", messages=inputs)
+        logger.debug("Received response from OpenAI API")
+        record_tokens("prompt", response["usage"]["prompt_tokens"], model=response["model"])
+        record_tokens("completion", response["usage"]["completion_tokens"], model=response["model"])
+        return CompletionData(status=CompletionResult.OK, reply_text=response["content"], status_text=None)
+
     loop = asyncio.get_event_loop()
     with concurrent.futures.ThreadPoolExecutor() as executor:
         response = await loop.run_in_executor(executor, functools.partial(
@@ -64,6 +75,8 @@ async def generate_chat_completion_response(messages: List[Message], user) -> Co
         ))
     
     logger.debug("Received response from OpenAI API")
+    record_tokens("prompt", response["usage"]["prompt_tokens"], model=response["model"])
+    record_tokens("completion", response["usage"]["completion_tokens"], model=response["model"])
     response_data = CompletionData(
         status=CompletionResult.OK,
         reply_text=response['choices'][0]['message']['content'],
@@ -99,7 +112,8 @@ async def process_response(
                 description = f"**Invalid response** - empty response from GPT-3.5 Turbo"
             else:
                 description = f"**Invalid response** - empty response"
-            sent_message = await thread.send(
+            sent_message = await send_queue.send(
+                thread,
                 embed=discord.Embed(
                     description=description,
                     color=discord.Color.yellow(),
@@ -108,8 +122,8 @@ async def process_response(
         # If the reply text is too long, send a message saying the response is too long
         else:
             shorter_response = split_into_shorter_messages(reply_text)
-            for r in shorter_response:
-                sent_message = await thread.send(r)
+            # the parts are queued together, so the ones that fit in one message are sent as one
+            sent_message = (await send_queue.send_parts(thread, shorter_response))[-1]
         # If the status is flagged, send a moderation flagged message
         if status == CompletionResult.MODERATION_FLAGGED:
             await send_moderation_flagged_message(
@@ -120,7 +134,8 @@ async def process_response(
                 url=sent_message.jump_url if sent_message else "no url",
             )
             # Send a message saying the conversation has been flagged
-            await thread.send(
+            await send_queue.send(
+                thread,
                 embed=discord.Embed(
                     description=f"⚠️ **This conversation has been flagged by moderation.**",
                     color=discord.Color.yellow(),
@@ -135,7 +150,8 @@ async def process_response(
             message=reply_text,
         )
         # Send a message saying the response has been blocked
-        await thread.send(
+        await send_queue.send(
+            thread,
             embed=discord.Embed(
                 description=f"❌ **The response has been blocked by moderation.**",
                 color=discord.Color.red(),
@@ -148,7 +164,8 @@ async def process_response(
         await close_thread(thread)
     elif status == CompletionResult.INVALID_REQUEST:
         logger.debug(f"Status: {status}; Invalid request for user {user} in thread {thread.name}")  # NEW logging statement
-        await thread.send(
+        await send_queue.send(
+            thread,
             embed=discord.Embed(
                 description=f"**Invalid request** - {status_text}",
                 color=discord.Color.yellow(),
@@ -157,7 +174,8 @@ async def process_response(
     # If the status is other error, send a message saying an error occurred
     else:
         logger.debug(f"Other error for user {user} in thread {thread.name}; status_text: {status_text}")  # NEW logging statement
-        await thread.send(
+        await send_queue.send(
+            thread,
             embed=discord.Embed(
                 description=f"**Error** - {status_text}",
                 color=discord.Color.yellow(),
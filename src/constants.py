@@ -27,7 +27,7 @@ EXAMPLE_CONVOS = CONFIG.example_conversations
 DISCORD_BOT_TOKEN = os.environ["DISCORD_BOT_TOKEN"]
 DISCORD_CLIENT_ID = os.environ["DISCORD_CLIENT_ID"]
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
-TARGET_CHANNEL_ID = os.environ["TARGET_CHANNEL_ID"] # intro channel id for onboarding bot
+TARGET_CHANNEL_ID = int(os.environ["TARGET_CHANNEL_ID"]) # intro channel id for onboarding bot, an int like the IDs discord.py caches channels by
 
 # Initialize an empty list to store allowed server IDs
 ALLOWED_SERVER_IDS: List[int] = []
@@ -47,6 +47,37 @@ for s in server_channels:
     # Assign the mapped pair (server ID and moderation channel) to the dictionary
     SERVER_TO_MODERATION_CHANNEL[int(values[0])] = int(values[1])
 
+# Folder with the documents used for document search (QA) and onboarding
+DEFAULT_DOCS_DIR = os.path.join(LEO_DIR, "text")
+# Create a dictionary to map server IDs to their own documents folder, relative to the repo or absolute
+GUILD_TO_DOCS_DIR: Dict[int, str] = {}
+# Retrieve the guild_docs string from environment variables, or use an empty string if not present
+guild_docs = os.environ.get("GUILD_TO_DOCS_DIR", "")
+# Loop through guild_docs, splitting each pair on the first ':' and adding the pair to the dictionary
+for s in filter(None, guild_docs.split(",")):
+    guild_id, docs_dir = s.split(":", 1)
+    GUILD_TO_DOCS_DIR[int(guild_id)] = os.path.join(LEO_DIR, docs_dir)
+# Memory budget for the loaded document indexes, the least recently used ones are unloaded beyond it
+INDEX_MEMORY_BUDGET_MB = int(os.environ.get("INDEX_MEMORY_BUDGET_MB", "512"))
+# How the document vectors are stored for search: float32, float16 (half the memory, slower to score with numpy)
+# or int8 (a quarter of the memory, as fast as float32). Benchmark them with `python -m utils.bench_index`
+INDEX_VECTOR_DTYPE = os.environ.get("INDEX_VECTOR_DTYPE", "float32")
+# Folder inside a documents folder where utils/ingest_archive.py writes the index of the server's Discord history,
+# it is searched together with the documents
+ARCHIVE_INDEX_DIRNAME = "_archive"
+# Folder utils/ingest.py writes the index of a documents folder to, the bot loads it instead of embedding the
+# documents again as long as every document was ingested and none changed since
+INGESTED_INDEX_DIR = os.environ.get("INGESTED_INDEX_DIR", os.path.join(LEO_DIR, "data", "index"))
+# Messages of a channel further apart than this start a new conversation window, windows are embedded as one chunk
+ARCHIVE_WINDOW_GAP_MINUTES = 30
+# Maximum tokens of a conversation window, and windows shorter than the minimum (e.g. a lone "gm") are not indexed
+ARCHIVE_WINDOW_TOKENS = 300
+ARCHIVE_WINDOW_MIN_TOKENS = 20
+# Number of best float16/int8 matches re-ranked with the full precision vectors
+INDEX_RERANK_CANDIDATES = 50
+# How often to check the loaded documents folders for changes and reload their index, 0 disables it
+INDEX_WATCH_SECONDS = int(os.environ.get("INDEX_WATCH_SECONDS", "60"))
+
 # Create a Discord invite URL for the bot with specific permissions: 
 #   # Send Messages, Create Public Threads, Send Messages in Threads, Manage Messages, Manage Threads, Read Message History, Use Slash Command
 BOT_INVITE_URL = f"https://discord.com/api/oauth2/authorize?client_id={DISCORD_CLIENT_ID}&permissions=328565073920&scope=bot"
@@ -87,3 +118,80 @@ INACTIVATE_THREAD_PREFIX = "💬❌"
 MAX_CHARS_PER_REPLY_MSG = (
     1500  # discord has a 2k limit, we just break message into 1.5k
 )
+
+# Embedding model used for documents, queries and few-shot examples
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# Maximum number of inputs sent in a single embeddings request
+EMBEDDING_BATCH_SIZE = 500
+# Query embeddings requested within this window are sent in one embeddings request, up to this many
+EMBEDDING_BATCH_WINDOW_MS = 5
+EMBEDDING_BATCH_MAX_ITEMS = 64
+# Folder where embeddings are cached on disk between runs (the benchmarks point it elsewhere, their fake vectors
+# must not end up in the bot's cache)
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", os.path.join(LEO_DIR, "data", "cache"))
+
+# Size of the document chunks that are embedded, and how many tokens each chunk repeats from the previous one
+CHUNK_TOKENS = 250
+CHUNK_OVERLAP_TOKENS = 25
+
+# Number of most similar document chunks considered to answer a question
+QA_CANDIDATE_CHUNKS = 20
+# Token budget for the document chunks passed to the model to answer a question
+QA_CONTEXT_MAX_TOKENS = 1200
+# Relevance/diversity trade-off when picking the chunks: 1 picks by relevance only, lower values skip near-duplicates
+QA_MMR_LAMBDA = 0.5
+# Chunks more similar than this to a chunk already in the context are dropped as duplicates
+QA_DUPLICATE_SIMILARITY = 0.97
+
+# Number of most similar intro examples to include in the intro detector prompt
+INTRO_EXAMPLES_K = 4
+# Token budget for the intro examples included in the intro detector prompt
+INTRO_EXAMPLES_MAX_TOKENS = 300
+# Number of message embeddings the intro detector keeps after embedding them ahead of classification
+INTRO_QUERY_CACHE_SIZE = 1000
+
+# Discord rate limits the outbound send queue stays under: messages per channel every 5 seconds, and requests per second overall
+DISCORD_CHANNEL_SENDS_PER_5S = 5
+# edits and deletes in a channel are limited separately from its sends
+DISCORD_CHANNEL_EDITS_PER_5S = 5
+DISCORD_CHANNEL_DELETES_PER_5S = 5
+DISCORD_GLOBAL_REQUESTS_PER_SECOND = 50
+
+# Seconds a channel fetched over REST is reused before fetching it again, when it isn't in the gateway cache
+CHANNEL_CACHE_TTL_SECONDS = 300
+
+# SQLite database of the background job queue, number of jobs run at once, and retries of a failed job
+JOBS_DB_PATH = os.path.join(LEO_DIR, "data", "jobs.sqlite3")
+JOBS_WORKERS = 2
+JOBS_MAX_ATTEMPTS = 5
+# Delay before the first retry of a failed job, doubled after every attempt
+JOBS_RETRY_BASE_SECONDS = 30
+# How often a process running only some shards checks for jobs queued by the other shard processes
+JOBS_POLL_SECONDS = 5
+
+# Number of worker processes running the document search, intro classification and chat completions, 0 runs them in the bot process
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "0"))
+# Requests each worker process runs at once
+WORKER_THREADS = 4
+
+# Number of gateway shards, 0 connects with a single unsharded connection
+SHARD_COUNT = int(os.environ.get("SHARD_COUNT", "0"))
+# Shards run by this process, e.g. "0,1", to split the shards across several processes; all of them if unset
+shard_ids = os.environ.get("SHARD_IDS", "")
+SHARD_IDS = [int(s) for s in shard_ids.split(",") if s.strip()] or None
+# SQLite database holding the state shared by the shard processes, like the global Discord rate limit
+SHARED_STATE_PATH = os.path.join(LEO_DIR, "data", "state.sqlite3")
+
+# Texts whose SimHash fingerprints differ in at most this many of 64 bits are treated as near-duplicates
+DEDUP_MAX_HAMMING_DISTANCE = 3
+# Number of consecutive words hashed together when fingerprinting a text
+DEDUP_SHINGLE_WORDS = 3
+
+# Address the Prometheus metrics are served on (http://host:port/metrics), 0 disables it. Use a different port per process
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+# Requests taking longer than this are logged with the time spent in each stage
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", "10"))
+# The event loop counts as stalled when a callback runs this late, the stall is logged with the stack that blocked it.
+# 0 disables the watchdog
+LOOP_STALL_THRESHOLD_MS = int(os.environ.get("LOOP_STALL_THRESHOLD_MS", "250"))
@@ -0,0 +1,72 @@
+# Description: This file contains the context builder for document search (QA) prompts
+# Retrieved chunks are picked with maximal marginal relevance (MMR), so near-duplicate chunks (e.g. the same
+# navigation text crawled on every page) don't crowd out the others, and packed until the token budget is spent.
+from typing import List
+
+import numpy as np
+
+from src.embeddings import get_encoding
+from src.index import Chunk
+
+# Chunks are only trimmed to fit the budget if at least this many tokens are left for them
+MIN_TRIMMED_CHUNK_TOKENS = 50
+
+
+def mmr_order(query_vector: np.ndarray, vectors: np.ndarray, lambda_mult: float, max_similarity: float = 1.0) -> List[int]:
+    """Orders candidates by maximal marginal relevance.
+        Args:
+            query_vector: embedding of the query
+            vectors: embeddings of the candidates, one per row
+            lambda_mult: 1 ranks by relevance only, 0 by diversity only
+            max_similarity: candidates more similar than this to a better one are dropped as duplicates
+        Returns:
+            candidate positions, best first
+    """
+    relevance = vectors @ query_vector
+    similarity = vectors @ vectors.T
+    order: List[int] = []
+    # highest similarity of each candidate to the candidates already picked
+    redundancy = np.full(len(vectors), -np.inf)
+    remaining = np.ones(len(vectors), dtype=bool)
+    for _ in range(len(vectors)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * np.maximum(redundancy, 0)
+        scores[~remaining | (redundancy > max_similarity)] = -np.inf
+        best = int(np.argmax(scores))
+        if scores[best] == -np.inf:
+            break
+        order.append(best)
+        remaining[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return order
+
+
+def build_context(query_vector: np.ndarray, chunks: List[Chunk], vectors: np.ndarray, max_tokens: int, lambda_mult: float, max_similarity: float = 1.0) -> str:
+    """Builds the context passed to the model to answer a question.
+        Args:
+            query_vector: embedding of the question
+            chunks: retrieved chunks, most relevant first
+            vectors: embeddings of the retrieved chunks, one per row
+            max_tokens: token budget for the context
+            lambda_mult: relevance/diversity trade-off, see mmr_order
+            max_similarity: similarity above which a chunk is dropped as a duplicate, see mmr_order
+        Returns:
+            the selected chunks separated by blank lines
+    """
+    if not chunks:
+        return ""
+    encoding = get_encoding()
+    separator_tokens = len(encoding.encode("\n\n"))
+    budget = max_tokens
+    selected = []
+    for i in mmr_order(query_vector, vectors, lambda_mult, max_similarity):
+        # chunks store their token count, only chunks that need trimming are encoded
+        n_tokens = chunks[i].tokens if chunks[i].tokens is not None else len(encoding.encode(chunks[i].text))
+        available = budget - (separator_tokens if selected else 0)
+        if n_tokens <= available:
+            selected.append(chunks[i].text)
+            budget = available - n_tokens
+        elif available >= MIN_TRIMMED_CHUNK_TOKENS:
+            # trim the chunk to the tokens we have left, then the budget is spent
+            selected.append(encoding.decode(encoding.encode(chunks[i].text)[:available]))
+            break
+    return "\n\n".join(selected)
@@ -0,0 +1,108 @@
+# Description: This file contains the per-guild document corpora used by /ask and /onboard
+# Each guild can have its own documents folder (GUILD_TO_DOCS_DIR), the others share DEFAULT_DOCS_DIR.
+# Indexes are loaded on first use and the least recently used ones are unloaded when over INDEX_MEMORY_BUDGET_MB.
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from src.base import BaseRetriever
+from src.index import docs_snapshot
+from src.constants import DEFAULT_DOCS_DIR, GUILD_TO_DOCS_DIR, INDEX_MEMORY_BUDGET_MB
+
+# logger
+logger = logging.getLogger(__name__)
+
+
+class GuildCorpora:
+    def __init__(
+        self,
+        build_retriever: Callable[[str, Optional[BaseRetriever]], BaseRetriever],
+        guild_to_docs_dir: Dict[int, str] = GUILD_TO_DOCS_DIR,
+        default_docs_dir: str = DEFAULT_DOCS_DIR,
+        memory_budget_bytes: int = INDEX_MEMORY_BUDGET_MB * 1024 * 1024,
+    ):
+        self.build_retriever = build_retriever
+        self.guild_to_docs_dir = guild_to_docs_dir
+        self.default_docs_dir = default_docs_dir
+        self.memory_budget_bytes = memory_budget_bytes
+        # loaded retrievers keyed by documents folder, least recently used first
+        self._retrievers: "OrderedDict[str, BaseRetriever]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+
+    def docs_dir(self, guild_id: Optional[int]) -> str:
+        return self.guild_to_docs_dir.get(guild_id, self.default_docs_dir)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(r.index.nbytes for r in self._retrievers.values())
+
+    def version(self, guild_id: Optional[int]) -> Optional[int]:
+        """Returns the version of the guild's loaded index, or None if it isn't loaded."""
+        with self._lock:
+            retriever = self._retrievers.get(self.docs_dir(guild_id))
+        return retriever.index.version if retriever else None
+
+    def get(self, guild_id: Optional[int]) -> BaseRetriever:
+        """Returns the retriever for a guild's documents, loading them if needed. Blocking, run it in a thread."""
+        root = self.docs_dir(guild_id)
+        with self._lock:
+            if root in self._retrievers:
+                self._retrievers.move_to_end(root)
+                return self._retrievers[root]
+            load_lock = self._load_locks.setdefault(root, threading.Lock())
+
+        # only one thread loads a given folder, the others wait for it
+        with load_lock:
+            with self._lock:
+                if root in self._retrievers:
+                    self._retrievers.move_to_end(root)
+                    return self._retrievers[root]
+            return self._build(root, previous=None)
+
+    def _build(self, root: str, previous: Optional[BaseRetriever]) -> BaseRetriever:
+        # must be called holding the folder's load lock
+        start = time.perf_counter()
+        retriever = self.build_retriever(root, previous)
+        logger.info(f"Loaded index for {root} ({len(retriever.index)} chunks, {retriever.index.nbytes / 1e6:.1f}MB) in {time.perf_counter() - start:.2f}s")
+        with self._lock:
+            # swap the new index in, requests already searching the previous one finish with it
+            # and it is freed once they release it
+            self._retrievers[root] = retriever
+            self._retrievers.move_to_end(root)
+            self._evict(keep=root)
+        return retriever
+
+    def reload(self, guild_id: Optional[int]) -> BaseRetriever:
+        """Rebuilds a guild's index. Blocking, run it in a thread.
+            The current index keeps serving searches until the new one is built, and only
+            new or edited chunks are embedded again.
+            Returns:
+                the new retriever
+        """
+        return self.reload_docs_dir(self.docs_dir(guild_id))
+
+    def reload_docs_dir(self, root: str) -> BaseRetriever:
+        with self._lock:
+            load_lock = self._load_locks.setdefault(root, threading.Lock())
+        # a folder is only rebuilt by one thread at a time
+        with load_lock:
+            with self._lock:
+                previous = self._retrievers.get(root)
+            return self._build(root, previous=previous)
+
+    def changed_docs_dirs(self) -> List[str]:
+        """Returns the loaded documents folders whose files changed since their index was built."""
+        with self._lock:
+            loaded = list(self._retrievers.items())
+        return [root for root, retriever in loaded if docs_snapshot(root) != retriever.snapshot]
+
+    def _evict(self, keep: str) -> None:
+        # unload the least recently used indexes until we are under budget, requests still
+        # holding an unloaded retriever finish with it before it is freed
+        while self.nbytes > self.memory_budget_bytes and len(self._retrievers) > 1:
+            root = next(r for r in self._retrievers if r != keep)
+            retriever = self._retrievers.pop(root)
+            logger.info(f"Unloaded index for {root} ({retriever.index.nbytes / 1e6:.1f}MB) to stay under {self.memory_budget_bytes / 1e6:.0f}MB")
@@ -0,0 +1,122 @@
+# Description: This file contains the boilerplate stripping and near-duplicate detection used by the crawler and ingest
+# Near-duplicates are found with 64-bit SimHash fingerprints of word shingles: texts that differ by a few words have
+# fingerprints that differ by a few bits, and an index split into bands finds them without comparing every pair.
+import re
+import hashlib
+from collections import Counter
+from typing import Dict, Hashable, Iterable, List, Optional, Set, TypeVar
+
+import numpy as np
+
+from src.constants import DEDUP_MAX_HAMMING_DISTANCE, DEDUP_SHINGLE_WORDS
+
+T = TypeVar("T")
+
+WORD_PATTERN = re.compile(r"\w+")
+BITS = 64
+
+
+def _shingles(text: str, size: int) -> List[str]:
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) <= size:
+        return [" ".join(words)] if words else []
+    return [" ".join(words[i : i + size]) for i in range(len(words) - size + 1)]
+
+
+def simhash(text: str, shingle_words: int = DEDUP_SHINGLE_WORDS) -> int:
+    """Returns the 64-bit SimHash fingerprint of a text."""
+    shingles = _shingles(text, shingle_words)
+    if not shingles:
+        return 0
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") for s in set(shingles)],
+        dtype=np.uint64,
+    )
+    # each bit of the fingerprint is the majority vote of that bit over the shingle hashes
+    bits = (hashes[:, None] >> np.arange(BITS, dtype=np.uint64)) & np.uint64(1)
+    votes = bits.sum(axis=0) * 2 > len(hashes)
+    return int(sum(1 << i for i in np.flatnonzero(votes)))
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class SimHashIndex:
+    """Finds the fingerprints within max_distance bits of a new one.
+        The fingerprints are split into max_distance + 1 bands: two fingerprints that differ in at most
+        max_distance bits are equal in at least one band, so only fingerprints sharing a band are compared.
+    """
+    def __init__(self, max_distance: int = DEDUP_MAX_HAMMING_DISTANCE):
+        self.max_distance = max_distance
+        self.bands = max_distance + 1
+        self.band_bits = BITS // self.bands
+        self._tables: List[Dict[int, List[tuple]]] = [{} for _ in range(self.bands)]
+        self.size = 0
+
+    def _band_keys(self, fingerprint: int) -> List[int]:
+        mask = (1 << self.band_bits) - 1
+        # the last band takes the remaining bits
+        keys = [(fingerprint >> (i * self.band_bits)) & mask for i in range(self.bands - 1)]
+        keys.append(fingerprint >> ((self.bands - 1) * self.band_bits))
+        return keys
+
+    def find(self, fingerprint: int) -> Optional[Hashable]:
+        """Returns the key of a fingerprint near this one, or None."""
+        for table, band_key in zip(self._tables, self._band_keys(fingerprint)):
+            for other, key in table.get(band_key, ()):
+                if hamming_distance(fingerprint, other) <= self.max_distance:
+                    return key
+        return None
+
+    def add(self, fingerprint: int, key: Hashable) -> None:
+        for table, band_key in zip(self._tables, self._band_keys(fingerprint)):
+            table.setdefault(band_key, []).append((fingerprint, key))
+        self.size += 1
+
+    def add_if_new(self, text: str, key: Hashable) -> Optional[Hashable]:
+        """Adds a text unless it is a near-duplicate of one already added, in which case that one's key is returned."""
+        fingerprint = simhash(text)
+        duplicate_of = self.find(fingerprint)
+        if duplicate_of is None:
+            self.add(fingerprint, key)
+        return duplicate_of
+
+
+def drop_near_duplicates(items: Iterable[T], text=lambda item: item, index: Optional[SimHashIndex] = None) -> List[T]:
+    """Returns the items whose text is not a near-duplicate of an earlier item's, keeping the first of each group."""
+    index = index if index is not None else SimHashIndex()
+    kept = []
+    for item in items:
+        if index.add_if_new(text(item), index.size) is None:
+            kept.append(item)
+    return kept
+
+
+def find_boilerplate(texts: Iterable[str], min_documents: int = 3, max_fraction: float = 0.5) -> Set[str]:
+    """Returns the lines repeated across many documents of a site, like navigation, footers and subscribe prompts.
+        Args:
+            texts: the text of each document of the same site
+            min_documents: lines are only boilerplate if they appear in at least this many documents
+            max_fraction: lines appearing in more than this fraction of the documents are boilerplate
+        Returns:
+            the boilerplate lines, stripped of surrounding whitespace
+    """
+    frequency = Counter()
+    documents = 0
+    for text in texts:
+        frequency.update({line.strip() for line in text.splitlines()} - {""})
+        documents += 1
+    threshold = max(min_documents, max_fraction * documents)
+    return {line for line, count in frequency.items() if count >= threshold}
+
+
+def remove_lines(text: str, lines: Set[str]) -> str:
+    """Removes the given lines from a text and collapses runs of blank lines."""
+    kept = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line in lines or (not line and (not kept or not kept[-1])):
+            continue
+        kept.append(line)
+    return "\n".join(kept).strip()
@@ -0,0 +1,195 @@
+# Description: This file contains helpers for embedding text with OpenAI and caching the vectors on disk
+import os
+import time
+import asyncio
+import hashlib
+import functools
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import openai
+import tiktoken
+
+from src.constants import (
+    OPENAI_API_KEY,
+    EMBEDDING_MODEL,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_CACHE_DIR,
+    EMBEDDING_BATCH_WINDOW_MS,
+    EMBEDDING_BATCH_MAX_ITEMS,
+)
+from src.utils import logger
+from src.metrics import record_cache
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str = "text-davinci-003") -> tiktoken.Encoding:
+    # tiktoken encodings are expensive to build, so we only load each one once
+    return tiktoken.encoding_for_model(model)
+
+
+def count_tokens(text: str, model: str = "text-davinci-003") -> int:
+    return len(get_encoding(model).encode(text))
+
+
+def embed_texts(texts: Sequence[str], model: str = EMBEDDING_MODEL) -> np.ndarray:
+    """Embeds a list of texts, sending at most EMBEDDING_BATCH_SIZE texts per request.
+        Args:
+            texts: strings to embed
+            model: the OpenAI embedding model to use
+        Returns:
+            float32 matrix with one row per text
+    """
+    vectors: List[List[float]] = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        batch = [text.replace("\n", " ") for text in texts[start : start + EMBEDDING_BATCH_SIZE]]
+        response = openai.Embedding.create(input=batch, model=model, api_key=OPENAI_API_KEY)
+        # the API does not guarantee the order of the returned embeddings
+        data = sorted(response["data"], key=lambda d: d["index"])
+        vectors.extend(d["embedding"] for d in data)
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def embed_texts_with_retries(texts: Sequence[str], max_retries: int = 5, model: str = EMBEDDING_MODEL) -> np.ndarray:
+    """Same as embed_texts, retrying with exponential backoff when the API is rate limited or unavailable."""
+    retryable = (
+        openai.error.RateLimitError,
+        openai.error.APIError,
+        openai.error.Timeout,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+    )
+    for attempt in range(max_retries + 1):
+        try:
+            return embed_texts(texts, model=model)
+        except retryable as e:
+            if attempt == max_retries:
+                raise
+            delay = 2 ** attempt
+            logger.info(f"Embedding request failed ({e}), retrying in {delay}s")
+            time.sleep(delay)
+
+
+def cached_embed_texts(texts: Sequence[str], name: str, model: str = EMBEDDING_MODEL) -> np.ndarray:
+    """Embeds a list of texts, reusing the vectors saved on disk by a previous run.
+        The cache file name includes a hash of the model and the texts, so editing
+        the texts invalidates the cache automatically.
+        Args:
+            texts: strings to embed
+            name: prefix of the cache file in EMBEDDING_CACHE_DIR
+            model: the OpenAI embedding model to use
+        Returns:
+            float32 matrix with one row per text
+    """
+    digest = hashlib.sha256("\x00".join([model, *texts]).encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(EMBEDDING_CACHE_DIR, f"{name}-{digest}.npy")
+    record_cache("embeddings", hit=os.path.exists(path))
+    if os.path.exists(path):
+        logger.debug(f"Loading cached embeddings from {path}")
+        return np.load(path)
+
+    vectors = embed_texts(texts, model=model)
+    os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+    np.save(path, vectors)
+    logger.info(f"Saved {len(texts)} embeddings to {path}")
+    return vectors
+
+
+def cached_embed_chunks(texts: Sequence[str], name: str, known: Optional[Dict[str, np.ndarray]] = None, model: str = EMBEDDING_MODEL) -> np.ndarray:
+    """Embeds the chunks of a documents folder, reusing the vector saved on disk for every chunk text already embedded.
+        Unlike cached_embed_texts each text is cached on its own (by a hash of it), so when a few documents change
+        only their chunks are embedded again, and a restarted bot or a new worker process embeds nothing.
+        Args:
+            texts: strings to embed
+            name: prefix of the cache file in EMBEDDING_CACHE_DIR, one per documents folder
+            known: vectors of texts already in memory, e.g. from the index being reloaded
+            model: the OpenAI embedding model to use
+        Returns:
+            float32 matrix with one row per text
+    """
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+    path = os.path.join(EMBEDDING_CACHE_DIR, f"{name}-{model}.npz")
+    hashes = [hashlib.sha256(text.encode("utf-8")).hexdigest()[:16] for text in texts]
+    cached: Dict[str, np.ndarray] = {}
+    if os.path.exists(path):
+        with np.load(path) as cache:
+            cached = dict(zip(cache["hashes"].tolist(), cache["vectors"]))
+    known = known or {}
+    vectors: Dict[str, np.ndarray] = {}
+    for text, digest in zip(texts, hashes):
+        if text in known:
+            vectors[digest] = known[text]
+        elif digest in cached:
+            vectors[digest] = cached[digest]
+    # embed each missing text once, even if it appears in several documents
+    missing = list(dict.fromkeys(text for text, digest in zip(texts, hashes) if digest not in vectors))
+    record_cache("embeddings", hit=not missing)
+    if missing:
+        logger.info(f"Embedding {len(missing)} of {len(set(hashes))} chunks for {name}, the others are cached")
+        for text, vector in zip(missing, embed_texts_with_retries(missing, model=model)):
+            vectors[hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]] = vector
+    if missing or set(cached) != set(vectors):
+        # only the current chunks are kept, so the cache doesn't grow with every edit
+        os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, hashes=np.array(list(vectors)), vectors=np.stack(list(vectors.values())).astype(np.float32))
+        # renamed into place, so another process never reads a half written cache
+        os.replace(tmp, path)
+    return np.stack([vectors[digest] for digest in hashes]).astype(np.float32, copy=False)
+
+
+class EmbeddingBatcher:
+    """Coalesces the texts embedded by concurrent requests into one embeddings API request.
+        Texts arriving within window_ms of the first one, or until max_items are waiting, are sent
+        together and each caller gets its own vector back.
+    """
+    def __init__(self, window_ms: float = EMBEDDING_BATCH_WINDOW_MS, max_items: int = EMBEDDING_BATCH_MAX_ITEMS):
+        self.window_ms = window_ms
+        self.max_items = max_items
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # embeddings API requests sent and texts embedded, to see how much batching saves
+        self.requests = 0
+        self.texts = 0
+
+    async def embed(self, text: str) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_ms / 1000, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._embed_batch(batch))
+
+    async def _embed_batch(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        # identical texts in the batch are only embedded once
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.requests += 1
+        self.texts += len(texts)
+        try:
+            loop = asyncio.get_running_loop()
+            vectors = await loop.run_in_executor(None, embed_texts_with_retries, texts)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        rows = {text: i for i, text in enumerate(texts)}
+        for text, future in batch:
+            if not future.done():
+                future.set_result(vectors[rows[text]])
+
+
+# Shared batcher for the query embeddings of /ask, /onboard and the intro detector
+query_embeddings = EmbeddingBatcher()
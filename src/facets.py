@@ -0,0 +1,123 @@
+# Description: This file contains the chunk metadata the document index can filter searches on
+# Each facet (source, domain, channel, date, guild) is stored as one int32 code per chunk, and each of its values has
+# a precomputed posting list of the rows holding it: a bitmap for values held by many chunks, the sorted row numbers
+# for the others. A filtered search starts from the smallest posting list, so it costs time in proportion to the
+# chunks it matches rather than to the whole index.
+import os
+from typing import Dict, Iterable, List, Optional, Union
+
+import numpy as np
+
+FACETS = ("source", "domain", "channel", "date", "guild")
+
+# Filters: facet -> value, or list of values any of which matches
+Filters = Dict[str, Union[str, Iterable[str]]]
+
+# A posting list is stored as a bitmap once it holds at least 1/32 of the rows, i.e. once the bitmap
+# (one bit per row) is smaller than the int32 row numbers
+DENSE_FRACTION = 32
+
+
+def chunk_facet(chunk, facet: str) -> Optional[str]:
+    """Returns a chunk's value for a facet, or None if it doesn't have one."""
+    if facet == "source":
+        return chunk.source
+    if facet == "domain":
+        # crawled sites are saved in a folder named after their domain, see utils/crawler.py
+        parts = chunk.source.split(os.sep)
+        return parts[0] if len(parts) > 1 and chunk.channel is None else None
+    if facet == "channel":
+        return chunk.channel
+    if facet == "date":
+        return chunk.time_stamp[:10] if chunk.time_stamp else None
+    if facet == "guild":
+        return str(chunk.guild) if chunk.guild is not None else None
+    raise ValueError(f"Unknown facet {facet}, use one of {', '.join(FACETS)}")
+
+
+class FacetIndex:
+    def __init__(self, chunks: list):
+        self.size = len(chunks)
+        # per facet: its values, the code of each chunk's value (-1 if it has none), and the posting list and
+        # number of rows of each value
+        self.values: Dict[str, List[str]] = {}
+        self.lookup: Dict[str, Dict[str, int]] = {}
+        self.codes: Dict[str, np.ndarray] = {}
+        self.postings: Dict[str, List[np.ndarray]] = {}
+        self.counts: Dict[str, np.ndarray] = {}
+        for facet in FACETS:
+            column = [chunk_facet(c, facet) for c in chunks]
+            values = sorted({v for v in column if v is not None})
+            lookup = {v: i for i, v in enumerate(values)}
+            codes = np.array([lookup.get(v, -1) for v in column], dtype=np.int32)
+            # a stable sort groups the rows of each value, still in row order
+            order = np.argsort(codes, kind="stable").astype(np.int32)
+            starts = np.searchsorted(codes[order], np.arange(len(values) + 1))
+            self.values[facet] = values
+            self.lookup[facet] = lookup
+            self.codes[facet] = codes
+            self.postings[facet] = [self._posting(order[starts[i] : starts[i + 1]]) for i in range(len(values))]
+            self.counts[facet] = np.diff(starts)
+
+    def _posting(self, rows: np.ndarray) -> np.ndarray:
+        if len(rows) * DENSE_FRACTION < self.size:
+            return rows
+        bits = np.zeros(self.size, dtype=bool)
+        bits[rows] = True
+        return np.packbits(bits)
+
+    def _is_bitmap(self, posting: np.ndarray) -> bool:
+        return posting.dtype == np.uint8
+
+    def _posting_rows(self, posting: np.ndarray) -> np.ndarray:
+        if self._is_bitmap(posting):
+            return np.flatnonzero(np.unpackbits(posting, count=self.size)).astype(np.int32)
+        return posting
+
+    @property
+    def nbytes(self) -> int:
+        return sum(codes.nbytes for codes in self.codes.values()) + sum(
+            posting.nbytes for postings in self.postings.values() for posting in postings
+        )
+
+    def rows(self, filters: Filters) -> np.ndarray:
+        """Returns the sorted rows matching every facet of the filters."""
+        wanted: Dict[str, List[int]] = {}
+        for facet, values in filters.items():
+            if facet not in self.codes:
+                raise ValueError(f"Unknown facet {facet}, use one of {', '.join(FACETS)}")
+            values = [values] if isinstance(values, str) else list(values)
+            wanted[facet] = [self.lookup[facet][v] for v in values if v in self.lookup[facet]]
+            if not wanted[facet]:
+                return np.zeros(0, dtype=np.int32)
+        if not wanted:
+            return np.arange(self.size, dtype=np.int32)
+
+        # facets whose values are all held by many rows are combined as bitmaps, a byte for 8 rows
+        dense = [f for f in wanted if all(self._is_bitmap(self.postings[f][c]) for c in wanted[f])]
+        smallest = min(wanted, key=lambda f: self.counts[f][wanted[f]].sum())
+        if smallest in dense:
+            bitmap = None
+            for facet in dense:
+                union = np.bitwise_or.reduce([self.postings[facet][c] for c in wanted[facet]])
+                bitmap = union if bitmap is None else bitmap & union
+            rows = np.flatnonzero(np.unpackbits(bitmap, count=self.size)).astype(np.int32)
+            remaining = [f for f in wanted if f not in dense]
+        else:
+            # start from the rows of the most selective facet
+            postings = [self._posting_rows(self.postings[smallest][c]) for c in wanted[smallest]]
+            rows = postings[0] if len(postings) == 1 else np.sort(np.concatenate(postings))
+            remaining = [f for f in wanted if f != smallest]
+        # and check the other facets on those rows only
+        for facet in remaining:
+            rows = rows[np.isin(self.codes[facet][rows], wanted[facet])]
+        return rows
+
+    def exclude_other_guilds(self, rows: Optional[np.ndarray], guild_id: Optional[int]) -> Optional[np.ndarray]:
+        """Drops the rows belonging to another guild than this one (e.g. its Discord archive) from rows (None: every row)."""
+        others = [code for value, code in self.lookup["guild"].items() if value != str(guild_id)]
+        if not others:
+            return rows
+        if rows is None:
+            return np.flatnonzero(~np.isin(self.codes["guild"], others)).astype(np.int32)
+        return rows[~np.isin(self.codes["guild"][rows], others)]
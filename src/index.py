@@ -0,0 +1,270 @@
+# Description: This file contains the in-memory vector index used by the retrievers for document search (QA)
+import os
+import json
+import hashlib
+import weakref
+import tempfile
+import itertools
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from src.constants import EMBEDDING_CACHE_DIR, EMBEDDING_MODEL, INDEX_VECTOR_DTYPE, INDEX_RERANK_CANDIDATES, ARCHIVE_INDEX_DIRNAME, INGESTED_INDEX_DIR
+from src.embeddings import cached_embed_chunks
+from src.chunking import chunk_file
+from src.dedup import drop_near_duplicates
+from src.facets import FacetIndex, Filters
+
+# Every index gets a new version, so results cached against an older index are never reused
+_versions = itertools.count(1)
+
+
+def docs_snapshot(root: str) -> Tuple[Tuple[str, float, int], ...]:
+    # (path, modified time, size) of every document, used to detect changes in a documents folder
+    paths = sorted(Path(root).glob("**/*.txt"))
+    # the archive index's checkpoint is rewritten whenever utils/ingest_archive.py adds to it
+    checkpoint = Path(root) / ARCHIVE_INDEX_DIRNAME / "checkpoint.json"
+    if checkpoint.exists():
+        paths.append(checkpoint)
+    # and utils/ingest.py's when it ingests the folder again
+    ingested = Path(INGESTED_INDEX_DIR) / "checkpoint.json"
+    if ingested.exists():
+        paths.append(ingested)
+    return tuple((str(p), p.stat().st_mtime, p.stat().st_size) for p in paths)
+
+# Rows scored at once when searching quantized vectors, small enough for their float32 copy to stay in cache
+SCORE_BLOCK_ROWS = 128
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Compresses float32 vectors for search.
+        Args:
+            vectors: float32 matrix with one vector per row
+            dtype: "float32" (unchanged), "float16", or "int8" (each row scaled so its largest value maps to 127)
+        Returns:
+            the compressed matrix and, for int8, the per-row scale to multiply the scores by
+    """
+    if dtype == "float32":
+        return vectors, None
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f"Unsupported index dtype {dtype}, use float32, float16 or int8")
+
+
+# Chunk: a piece of a document that is embedded and returned by searches
+@dataclass(frozen=True)
+class Chunk:
+    text: str
+    source: str
+    # tiktoken count of the text, if known
+    tokens: Optional[int] = None
+    # for conversation windows of the Discord archive: the channel, and when the window started (UTC, ISO format)
+    channel: Optional[str] = None
+    time_stamp: Optional[str] = None
+    # the guild a chunk belongs to, it is only searched from that guild
+    guild: Optional[int] = None
+
+
+class VectorIndex:
+    def __init__(self, chunks: List[Chunk], vectors: np.ndarray, dtype: str = INDEX_VECTOR_DTYPE):
+        self.chunks = chunks
+        self.dtype = dtype
+        self.version = next(_versions)
+        # searches score every chunk against the compressed codes
+        self.codes, self.scales = quantize(vectors, dtype)
+        if self.codes is vectors:
+            self.vectors = vectors
+        else:
+            # the full precision vectors only re-rank a few candidates per search, so they stay on
+            # disk and only the rows we read are paged in
+            os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+            fd, path = tempfile.mkstemp(prefix="index-", suffix=".npy", dir=EMBEDDING_CACHE_DIR)
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, vectors)
+            self.vectors = np.load(path, mmap_mode="r")
+            try:
+                # the mapping outlives the file's name on POSIX, so nothing is left behind even if the bot is killed
+                os.remove(path)
+            except OSError:
+                # Windows can't remove a mapped file, it is removed once the index is freed
+                weakref.finalize(self, os.remove, path)
+        # metadata searches can be filtered on, with a posting list per value (see src/facets.py)
+        self.facets = FacetIndex(chunks)
+        # documents have no time stamp (NaT)
+        self.time_stamps = np.array([c.time_stamp for c in chunks], dtype="datetime64[s]")
+
+    @classmethod
+    def from_directory(cls, root: str, previous: Optional["VectorIndex"] = None, dtype: str = INDEX_VECTOR_DTYPE) -> "VectorIndex":
+        """Loads, splits and embeds every .txt document under a folder.
+            Args:
+                root: folder to load the documents from
+                previous: index built from an earlier version of the folder, its vectors are
+                    reused for unchanged chunks, as are the vectors cached on disk by earlier runs,
+                    so only new or edited chunks are embedded
+                dtype: how the vectors are stored for search, see quantize
+            Returns:
+                the index over the documents' chunks
+        """
+        chunks = []
+        for path in sorted(Path(root).glob("**/*.txt")):
+            source = os.path.relpath(path, root)
+            chunks.extend(Chunk(text=text, source=source, tokens=tokens) for text, tokens in chunk_file(str(path)))
+        # near-duplicate chunks would only take up room in the context, don't embed them
+        chunks = drop_near_duplicates(chunks, text=lambda c: c.text)
+        if not chunks:
+            return cls(chunks, np.zeros((0, 0), dtype=np.float32), dtype="float32")
+
+        known = {}
+        if previous is not None:
+            known = {c.text: previous.vectors[i] for i, c in enumerate(previous.chunks)}
+        # chunk vectors are cached on disk per folder, so restarts and worker processes reuse them too
+        name = "chunks-" + hashlib.sha256(os.path.realpath(root).encode("utf-8")).hexdigest()[:16]
+        vectors = cached_embed_chunks([c.text for c in chunks], name, known=known)
+        return cls(chunks, vectors, dtype=dtype)
+
+    @classmethod
+    def load(cls, path: str, dtype: str = INDEX_VECTOR_DTYPE) -> "VectorIndex":
+        """Loads an index written by utils/ingest.py.
+            Args:
+                path: the folder with the chunks-*.jsonl and vectors-*.npy shards
+                dtype: how the vectors are stored for search, see quantize
+            Returns:
+                the index over every shard's chunks
+        """
+        chunks = []
+        vectors = []
+        for chunks_path in sorted(Path(path).glob("chunks-*.jsonl")):
+            shard = chunks_path.stem[len("chunks-"):]
+            with open(chunks_path, encoding="utf-8") as f:
+                shard_chunks = [Chunk(**json.loads(line)) for line in f]
+            # shards of files without any text have no vectors
+            if shard_chunks:
+                chunks.extend(shard_chunks)
+                vectors.append(np.load(Path(path) / f"vectors-{shard}.npy"))
+        if not chunks:
+            return cls(chunks, np.zeros((0, 0), dtype=np.float32), dtype="float32")
+        return cls(chunks, np.concatenate(vectors), dtype=dtype)
+
+    @classmethod
+    def load_ingested(cls, root: str, path: str = INGESTED_INDEX_DIR, dtype: str = INDEX_VECTOR_DTYPE) -> Optional["VectorIndex"]:
+        """Loads the index utils/ingest.py wrote for a documents folder, if it is up to date.
+            Args:
+                root: the documents folder
+                path: the folder utils/ingest.py wrote to
+                dtype: how the vectors are stored for search, see quantize
+            Returns:
+                the index, or None if the folder wasn't ingested there, with the current embedding model,
+                or some of its documents were added or changed since
+        """
+        checkpoint_path = Path(path) / "checkpoint.json"
+        if not checkpoint_path.exists():
+            return None
+        with open(checkpoint_path, encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("docs") != os.path.realpath(root) or checkpoint["settings"].get("model") != EMBEDDING_MODEL:
+            return None
+        ingested_at = checkpoint_path.stat().st_mtime
+        done_files = set(checkpoint["done_files"])
+        for doc in Path(root).glob("**/*.txt"):
+            if os.path.relpath(doc, root) not in done_files or doc.stat().st_mtime > ingested_at:
+                return None
+        return cls.load(path, dtype=dtype)
+
+    @classmethod
+    def concat(cls, indexes: List["VectorIndex"], dtype: str = INDEX_VECTOR_DTYPE) -> "VectorIndex":
+        """Joins several indexes into one, e.g. the documents and the Discord archive."""
+        indexes = [index for index in indexes if len(index)]
+        if not indexes:
+            return cls([], np.zeros((0, 0), dtype=np.float32), dtype="float32")
+        chunks = [c for index in indexes for c in index.chunks]
+        return cls(chunks, np.concatenate([np.asarray(index.vectors) for index in indexes]), dtype=dtype)
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    @property
+    def nbytes(self) -> int:
+        # approximate memory held by the index: the search vectors plus the chunk text
+        nbytes = self.codes.nbytes + self.facets.nbytes + self.time_stamps.nbytes + sum(len(c.text.encode("utf-8")) for c in self.chunks)
+        if self.scales is not None:
+            nbytes += self.scales.nbytes
+        return nbytes
+
+    def filter_rows(self, filters: Optional[Filters] = None, since=None, until=None, guild_id: Optional[int] = None) -> Optional[np.ndarray]:
+        """Returns the rows of the chunks a search should score, or None to score them all.
+            Args:
+                filters: facet -> value (or list of values) the chunks must have, e.g. {"channel": "general"}, see src/facets.py
+                since, until: only conversation windows of the Discord archive that started in this time range (UTC)
+                guild_id: the guild searching, chunks belonging to another guild are left out
+            Returns:
+                the sorted rows
+        """
+        rows = self.facets.rows(filters) if filters else None
+        if since is not None or until is not None:
+            rows = np.arange(len(self.chunks)) if rows is None else rows
+            time_stamps = self.time_stamps[rows]
+            # comparisons with the NaT of documents are False, so they are filtered out
+            mask = np.ones(len(rows), dtype=bool)
+            if since is not None:
+                mask &= time_stamps >= np.datetime64(since, "s")
+            if until is not None:
+                mask &= time_stamps < np.datetime64(until, "s")
+            rows = rows[mask]
+        rows = self.facets.exclude_other_guilds(rows, guild_id)
+        # scoring a subset copies its vectors, not worth it if every row matches
+        if rows is not None and len(rows) == len(self.chunks):
+            return None
+        return rows
+
+    def approximate_scores(self, query_vector: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        # ada embeddings are unit length, so the dot product is the cosine similarity
+        if self.codes is self.vectors:
+            return (self.vectors if rows is None else self.vectors[rows]) @ query_vector
+        query_vector = query_vector.astype(np.float32)
+        n = len(self.codes) if rows is None else len(rows)
+        scores = np.empty(n, dtype=np.float32)
+        # convert one block at a time into the same buffer, so the whole float32 matrix is never built
+        buffer = np.empty((SCORE_BLOCK_ROWS, self.codes.shape[1]), dtype=np.float32)
+        for start in range(0, n, SCORE_BLOCK_ROWS):
+            block = self.codes[start : start + SCORE_BLOCK_ROWS] if rows is None else self.codes[rows[start : start + SCORE_BLOCK_ROWS]]
+            np.copyto(buffer[: len(block)], block, casting="unsafe")
+            scores[start : start + len(block)] = buffer[: len(block)] @ query_vector
+        if self.scales is not None:
+            scores *= self.scales if rows is None else self.scales[rows]
+        return scores
+
+    def search(self, query_vector: np.ndarray, k: int = 4, rows: Optional[np.ndarray] = None) -> List[Tuple[Chunk, float]]:
+        """Finds the chunks most similar to a query.
+            Args:
+                query_vector: embedding of the query
+                k: number of chunks to return
+                rows: only search these rows, e.g. from filter_rows
+            Returns:
+                (chunk, cosine similarity) pairs, most similar first
+        """
+        rows, scores = self.search_rows(query_vector, k=k, rows=rows)
+        return [(self.chunks[row], float(score)) for row, score in zip(rows, scores)]
+
+    def search_rows(self, query_vector: np.ndarray, k: int = 4, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Same as search, but returns the row numbers of the chunks and their similarities."""
+        if len(self.chunks) == 0 or (rows is not None and len(rows) == 0):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        # only the filtered rows are scored
+        scores = self.approximate_scores(query_vector, rows=rows)
+        candidates = np.arange(len(scores)) if rows is None else rows
+        if self.codes is not self.vectors:
+            # re-rank the best approximate matches with the full precision vectors
+            n = min(max(k, INDEX_RERANK_CANDIDATES), len(scores))
+            candidates = candidates[np.sort(np.argpartition(-scores, n - 1)[:n])]
+            scores = np.asarray(self.vectors[candidates]) @ query_vector
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return candidates[top], scores[top]
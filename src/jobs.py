@@ -0,0 +1,328 @@
+# Description: This file contains the persistent background job queue used for long-running commands
+# Jobs are stored in a SQLite database, so a job interrupted by a restart resumes from its last checkpoint
+# instead of starting over, and they run in worker coroutines instead of inside a slash command, so they
+# are not cut short when the 15 minute interaction token expires.
+# The database is shared with the other shard processes, so its statements can wait on their transactions: they run in
+# the queue's own thread, never on the event loop. Each process only runs the jobs of the guilds on its shards.
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import functools
+import threading
+import concurrent.futures
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from src.constants import (
+    JOBS_DB_PATH,
+    JOBS_WORKERS,
+    JOBS_MAX_ATTEMPTS,
+    JOBS_RETRY_BASE_SECONDS,
+    JOBS_POLL_SECONDS,
+    SHARD_IDS,
+)
+from src.shards import shard_for
+
+# logger
+logger = logging.getLogger(__name__)
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Identifies this process among the shard processes sharing the database, the same after a restart
+OWNER = "shards:" + ",".join(str(s) for s in SHARD_IDS) if SHARD_IDS is not None else "all"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    items_total INTEGER,
+    items_done INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    owner TEXT,
+    shard INTEGER,
+    guild_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_state_run_at ON jobs (state, run_at);
+CREATE TABLE IF NOT EXISTS job_items (
+    job_id INTEGER NOT NULL,
+    item TEXT NOT NULL,
+    PRIMARY KEY (job_id, item)
+);
+"""
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    payload: Dict[str, Any]
+    state: str
+    attempts: int
+    run_at: float
+    created_at: float
+    updated_at: float
+    items_total: Optional[int]
+    items_done: int
+    error: Optional[str]
+    owner: Optional[str]
+    # shard of the guild the job runs for, only the process running that shard claims it
+    shard: Optional[int]
+    # the guild the job runs for, only that guild can see it with /jobs
+    guild_id: Optional[int]
+
+
+class JobContext:
+    """Passed to a job handler to checkpoint its progress.
+        Items marked done are skipped when the job is retried or resumed after a restart.
+    """
+    def __init__(self, queue: "JobQueue", job: Job, done: set):
+        self.queue = queue
+        self.job = job
+        self._done = done
+
+    @property
+    def payload(self) -> Dict[str, Any]:
+        return self.job.payload
+
+    async def update_payload(self, **values) -> None:
+        # save state computed by the first attempt, e.g. the list of items, so a retry doesn't compute it again
+        self.job.payload.update(values)
+        await self.queue._run(self.queue._execute, "UPDATE jobs SET payload = ?, updated_at = ? WHERE id = ?", (json.dumps(self.job.payload), time.time(), self.job.id))
+
+    async def set_total(self, total: int) -> None:
+        self.job.items_total = total
+        await self.queue._run(self.queue._execute, "UPDATE jobs SET items_total = ?, updated_at = ? WHERE id = ?", (total, time.time(), self.job.id))
+
+    def is_done(self, item: Any) -> bool:
+        return str(item) in self._done
+
+    async def checkpoint(self, item: Any) -> None:
+        item = str(item)
+        if item in self._done:
+            return
+        self._done.add(item)
+        await self.queue._run(self.queue._execute_many, [
+            ("INSERT OR IGNORE INTO job_items (job_id, item) VALUES (?, ?)", (self.job.id, item)),
+            ("UPDATE jobs SET items_done = ?, updated_at = ? WHERE id = ?", (len(self._done), time.time(), self.job.id)),
+        ])
+
+
+class JobQueue:
+    def __init__(self, path: str = JOBS_DB_PATH, workers: int = JOBS_WORKERS, max_attempts: int = JOBS_MAX_ATTEMPTS, retry_base_seconds: float = JOBS_RETRY_BASE_SECONDS, owner: str = OWNER, shard_ids: Optional[Sequence[int]] = SHARD_IDS):
+        self.path = path
+        self.owner = owner
+        # the shards this process runs, None for all of them
+        self.shard_ids = list(shard_ids) if shard_ids is not None else None
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self._handlers: Dict[str, Callable[[JobContext], Awaitable[None]]] = {}
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        # the statements wait on the other shard processes' transactions, so they run in this thread
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs")
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def handler(self, kind: str):
+        """Decorator registering the coroutine function that runs the jobs of a kind."""
+        def decorator(fn: Callable[[JobContext], Awaitable[None]]):
+            self._handlers[kind] = fn
+            return fn
+        return decorator
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # several shard processes can share the database, wait for each other's transactions
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+            # databases created before jobs had an owner
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+            if "owner" not in columns:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            # and before they had a shard, any process can run those
+            if "shard" not in columns:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN shard INTEGER")
+            # and before they had a guild column, the onboarding jobs had it in their payload
+            if "guild_id" not in columns:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN guild_id INTEGER")
+                for job_id, payload in self._conn.execute("SELECT id, payload FROM jobs").fetchall():
+                    self._conn.execute("UPDATE jobs SET guild_id = ? WHERE id = ?", (json.loads(payload).get("guild_id"), job_id))
+        return self._conn
+
+    async def _run(self, fn: Callable, *args):
+        # runs a blocking database call in the queue's thread
+        return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+
+    def _execute(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def _execute_many(self, statements: List[tuple]) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _done_items(self, job_id: int) -> set:
+        return {row[0] for row in self._execute("SELECT item FROM job_items WHERE job_id = ?", (job_id,))}
+
+    @staticmethod
+    def _row_to_job(row: tuple) -> Job:
+        row = list(row)
+        row[2] = json.loads(row[2])
+        return Job(*row)
+
+    async def enqueue(self, kind: str, payload: Dict[str, Any], guild_id: Optional[int] = None) -> int:
+        """Adds a job and returns its ID, it is picked up by the next idle worker of the process running the guild's shard."""
+        if kind not in self._handlers:
+            raise ValueError(f"No handler for jobs of kind '{kind}'")
+        job_id = await self._run(self._insert, kind, payload, guild_id)
+        logger.info(f"Queued {kind} job {job_id}")
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    def _insert(self, kind: str, payload: Dict[str, Any], guild_id: Optional[int]) -> int:
+        now = time.time()
+        with self._lock:
+            cursor = self._connect().execute(
+                "INSERT INTO jobs (kind, payload, state, run_at, created_at, updated_at, shard, guild_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload), QUEUED, now, now, now, shard_for(guild_id), guild_id),
+            )
+            return cursor.lastrowid
+
+    async def get(self, job_id: int, guild_id: Optional[int]) -> Optional[Job]:
+        """Returns a job of a guild, or None if it doesn't exist or belongs to another guild."""
+        rows = await self._run(self._execute, "SELECT * FROM jobs WHERE id = ? AND guild_id IS ?", (job_id, guild_id))
+        return self._row_to_job(rows[0]) if rows else None
+
+    async def recent(self, guild_id: Optional[int], limit: int = 10) -> List[Job]:
+        """Returns the latest jobs of a guild, newest first."""
+        rows = await self._run(self._execute, "SELECT * FROM jobs WHERE guild_id IS ? ORDER BY id DESC LIMIT ?", (guild_id, limit))
+        return [self._row_to_job(row) for row in rows]
+
+    async def context(self, job: Job) -> JobContext:
+        """Returns the context a handler runs the job with, with the items checkpointed by earlier attempts."""
+        return JobContext(self, job, await self._run(self._done_items, job.id))
+
+    def _shard_filter(self) -> tuple:
+        # SQL condition and parameters selecting the jobs of this process's shards
+        if self.shard_ids is None:
+            return "", ()
+        return f" AND (shard IS NULL OR shard IN ({','.join('?' * len(self.shard_ids))}))", tuple(self.shard_ids)
+
+    def _claim(self) -> Optional[Job]:
+        # atomically take the oldest job that is due, so two workers never run the same job
+        now = time.time()
+        shard_sql, shard_params = self._shard_filter()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(f"SELECT * FROM jobs WHERE state = ? AND run_at <= ?{shard_sql} ORDER BY run_at, id LIMIT 1", (QUEUED, now, *shard_params)).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, owner = ?, updated_at = ? WHERE id = ?", (RUNNING, self.owner, now, row[0]))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        job = self._row_to_job(row)
+        job.state = RUNNING
+        job.attempts += 1
+        job.owner = self.owner
+        return job
+
+    def _next_run_at(self) -> Optional[float]:
+        shard_sql, shard_params = self._shard_filter()
+        rows = self._execute(f"SELECT MIN(run_at) FROM jobs WHERE state = ?{shard_sql}", (QUEUED, *shard_params))
+        return rows[0][0]
+
+    async def _run_job(self, job: Job) -> None:
+        logger.info(f"Running {job.kind} job {job.id} (attempt {job.attempts})")
+        try:
+            await self._handlers[job.kind](await self.context(job))
+        except asyncio.CancelledError:
+            # the bot is shutting down, the job is resumed on the next start. Run directly, the closing loop may not wait for the thread
+            self._execute("UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?", (QUEUED, time.time(), job.id))
+            raise
+        except Exception as e:
+            logger.exception(f"{job.kind} job {job.id} failed: {e}")
+            if job.attempts >= self.max_attempts:
+                await self._run(self._execute, "UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE id = ?", (FAILED, str(e), time.time(), job.id))
+            else:
+                # retry with exponential backoff, from the last checkpoint
+                delay = self.retry_base_seconds * 2 ** (job.attempts - 1)
+                await self._run(self._execute, "UPDATE jobs SET state = ?, error = ?, run_at = ?, updated_at = ? WHERE id = ?", (QUEUED, str(e), time.time() + delay, time.time(), job.id))
+            return
+        await self._run(self._execute, "UPDATE jobs SET state = ?, error = NULL, updated_at = ? WHERE id = ?", (DONE, time.time(), job.id))
+        logger.info(f"{job.kind} job {job.id} done")
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._run(self._claim)
+            if job is not None:
+                await self._run_job(job)
+                continue
+            # sleep until a job is queued or a retry is due
+            self._wakeup.clear()
+            run_at = await self._run(self._next_run_at)
+            timeout = None if run_at is None else max(0.0, run_at - time.time())
+            if self.shard_ids is not None:
+                # the other shard processes can't wake this one up
+                timeout = JOBS_POLL_SECONDS if timeout is None else min(timeout, JOBS_POLL_SECONDS)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _resume_interrupted(self) -> None:
+        # only this process's jobs, the ones running in other shard processes are still running
+        resumed = self._execute("SELECT COUNT(*) FROM jobs WHERE state = ? AND (owner = ? OR owner IS NULL)", (RUNNING, self.owner))[0][0]
+        if resumed:
+            logger.info(f"Resuming {resumed} interrupted jobs")
+            # the interrupted attempt doesn't count towards the retries
+            self._execute("UPDATE jobs SET state = ?, attempts = MAX(attempts - 1, 0), run_at = ? WHERE state = ? AND (owner = ? OR owner IS NULL)", (QUEUED, time.time(), RUNNING, self.owner))
+
+    def start(self) -> None:
+        """Starts the workers, resuming the jobs that were running when the bot last stopped."""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        # queued in the queue's thread before the workers' first claims
+        self._executor.submit(self._resume_interrupted)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Stops the workers, the jobs they were running are queued again and resumed by the next start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+# Initialize the shared job queue instance
+jobs = JobQueue()
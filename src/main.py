@@ -1,11 +1,15 @@
+# imported first so the startup timings include the time spent importing everything else
+from src import startup
+
 import os
 import asyncio
+import datetime
+import functools
 import logging
 import openai
 import discord
 from discord import Message as DiscordMessage
-from typing import List, Tuple
-from langchain import OpenAI
+from typing import List, Optional, Tuple
 
 from src.base import (
     Message,
@@ -19,7 +23,13 @@ from src.constants import (
     MAX_THREAD_MESSAGES,
     SECONDS_DELAY_RECEIVING_MSG,
     OPENAI_API_KEY,
-    TARGET_CHANNEL_ID
+    TARGET_CHANNEL_ID,
+    INDEX_WATCH_SECONDS,
+    METRICS_PORT,
+    LOOP_STALL_THRESHOLD_MS,
+    WORKER_PROCESSES,
+    SHARD_COUNT,
+    SHARD_IDS,
 )
 from src.utils import (
     logger,
@@ -43,14 +53,15 @@ from src.moderation import (
     send_moderation_flagged_message
 )
 
-from src.search import (
-    generate_qa_completion_response,
-    process_qa_response,
-    OnboardPromptTemplate,
-    IntroDetector,
-    generate_onboard_completion_response,
-    process_onboard_response
-)
+# src.search imports pandas and langchain, it is imported in the background by startup.warm_up
+# and imported inside the /ask and /onboard commands once they are ready
+from src.registry import registry
+from src.outbound import send_queue, DELETE
+from src.channels import channels
+from src.jobs import jobs, JobContext
+from src.workers import worker_pool
+from src.metrics import traced, span, start_server as start_metrics_server
+from src.watchdog import watchdog
 
 # Set up logging
 # logging.basicConfig(level=logging.DEBUG)  # Set logging level to DEBUG
@@ -62,6 +73,7 @@ logger.setLevel(logging.INFO)
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 logger.addHandler(console_handler)
+startup.mark("imports")
 
 
 # Initialize the langchain OpenAI instance
@@ -72,17 +84,75 @@ intents = discord.Intents.default()
 intents.message_content = True
 
 # Instantiate a discord.Client object with the specified intents
-client = discord.Client(intents=intents)
+if SHARD_COUNT > 0:
+    # one process runs all the shards, or only SHARD_IDS while other processes run the rest
+    client = discord.AutoShardedClient(intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    client = discord.Client(intents=intents)
 
 
 # Instantiate a CommandTree object that will hold the bot's command hierarchy
 tree = discord.app_commands.CommandTree(client)
 
+# Background warm-up and document watcher, started in setup_hook
+warm_up_future: Optional[asyncio.Future] = None
+watch_documents_task: Optional[asyncio.Task] = None
+
+# Reload the index of every loaded documents folder whose files changed
+async def watch_documents():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(INDEX_WATCH_SECONDS)
+        if worker_pool.running:
+            # every worker checks and reloads its own indexes
+            try:
+                if any(await worker_pool.broadcast("reload_changed_docs")):
+                    worker_pool.generation += 1
+            except Exception as e:
+                logger.exception("Error while reloading documents: %s", e)
+            continue
+        if not registry.is_loaded("corpora"):
+            continue
+        corpora = registry.get("corpora")
+        try:
+            # the new index is built in a thread and swapped in once ready, /ask keeps answering meanwhile
+            for root in await loop.run_in_executor(None, corpora.changed_docs_dirs):
+                logger.info(f"Documents changed in {root}, reloading index")
+                await loop.run_in_executor(None, corpora.reload_docs_dir, root)
+        except Exception as e:
+            logger.exception("Error while reloading documents: %s", e)
+
+# Called once after login, before connecting to the gateway
+@client.event
+async def setup_hook():
+    global warm_up_future, watch_documents_task
+    if LOOP_STALL_THRESHOLD_MS > 0:
+        # started first, so stalls during startup are caught too
+        watchdog.start()
+    if WORKER_PROCESSES > 0:
+        # the heavy components are loaded by the worker processes instead
+        worker_pool.start()
+    else:
+        # warm up the heavy components in a thread while the gateway connects
+        warm_up_future = asyncio.get_running_loop().run_in_executor(None, startup.warm_up)
+    if INDEX_WATCH_SECONDS > 0:
+        watch_documents_task = asyncio.create_task(watch_documents())
+    # resume the background jobs the last run didn't finish
+    jobs.start()
+    if METRICS_PORT > 0:
+        try:
+            await start_metrics_server()
+        except OSError as e:
+            # e.g. another shard process already serves on this port
+            logger.error(f"Could not serve metrics on port {METRICS_PORT}: {e}")
+
 # Event triggered when the bot starts and logs in
 @client.event
 async def on_ready():
     # Log bot's username and invite URL
     logger.info(f"We have logged in as {client.user}. Invite URL: {BOT_INVITE_URL}")
+    if "gateway_ready" not in startup.phases:
+        startup.mark("gateway_ready")
     # Set the bot's name and initialize an empty list to store example conversations
     completion.MY_BOT_NAME = client.user.name
     completion.MY_BOT_EXAMPLE_CONVOS = []
@@ -98,6 +168,33 @@ async def on_ready():
         completion.MY_BOT_EXAMPLE_CONVOS.append(Conversation(messages=messages))
     # Sync the CommandTree with the bot's commands
     await tree.sync()
+    if "commands_synced" not in startup.phases:
+        startup.mark("commands_synced")
+
+# Drop channels the resolver fetched over REST when they change or are deleted
+@client.event
+async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    channels.invalidate(after.id)
+
+@client.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    channels.invalidate(channel.id)
+
+@client.event
+async def on_thread_update(before: discord.Thread, after: discord.Thread):
+    channels.invalidate(after.id)
+
+@client.event
+async def on_raw_thread_delete(payload: discord.RawThreadDeleteEvent):
+    channels.invalidate(payload.thread_id)
+
+@client.event
+async def on_shard_ready(shard_id: int):
+    logger.info(f"Shard {shard_id} is ready")
+
+@client.event
+async def on_shard_resumed(shard_id: int):
+    channels.invalidate_shard(shard_id)
 
 ## Chat w/ GPT-4 / GPT35turbp##
 @tree.command(name="chat", description="Create a new thread for conversation with GPT-4 (whatever is set in completions.py)")
@@ -106,6 +203,7 @@ async def on_ready():
 @discord.app_commands.checks.bot_has_permissions(send_messages=True)
 @discord.app_commands.checks.bot_has_permissions(view_channel=True)
 @discord.app_commands.checks.bot_has_permissions(manage_threads=True)
+@traced("chat")
 async def chat_command(int: discord.Interaction, message: str):
     try:
         # only support creating thread in text channel
@@ -121,7 +219,9 @@ async def chat_command(int: discord.Interaction, message: str):
         logger.info(f"Chat command by {user} {message[:20]}")
         try:
             # moderate the message
-            flagged_str, blocked_str = moderate_message(message=message, user=user)
+            with span("moderation"):
+                # the moderation call is a blocking request, it runs in a thread
+                flagged_str, blocked_str = await asyncio.get_running_loop().run_in_executor(None, functools.partial(moderate_message, message=message, user=user))
             await send_moderation_blocked_message(
                 guild=int.guild,
                 user=user,
@@ -151,8 +251,9 @@ async def chat_command(int: discord.Interaction, message: str):
                 embed.title = "⚠️ This prompt was flagged by moderation."
             
             # Send the embed as a response
-            await int.response.send_message(embed=embed)
-            response = await int.original_response()
+            with span("discord_send"):
+                await int.response.send_message(embed=embed)
+                response = await int.original_response()
 
             # Send a notification if the message was flagged by moderation
             await send_moderation_flagged_message(
@@ -170,33 +271,64 @@ async def chat_command(int: discord.Interaction, message: str):
             return
 
         # create the thread for the conversation
-        thread = await response.create_thread(
-            name=f"{ACTIVATE_THREAD_PREFX} {user.name[:20]} - {message[:30]}",
-            slowmode_delay=1,
-            reason="gpt-bot",
-            auto_archive_duration=60,
-        )
+        with span("create_thread"):
+            thread = await response.create_thread(
+                name=f"{ACTIVATE_THREAD_PREFX} {user.name[:20]} - {message[:30]}",
+                slowmode_delay=1,
+                reason="gpt-bot",
+                auto_archive_duration=60,
+            )
         # Show the bot is typing in the thread
         async with thread.typing():
             logger.debug("Generating response using GPT-4")
             # fetch completion
             messages = [Message(user=user.name, text=message)]
-            response_data = await generate_chat_completion_response(messages=messages, user=user)
+            with span("llm"):
+                response_data = await generate_chat_completion_response(messages=messages, user=user)
             logger.debug("Response generated by GPT-4")
             # send the result
-            await process_response(
-                user=user, thread=thread, response_data=response_data
-            )
+            with span("discord_send"):
+                await process_response(
+                    user=user, thread=thread, response_data=response_data
+                )
     except Exception as e:
         logger.exception(e)
         await int.edit_original_response(content="An error occurred while using GPT-3.5 Turbo/GPT-4: {}".format(e))
 
 ## ASK ##
 @tree.command(name="ask", description="Ask a question to the bot.")
-async def ask_command(int: discord.Interaction, question: str):
+@discord.app_commands.describe(
+    channel="Only search the chat history of this channel",
+    domain="Only search the pages crawled from this website, e.g. talentdao.substack.com",
+    since="Only search conversations from this date on (YYYY-MM-DD)",
+    until="Only search conversations before this date (YYYY-MM-DD)",
+)
+@traced("ask")
+async def ask_command(int: discord.Interaction, question: str, channel: Optional[str] = None, domain: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None):
+    # the document index may still be loading right after a restart
+    if not startup.is_ready("ask"):
+        await int.response.send_message(startup.not_ready_message(), ephemeral=True)
+        return
+    from src.search import generate_qa_completion_response, process_qa_response
+
+    # only the chunks matching the filters are searched
+    filters = {}
+    if channel:
+        filters["channel"] = channel.lstrip("#")
+    if domain:
+        filters["domain"] = domain
+    try:
+        for date in (since, until):
+            if date:
+                datetime.date.fromisoformat(date)
+    except ValueError:
+        await int.response.send_message("Dates should be written as YYYY-MM-DD, e.g. 2023-05-01", ephemeral=True)
+        return
+
     try:
         # Send an initial "thinking" response
-        await int.response.send_message("🤖 thinking...", ephemeral=False)
+        with span("discord_send"):
+            await int.response.send_message("🤖 thinking...", ephemeral=False)
 
         # Get the user who issued the ask command
         user = int.user
@@ -204,10 +336,11 @@ async def ask_command(int: discord.Interaction, question: str):
 
         # Fetch the QA response
         #response_data = await generate_qa_completion_response(question=question, user=user)
-        response_data = await generate_qa_completion_response(query=[Message(user=str(user), text=str(question))], user=user)
+        response_data = await generate_qa_completion_response(query=[Message(user=str(user), text=str(question))], user=user, guild_id=int.guild_id, filters=filters or None, since=since, until=until)
 
         # Process and send the response
-        await process_qa_response(user=user, interaction=int, question=question, response_data=response_data)
+        with span("discord_send"):
+            await process_qa_response(user=user, interaction=int, question=question, response_data=response_data)
        
     except openai.error.RateLimitError as rle:  # Import openai at the beginning of the file if not already done.
         logger.exception(rle)
@@ -224,88 +357,315 @@ async def ask_command(int: discord.Interaction, question: str):
             await int.followup.send(content=f"Failed to answer question. {str(e)}", ephemeral=True)
 
 ## ONBOARD ##
-@tree.command(name="onboard", description="Read intro messages from target channel and recommend projects to users")
-async def onboard_users_command(int: discord.Interaction, limit: int = 10):
-    # role permissions
-    allowed_roles = ["leo-admin"]  # Modify this list according to the roles you want to allow
-    if not has_any_role(int.user, allowed_roles):
-        await int.response.send_message(
-            f"{int.user.mention}, you don't have the required role to use this command.",
-            ephemeral=True,
-        )
-        return
-    
-    # Defer the response to prevent the interaction from expiring
-    await int.response.defer(ephemeral=True)
-
-    # Message logging
-    async def fetch_and_save_messages(client: discord.Client, limit=limit) -> List[Tuple[str, str, int]]:
-        
-        # Fetch the last 100 messages from the desired channel
-        channel = await client.fetch_channel(TARGET_CHANNEL_ID)
-        
+# Runs an onboarding job. A job interrupted by a restart or an error is resumed from the last message it processed
+@jobs.handler("onboard")
+@traced("onboard_job")
+async def run_onboard_job(job: JobContext):
+    # the intro detector and document index may still be loading when a job is resumed right after a restart
+    while not startup.is_ready("onboard"):
+        if startup.warm_up_error is not None:
+            raise RuntimeError(startup.not_ready_message())
+        await asyncio.sleep(1)
+    from src.search import generate_onboard_completion_response, process_onboard_response
+
+    target_channel = await channels.resolve(client, TARGET_CHANNEL_ID)
+    notify_channel_id = job.payload.get("notify_channel_id")
+    notify_channel = await channels.resolve(client, notify_channel_id) if notify_channel_id else None
+
+    # message objects from the history scan, a resumed job fetches the messages it still has to process
+    history = {}
+    if "messages" not in job.payload:
+        # Fetch the last `limit` messages from the desired channel
         messages = []
-        # Iterate through the channel history and add the messages to the list
-        async for message in channel.history(limit=limit):
-            messages.append((message.content, message.author.name, message.id))
+        with span("history_fetch"):
+            async for message in target_channel.history(limit=job.payload["limit"]):
+                messages.append((message.content, message.author.name, message.id))
+                history[message.id] = message
 
         # Save the messages to a file in the msg_log folder with the file name as the channel ID
         save_messages_to_file(messages, folder="msg_log", filename=f"{TARGET_CHANNEL_ID}")
-
-        return messages
-    
-    # Create intro detector object
-    intro_detector = IntroDetector()
+        # saved with the job, so a retry doesn't scan the history again
+        await job.update_payload(messages=messages)
+        await job.set_total(len(messages))
+    messages = job.payload["messages"]
 
     # Check if the bot has replied to the message
-    async def has_bot_replied(target_channel, original_message):
+    async def has_bot_replied(original_message):
         bot_replied = False
         # Fetch message history around the original_message
         async for message in target_channel.history(around=original_message, limit=15):
             # Check if the message is a reply and authored by the bot
-            if message.reference is not None and message.reference.message_id == original_message.id and message.author == int.guild.me:
+            if message.reference is not None and message.reference.message_id == original_message.id and message.author == client.user:
                 bot_replied = True
                 break
 
         return bot_replied
-    
-    try:
-        # Fetch the last `limit` messages
-        messages = await fetch_and_save_messages(client, limit=limit)
-        
-        target_channel = await client.fetch_channel(TARGET_CHANNEL_ID)
-    
-        for content, author_name, message_id in messages:
-            if intro_detector.is_intro(message=content):
-                # Get the message object using the message ID
-                original_message = await target_channel.fetch_message(message_id)
 
-                # Check if the bot has already replied to this message
-                if await has_bot_replied(target_channel, original_message):
-                    logger.info(f"Skipping message {message_id} as the bot has already replied")
-                    continue
+    pending = [(content, author_name, message_id) for content, author_name, message_id in messages if not job.is_done(message_id)]
+    contents = [content for content, _, _ in pending]
+    if worker_pool.running:
+        # a worker embeds the messages in one request and classifies them
+        with span("intro_classification"):
+            intro_flags = await worker_pool.submit("classify_intros", messages=contents)
+    else:
+        # Get the shared intro detector, it was built during warm-up
+        intro_detector = registry.get("intro_detector")
+        # embed the messages together with the other queries before classifying them
+        with span("embedding"):
+            await intro_detector.prefetch(contents)
+        # classify in a thread, the LLM calls would block the gateway
+        loop = asyncio.get_running_loop()
+        with span("intro_classification"):
+            intro_flags = await loop.run_in_executor(None, intro_detector.classify, contents)
+
+    for (content, author_name, message_id), is_intro in zip(pending, intro_flags):
+        if is_intro:
+            # Get the message object using the message ID
+            original_message = history.get(message_id) or await target_channel.fetch_message(message_id)
+
+            # Check if the bot has already replied to this message
+            with span("history_fetch"):
+                replied = await has_bot_replied(original_message)
+            if replied:
+                logger.info(f"Skipping message {message_id} as the bot has already replied")
+                await job.checkpoint(message_id)
+                continue
+
+            # Get the user object (author) from the message object
+            author = original_message.author
+
+            # Get recommended projects
+            recommended_projects = await generate_onboard_completion_response(intro=content, user=author_name, guild_id=job.payload["guild_id"])
+
+            # Process and send the response
+            with span("discord_send"):
+                await process_onboard_response(user=author, notify_channel=notify_channel, original_message=original_message, response_data=recommended_projects)
+        await job.checkpoint(message_id)
+    logger.info(f"Processed {len(messages)} recent messages for onboarding")
+
 
-                # Get the user object (author) from the message object
-                author = original_message.author
+@tree.command(name="onboard", description="Read intro messages from target channel and recommend projects to users")
+async def onboard_users_command(int: discord.Interaction, limit: int = 10):
+    # role permissions
+    allowed_roles = ["leo-admin"]  # Modify this list according to the roles you want to allow
+    if not has_any_role(int.user, allowed_roles):
+        await int.response.send_message(
+            f"{int.user.mention}, you don't have the required role to use this command.",
+            ephemeral=True,
+        )
+        return
 
-                # Get recommended projects
-                recommended_projects = await generate_onboard_completion_response(intro=content, user=author_name)
+    try:
+        # the messages are processed by a background job, which outlives this interaction and survives restarts
+        job_id = await jobs.enqueue("onboard", {
+            "limit": limit,
+            "guild_id": int.guild_id,
+            "notify_channel_id": int.channel_id,
+        }, guild_id=int.guild_id)
+        await int.response.send_message(f"Queued onboarding job #{job_id}, use /jobs to follow its progress.", ephemeral=True)
 
-                # Process and send the response
-                await process_onboard_response(user=author, interaction=int, message_id=message_id, response_data=recommended_projects)
-        
-        # Edit the original deferred response
-        await int.edit_original_response(content=f"Processed {len(messages)} recent messages for onboarding.")
-    
     # Catch any exceptions and log them
     except Exception as e:
         logger.exception("Error in onboard_users_command: %s", e)
-        await int.edit_original_response(content=f"Failed to process messages for onboarding. {str(e)}")
+        await int.response.send_message(f"Failed to queue messages for onboarding. {str(e)}", ephemeral=True)
+
+
+## JOBS ##
+@tree.command(name="jobs", description="Show the status of the recent background jobs, or of one job")
+async def jobs_command(int: discord.Interaction, job_id: Optional[int] = None):
+    # role permissions
+    allowed_roles = ["leo-admin"]
+    if not has_any_role(int.user, allowed_roles):
+        await int.response.send_message(
+            f"{int.user.mention}, you don't have the required role to use this command.",
+            ephemeral=True,
+        )
+        return
+
+    # only this server's jobs, their errors and progress are not shown to other servers
+    if job_id is not None:
+        job = await jobs.get(job_id, guild_id=int.guild_id)
+        recent = [job] if job else []
+    else:
+        recent = await jobs.recent(guild_id=int.guild_id)
+    if not recent:
+        await int.response.send_message("No jobs found.", ephemeral=True)
+        return
+
+    lines = []
+    for job in recent:
+        progress = f"{job.items_done}/{job.items_total}" if job.items_total is not None else "-"
+        line = f"#{job.id} {job.kind}: {job.state}, {progress} items, attempt {job.attempts}"
+        if job.error:
+            line += f" - {job.error[:200]}"
+        lines.append(line)
+    await int.response.send_message("\n".join(lines), ephemeral=True)
 
 
+## RELOAD ##
+@tree.command(name="reload", description="Reload the shared models and prompts, e.g. after editing the intro examples")
+async def reload_command(int: discord.Interaction, name: Optional[str] = None):
+    # role permissions
+    allowed_roles = ["leo-admin"]
+    if not has_any_role(int.user, allowed_roles):
+        await int.response.send_message(
+            f"{int.user.mention}, you don't have the required role to use this command.",
+            ephemeral=True,
+        )
+        return
+
+    await int.response.defer(ephemeral=True)
+    try:
+        if worker_pool.running:
+            # every worker rebuilds its own copy, report the slowest one
+            timings = {}
+            for worker_timings in await worker_pool.broadcast("reload", name=name):
+                for n, seconds in worker_timings.items():
+                    timings[n] = max(seconds, timings.get(n, 0.0))
+            worker_pool.generation += 1
+            # every worker warmed up, including ones whose warm-up had failed
+            worker_pool.mark_ready()
+        else:
+            # rebuild in a thread so the gateway keeps running while the models load
+            loop = asyncio.get_running_loop()
+            timings = await loop.run_in_executor(None, startup.reload, name)
+        lines = [f"{n}: {seconds:.2f}s" for n, seconds in timings.items()]
+        await int.edit_original_response(content="Reloaded:\n" + "\n".join(lines))
+    except Exception as e:
+        logger.exception("Error in reload_command: %s", e)
+        await int.edit_original_response(content=f"Failed to reload. {str(e)}")
+
+## REINDEX ##
+@tree.command(name="reindex", description="Reload this server's documents without restarting the bot")
+async def reindex_command(int: discord.Interaction):
+    # role permissions
+    allowed_roles = ["leo-admin"]
+    if not has_any_role(int.user, allowed_roles):
+        await int.response.send_message(
+            f"{int.user.mention}, you don't have the required role to use this command.",
+            ephemeral=True,
+        )
+        return
+    if not startup.is_ready("ask"):
+        await int.response.send_message(startup.not_ready_message(), ephemeral=True)
+        return
+
+    await int.response.defer(ephemeral=True)
+    try:
+        # /ask keeps answering from the current index until the new one is swapped in
+        if worker_pool.running:
+            chunks, root = (await worker_pool.broadcast("reindex", guild_id=int.guild_id))[0]
+            worker_pool.generation += 1
+        else:
+            loop = asyncio.get_running_loop()
+            retriever = await loop.run_in_executor(None, registry.get("corpora").reload, int.guild_id)
+            chunks, root = len(retriever.index), retriever.root
+        await int.edit_original_response(content=f"Reloaded {chunks} chunks from {os.path.basename(root)}.")
+    except Exception as e:
+        logger.exception("Error in reindex_command: %s", e)
+        await int.edit_original_response(content=f"Failed to reload documents. {str(e)}")
 
 
 #### THREAD HANDLING ####
+# Replies to a message in one of the bot's /chat threads
+@traced("thread_message")
+async def handle_thread_message(message: DiscordMessage, thread: discord.Thread):
+    # moderate the message
+    with span("moderation"):
+        # the moderation call is a blocking request, it runs in a thread
+        flagged_str, blocked_str = await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+            moderate_message, message=message.content, user=message.author
+        ))
+    await send_moderation_blocked_message(
+        guild=message.guild,
+        user=message.author,
+        blocked_str=blocked_str,
+        message=message.content,
+    )
+    # If the message is blocked by moderation, delete it and notify the thread
+    if len(blocked_str) > 0:
+        try:
+            await send_queue.call(thread, message.delete, kind=DELETE)
+            await send_queue.send(
+                thread,
+                embed=discord.Embed(
+                    description=f"❌ **{message.author}'s message has been deleted by moderation.**",
+                    color=discord.Color.red(),
+                )
+            )
+            return
+        except Exception as e:
+            await send_queue.send(
+                thread,
+                embed=discord.Embed(
+                    description=f"❌ **{message.author}'s message has been blocked by moderation but could not be deleted. Missing Manage Messages permission in this Channel.**",
+                    color=discord.Color.red(),
+                )
+            )
+            return
+    # Inform the thread if the message was flagged by moderation
+    await send_moderation_flagged_message(
+        guild=message.guild,
+        user=message.author,
+        flagged_str=flagged_str,
+        message=message.content,
+        url=message.jump_url,
+    )
+    if len(flagged_str) > 0:
+        await send_queue.send(
+            thread,
+            embed=discord.Embed(
+                description=f"⚠️ **{message.author}'s message has been flagged by moderation.**",
+                color=discord.Color.yellow(),
+            )
+        )
+
+    # wait a bit in case user has more messages
+    if SECONDS_DELAY_RECEIVING_MSG > 0:
+        with span("delay"):
+            await asyncio.sleep(SECONDS_DELAY_RECEIVING_MSG)
+        if is_last_message_stale(
+            interaction_message=message,
+            last_message=thread.last_message,
+            bot_id=client.user.id,
+        ):
+            # there is another message, so ignore this one
+            return
+
+    logger.info(
+        f"Thread message to process - {message.author}: {message.content[:50]} - {thread.name} {thread.jump_url}"
+    )
+    
+    # Fetch messages from the thread, apply relevant conversions, and reverse the order
+    with span("history_fetch"):
+        channel_messages = [
+            discord_message_to_message(message)
+            async for message in thread.history(limit=MAX_THREAD_MESSAGES)
+        ]
+    channel_messages = [x for x in channel_messages if x is not None]
+    channel_messages.reverse()
+
+    # generate the response
+    async with thread.typing():
+        with span("llm"):
+            response_data = await generate_chat_completion_response(
+                messages=channel_messages, user=message.author
+            )
+
+    if is_last_message_stale(
+        interaction_message=message,
+        last_message=thread.last_message,
+        bot_id=client.user.id,
+    ):
+        # there is another message and its not from us, so ignore this response
+        return
+
+    # send response
+    with span("discord_send"):
+        await process_response(
+            user=message.author, thread=thread, response_data=response_data
+        )
+
 # calls for each message
 # Event that triggers when a message is sent in a channel or thread
 @client.event
@@ -344,93 +704,10 @@ async def on_message(message: DiscordMessage):
             await close_thread(thread=thread)
             return
 
-        # moderate the message
-        flagged_str, blocked_str = moderate_message(
-            message=message.content, user=message.author
-        )
-        await send_moderation_blocked_message(
-            guild=message.guild,
-            user=message.author,
-            blocked_str=blocked_str,
-            message=message.content,
-        )
-        # If the message is blocked by moderation, delete it and notify the thread
-        if len(blocked_str) > 0:
-            try:
-                await message.delete()
-                await thread.send(
-                    embed=discord.Embed(
-                        description=f"❌ **{message.author}'s message has been deleted by moderation.**",
-                        color=discord.Color.red(),
-                    )
-                )
-                return
-            except Exception as e:
-                await thread.send(
-                    embed=discord.Embed(
-                        description=f"❌ **{message.author}'s message has been blocked by moderation but could not be deleted. Missing Manage Messages permission in this Channel.**",
-                        color=discord.Color.red(),
-                    )
-                )
-                return
-        # Inform the thread if the message was flagged by moderation
-        await send_moderation_flagged_message(
-            guild=message.guild,
-            user=message.author,
-            flagged_str=flagged_str,
-            message=message.content,
-            url=message.jump_url,
-        )
-        if len(flagged_str) > 0:
-            await thread.send(
-                embed=discord.Embed(
-                    description=f"⚠️ **{message.author}'s message has been flagged by moderation.**",
-                    color=discord.Color.yellow(),
-                )
-            )
-
-        # wait a bit in case user has more messages
-        if SECONDS_DELAY_RECEIVING_MSG > 0:
-            await asyncio.sleep(SECONDS_DELAY_RECEIVING_MSG)
-            if is_last_message_stale(
-                interaction_message=message,
-                last_message=thread.last_message,
-                bot_id=client.user.id,
-            ):
-                # there is another message, so ignore this one
-                return
-
-        logger.info(
-            f"Thread message to process - {message.author}: {message.content[:50]} - {thread.name} {thread.jump_url}"
-        )
-        
-        # Fetch messages from the thread, apply relevant conversions, and reverse the order
-        channel_messages = [
-            discord_message_to_message(message)
-            async for message in thread.history(limit=MAX_THREAD_MESSAGES)
-        ]
-        channel_messages = [x for x in channel_messages if x is not None]
-        channel_messages.reverse()
-
-        # generate the response
-        async with thread.typing():
-            response_data = await generate_chat_completion_response(
-                messages=channel_messages, user=message.author
-            )
-
-        if is_last_message_stale(
-            interaction_message=message,
-            last_message=thread.last_message,
-            bot_id=client.user.id,
-        ):
-            # there is another message and its not from us, so ignore this response
-            return
-
-        # send response
-        await process_response(
-            user=message.author, thread=thread, response_data=response_data
-        )
+        await handle_thread_message(message, thread)
     except Exception as e:
         logger.exception(e)
 
-client.run(DISCORD_BOT_TOKEN)
\ No newline at end of file
+# guarded, the worker processes import this module again when they start
+if __name__ == "__main__":
+    client.run(DISCORD_BOT_TOKEN)
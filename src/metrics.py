@@ -0,0 +1,240 @@
+# Description: This file contains the request tracing and the metrics served in the Prometheus format
+# Each command and thread message runs in a trace, and each stage of it (moderation, retrieval, LLM call, Discord send...)
+# in a span. Stage and request durations go to histograms, token counts and cache hits to counters, and requests slower
+# than SLOW_REQUEST_SECONDS are logged with the time spent in each stage. The metrics are served on
+# http://METRICS_HOST:METRICS_PORT/metrics for Prometheus, and the last slow requests on /slow.
+import json
+import time
+import logging
+import functools
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from src.constants import METRICS_HOST, METRICS_PORT, SLOW_REQUEST_SECONDS
+
+# logger
+logger = logging.getLogger("leo_logger")
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Number of slow requests kept for /slow
+SLOW_REQUESTS_KEPT = 50
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Sequence[Tuple[str, str]] = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    # label values escape backslashes, quotes and newlines
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_format_labels(labels)} {value}" for labels, value in sorted(self.values.items()))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> (count per bucket, sum, count)
+        self.values: Dict[Labels, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        counts, total, n = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key] = [counts, total + value, n + 1]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, n) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels(labels, [('le', str(bound))])} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels, [('le', '+Inf')])} {n}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {n}")
+        return lines
+
+
+class Metrics:
+    def __init__(self):
+        # spans also end in executor threads
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, object] = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        with self._lock:
+            return self._metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        with self._lock:
+            return self._metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def inc(self, name: str, help: str, amount: float = 1, **labels) -> None:
+        counter = self.counter(name, help)
+        with self._lock:
+            counter.inc(amount, **labels)
+
+    def observe(self, name: str, help: str, value: float, **labels) -> None:
+        histogram = self.histogram(name, help)
+        with self._lock:
+            histogram.observe(value, **labels)
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text format."""
+        with self._lock:
+            lines = [line for name in sorted(self._metrics) for line in self._metrics[name].render()]
+        return "\n".join(lines) + "\n"
+
+
+# Initialize the shared metrics instance
+metrics = Metrics()
+
+
+#### TRACING ####
+
+# Trace: one command or thread message, and the time spent in each of its stages
+@dataclass
+class Trace:
+    name: str
+    start: float = field(default_factory=time.perf_counter)
+    spans: List[Tuple[str, float]] = field(default_factory=list)
+    attributes: Dict[str, object] = field(default_factory=dict)
+
+    def summary(self, seconds: float) -> dict:
+        return {"request": self.name, "seconds": round(seconds, 3), "stages": [[stage, round(s, 3)] for stage, s in self.spans], **self.attributes}
+
+
+# The trace of the command or message being handled, inherited by the coroutines and tasks it starts
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("current_trace", default=None)
+# The last slow requests, most recent last
+slow_requests: Deque[dict] = deque(maxlen=SLOW_REQUESTS_KEPT)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace(name: str, **attributes) -> Iterator[Trace]:
+    """Traces a command or message, e.g. `with trace("ask", guild=guild_id):`."""
+    current = Trace(name, attributes=dict(attributes))
+    token = _current_trace.set(current)
+    status = "ok"
+    try:
+        yield current
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _current_trace.reset(token)
+        seconds = time.perf_counter() - current.start
+        metrics.observe("leo_request_seconds", "Time to handle a command or thread message", seconds, request=name, status=status)
+        if seconds >= SLOW_REQUEST_SECONDS:
+            summary = current.summary(seconds)
+            slow_requests.append(summary)
+            logger.warning(f"Slow request: {json.dumps(summary, default=str)}")
+
+
+def traced(name: str):
+    """Decorator running every call of a coroutine function (a command or event handler) in a trace."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with trace(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Times a stage of the current trace, e.g. `with span("retrieval"):`."""
+    current = _current_trace.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe("leo_stage_seconds", "Time spent in each stage of a request", seconds, request=current.name if current else "none", stage=stage)
+        if current is not None:
+            current.spans.append((stage, seconds))
+
+
+def set_attribute(name: str, value) -> None:
+    # recorded with the current trace, and logged with it if the request is slow
+    current = _current_trace.get()
+    if current is not None:
+        current.attributes[name] = value
+
+
+def record_tokens(kind: str, count: int, model: str) -> None:
+    """Counts the prompt or completion tokens of an LLM call."""
+    current = _current_trace.get()
+    metrics.inc("leo_llm_tokens_total", "Tokens sent to and generated by the LLMs", count, request=current.name if current else "none", kind=kind, model=model)
+    if current is not None:
+        current.attributes[f"{kind}_tokens"] = current.attributes.get(f"{kind}_tokens", 0) + count
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    """Counts a lookup in one of the caches, e.g. the channel cache or the shared /ask answers."""
+    metrics.inc("leo_cache_requests_total", "Cache lookups by cache and result", cache=cache, result="hit" if hit else "miss")
+    current = _current_trace.get()
+    if current is not None:
+        current.attributes[f"{cache}_cache"] = "hit" if hit else "miss"
+
+
+#### HTTP ENDPOINT ####
+
+async def start_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """Serves /metrics (Prometheus format), /slow (the last slow requests) and /stalls (the last event loop stalls, see
+        src/watchdog.py) as JSON. Returns the aiohttp runner.
+    """
+    from aiohttp import web
+    from src.watchdog import watchdog
+
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    async def handle_slow(request):
+        return web.json_response(list(slow_requests), dumps=lambda o: json.dumps(o, default=str))
+
+    async def handle_stalls(request):
+        return web.json_response(list(watchdog.reports))
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/slow", handle_slow)
+    app.router.add_get("/stalls", handle_stalls)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
@@ -7,6 +7,8 @@ import openai
 from typing import Optional, Tuple
 import discord
 from src.utils import logger
+from src.outbound import send_queue, Priority
+from src.channels import channels
 
 
 def moderate_message(
@@ -37,7 +39,7 @@ async def fetch_moderation_channel(
         return None
     moderation_channel = SERVER_TO_MODERATION_CHANNEL.get(guild.id, None)
     if moderation_channel:
-        channel = await guild.fetch_channel(moderation_channel)
+        channel = await channels.resolve(guild, moderation_channel)
         return channel
     return None
 
@@ -53,8 +55,10 @@ async def send_moderation_flagged_message(
         moderation_channel = await fetch_moderation_channel(guild=guild)
         if moderation_channel:
             message = message[:100] if message else None
-            await moderation_channel.send(
-                f"⚠️ {user} - {flagged_str} - {message} - {url}"
+            await send_queue.send(
+                moderation_channel,
+                f"⚠️ {user} - {flagged_str} - {message} - {url}",
+                priority=Priority.MODERATION,
             )
 
 
@@ -68,4 +72,4 @@ async def send_moderation_blocked_message(
         moderation_channel = await fetch_moderation_channel(guild=guild)
         if moderation_channel:
             message = message[:500] if message else None
-            await moderation_channel.send(f"❌ {user} - {blocked_str} - {message}")
+            await send_queue.send(moderation_channel, f"❌ {user} - {blocked_str} - {message}", priority=Priority.MODERATION)
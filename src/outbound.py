@@ -0,0 +1,247 @@
+# Description: This file contains the outbound queue every Discord send and edit made by the bot goes through
+# It keeps the bot under Discord's per-channel and global rate limits instead of running into 429s, sends chat
+# replies before onboarding and moderation-log traffic, and merges the adjacent parts of a long reply that fit in one message.
+import time
+import asyncio
+import logging
+import itertools
+import functools
+from enum import IntEnum
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import discord
+
+from src.constants import (
+    DISCORD_CHANNEL_SENDS_PER_5S,
+    DISCORD_CHANNEL_EDITS_PER_5S,
+    DISCORD_CHANNEL_DELETES_PER_5S,
+    DISCORD_GLOBAL_REQUESTS_PER_SECOND,
+    SHARD_IDS,
+)
+from src.shards import ShardMap
+from src.state import SharedTokenBucket, shared_state
+
+# logger
+logger = logging.getLogger(__name__)
+
+# Discord's limit on the length of a message
+MAX_MESSAGE_CHARS = 2000
+
+
+# Lower values are sent first
+class Priority(IntEnum):
+    CHAT = 0
+    ONBOARD = 1
+    MODERATION = 2
+
+
+# Kinds of channel requests, Discord rate limits each kind in a channel separately
+SEND = "send"
+EDIT = "edit"
+DELETE = "delete"
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Returns how many seconds until a token is available."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+
+# A queued Discord request, ordered by priority then arrival
+@dataclass(order=True)
+class OutboundRequest:
+    priority: int
+    seq: int
+    channel_id: int = field(compare=False)
+    call: Callable[[], Awaitable[Any]] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    kind: str = field(compare=False, default=SEND)
+    # set for the parts of a long message queued by send_parts, which can be merged with the other parts of the same message
+    channel: Optional[discord.abc.Messageable] = field(compare=False, default=None)
+    content: Optional[str] = field(compare=False, default=None)
+    group: Optional[int] = field(compare=False, default=None)
+
+
+class SendQueue:
+    def __init__(
+        self,
+        channel_sends_per_5s: int = DISCORD_CHANNEL_SENDS_PER_5S,
+        global_requests_per_second: int = DISCORD_GLOBAL_REQUESTS_PER_SECOND,
+        global_bucket: Optional[TokenBucket] = None,
+        channel_edits_per_5s: int = DISCORD_CHANNEL_EDITS_PER_5S,
+        channel_deletes_per_5s: int = DISCORD_CHANNEL_DELETES_PER_5S,
+    ):
+        self.channel_sends_per_5s = channel_sends_per_5s
+        # requests per 5 seconds in one channel, by kind of request
+        self.channel_limits_per_5s = {SEND: channel_sends_per_5s, EDIT: channel_edits_per_5s, DELETE: channel_deletes_per_5s}
+        # the global limit applies to the whole bot, so the shards' queues share this bucket
+        self._global = global_bucket or TokenBucket(global_requests_per_second, global_requests_per_second)
+        self._buckets: Dict[Tuple[int, str], TokenBucket] = {}
+        self._pending: List[OutboundRequest] = []
+        # channels with a request in flight, requests to a channel are sent one at a time and in order
+        self._busy: Set[int] = set()
+        self._seq = itertools.count()
+        self._groups = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        # number of messages saved by merging
+        self.merged = 0
+
+    async def send(self, channel: discord.abc.Messageable, content: Optional[str] = None, *, priority: Priority = Priority.CHAT, **kwargs) -> discord.Message:
+        """Queues channel.send(content, **kwargs) and returns the sent message."""
+        return await self._enqueue(self._request(channel.id, lambda: channel.send(content, **kwargs), priority))
+
+    async def send_parts(self, channel: discord.abc.Messageable, parts: List[str], *, priority: Priority = Priority.CHAT) -> List[discord.Message]:
+        """Queues the parts of a message too long for one Discord message, e.g. from split_into_shorter_messages.
+            Adjacent parts are sent as one message while they fit in it, parts sent together return the same message.
+            Returns:
+                the message each part was sent in
+        """
+        group = next(self._groups)
+        requests = [
+            self._request(channel.id, functools.partial(channel.send, part), priority, channel=channel, content=part, group=group)
+            for part in parts
+        ]
+        return list(await asyncio.gather(*(self._enqueue(request) for request in requests)))
+
+    async def call(self, channel: discord.abc.Snowflake, call: Callable[[], Awaitable[Any]], *, priority: Priority = Priority.CHAT, kind: str = SEND) -> Any:
+        """Queues any other request made in a channel and returns its result.
+            Args:
+                kind: SEND for replies, EDIT for message and channel edits, DELETE for deletes
+        """
+        return await self._enqueue(self._request(channel.id, call, priority, kind=kind))
+
+    def _request(self, channel_id: int, call: Callable[[], Awaitable[Any]], priority: Priority, **kwargs) -> OutboundRequest:
+        future = asyncio.get_running_loop().create_future()
+        return OutboundRequest(int(priority), next(self._seq), channel_id, call, future, **kwargs)
+
+    async def _enqueue(self, request: OutboundRequest) -> Any:
+        self._pending.append(request)
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+        self._wakeup.set()
+        return await request.future
+
+    def _bucket(self, channel_id: int, kind: str) -> TokenBucket:
+        if (channel_id, kind) not in self._buckets:
+            limit = self.channel_limits_per_5s[kind]
+            self._buckets[(channel_id, kind)] = TokenBucket(limit / 5, limit)
+        return self._buckets[(channel_id, kind)]
+
+    def _next_batch(self, now: float):
+        """Returns the best request that can be sent now, merged with the ones after it, or how long to wait."""
+        # only the oldest request of each idle channel can be sent
+        heads: Dict[int, OutboundRequest] = {}
+        for request in sorted(self._pending):
+            if request.channel_id not in self._busy and request.channel_id not in heads:
+                heads[request.channel_id] = request
+        if not heads:
+            return None, None
+        waits = {channel_id: self._bucket(channel_id, request.kind).wait_time(now) for channel_id, request in heads.items()}
+        ready = [heads[channel_id] for channel_id, wait in waits.items() if wait == 0]
+        global_wait = self._global.wait_time(now)
+        if not ready or global_wait > 0:
+            return None, max(global_wait, min(waits.values()))
+
+        first = min(ready)
+        batch = [first]
+        if first.group is not None:
+            # only the parts of the same message are merged, never the messages of different callers
+            length = len(first.content)
+            for request in sorted(r for r in self._pending if r.channel_id == first.channel_id and r is not first):
+                if request.group != first.group or length + 1 + len(request.content) > MAX_MESSAGE_CHARS:
+                    break
+                batch.append(request)
+                length += 1 + len(request.content)
+        return batch, None
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            batch, wait = self._next_batch(now)
+            if batch is None:
+                # wait for a new request, a channel to finish, or a bucket to refill
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for request in batch:
+                self._pending.remove(request)
+            self._bucket(batch[0].channel_id, batch[0].kind).take(now)
+            self._global.take(now)
+            self._busy.add(batch[0].channel_id)
+            asyncio.create_task(self._execute(batch))
+
+    async def _execute(self, batch: List[OutboundRequest]) -> None:
+        try:
+            if len(batch) > 1:
+                self.merged += len(batch) - 1
+                result = await batch[0].channel.send("\n".join(r.content for r in batch))
+            else:
+                result = await batch[0].call()
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_result(result)
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        finally:
+            self._busy.discard(batch[0].channel_id)
+            # forget idle channels whose bucket is full again
+            if len(self._buckets) > 1000:
+                now = time.monotonic()
+                for key in [k for k, b in self._buckets.items() if k[0] not in self._busy and b.wait_time(now) == 0 and b.tokens >= b.capacity]:
+                    del self._buckets[key]
+            self._wakeup.set()
+
+
+class ShardedSendQueue:
+    """One SendQueue per gateway shard, picked by the guild of the channel. Same API as SendQueue."""
+    def __init__(self, global_requests_per_second: int = DISCORD_GLOBAL_REQUESTS_PER_SECOND):
+        if SHARD_IDS is not None:
+            # other processes run the other shards, the global limit is counted in the shared state store
+            self.global_bucket = SharedTokenBucket(shared_state, "discord_global", global_requests_per_second, global_requests_per_second)
+        else:
+            self.global_bucket = TokenBucket(global_requests_per_second, global_requests_per_second)
+        self.shards: ShardMap[SendQueue] = ShardMap(lambda shard_id: SendQueue(global_bucket=self.global_bucket))
+
+    def _queue(self, channel) -> SendQueue:
+        guild = getattr(channel, "guild", None)
+        return self.shards.for_guild(guild.id if guild else None)
+
+    async def send(self, channel: discord.abc.Messageable, content: Optional[str] = None, *, priority: Priority = Priority.CHAT, **kwargs) -> discord.Message:
+        return await self._queue(channel).send(channel, content, priority=priority, **kwargs)
+
+    async def send_parts(self, channel: discord.abc.Messageable, parts: List[str], *, priority: Priority = Priority.CHAT) -> List[discord.Message]:
+        return await self._queue(channel).send_parts(channel, parts, priority=priority)
+
+    async def call(self, channel: discord.abc.Snowflake, call: Callable[[], Awaitable[Any]], *, priority: Priority = Priority.CHAT, kind: str = SEND) -> Any:
+        return await self._queue(channel).call(channel, call, priority=priority, kind=kind)
+
+    @property
+    def merged(self) -> int:
+        return sum(queue.merged for _, queue in self.shards.items())
+
+
+# Initialize the shared send queue instance
+send_queue = ShardedSendQueue()
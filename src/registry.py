@@ -0,0 +1,88 @@
+# Description: This file contains the process-wide registry for heavy objects (LLM clients, prompts, retrievers)
+# Each object is built once on first use and shared by every command, instead of being rebuilt per command.
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# logger
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._depends_on: Dict[str, List[str]] = {}
+        # objects left out when every object is reloaded, they are only reloaded by name
+        self._reload_by_name_only: List[str] = []
+        self._instances: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        # seconds it took to build each object the last time it was loaded
+        self.timings: Dict[str, float] = {}
+
+    def register(self, name: str, factory: Callable[[], Any], depends_on: Iterable[str] = (), reload_with_all: bool = True) -> None:
+        """Registers a factory for a shared object.
+            Args:
+                name: key used to fetch the object
+                factory: callable building the object, called on first use and on reload
+                depends_on: names of registered objects the factory uses, reloading one of them reloads this one too
+                reload_with_all: whether reloading every object reloads this one, otherwise it is only reloaded by name
+        """
+        self._factories[name] = factory
+        self._depends_on[name] = list(depends_on)
+        if not reload_with_all:
+            self._reload_by_name_only.append(name)
+        self._locks.setdefault(name, threading.Lock())
+
+    def _load(self, name: str) -> Any:
+        start = time.perf_counter()
+        instance = self._factories[name]()
+        self.timings[name] = time.perf_counter() - start
+        logger.info(f"Loaded {name} in {self.timings[name]:.2f}s")
+        return instance
+
+    def get(self, name: str) -> Any:
+        """Returns the shared object, building it if it hasn't been loaded yet."""
+        if name in self._instances:
+            return self._instances[name]
+        # only one thread builds a given object, the others wait for it
+        with self._locks[name]:
+            if name not in self._instances:
+                self._instances[name] = self._load(name)
+        return self._instances[name]
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._instances
+
+    def _dependents(self, name: str) -> List[str]:
+        dependents = []
+        for other, depends_on in self._depends_on.items():
+            if name in depends_on:
+                dependents.append(other)
+                dependents.extend(self._dependents(other))
+        return dependents
+
+    def reload(self, name: Optional[str] = None) -> Dict[str, float]:
+        """Rebuilds a shared object and everything depending on it, or every registered object if no name is given.
+            The old object keeps serving callers until its replacement is built.
+            Returns:
+                load timings of the reloaded objects
+            Raises:
+                ValueError: if no object is registered under the name
+        """
+        if name is None:
+            names = [n for n in self._factories if n not in self._reload_by_name_only]
+        elif name not in self._factories:
+            raise ValueError(f"Unknown component {name!r}, registered: {', '.join(self._factories)}")
+        else:
+            names = [name] + self._dependents(name)
+        # rebuild in registration order so dependencies are fresh before their dependents
+        names = [n for n in self._factories if n in names]
+        for n in names:
+            with self._locks[n]:
+                self._instances[n] = self._load(n)
+        return {n: self.timings[n] for n in names}
+
+
+# Initialize the shared registry instance
+registry = ModelRegistry()
@@ -5,24 +5,27 @@ import logging
 import pandas as pd
 import discord
 from typing import List, Dict, Any, Optional
+from collections import OrderedDict
 from enum import Enum
 from dataclasses import dataclass
-from langchain.llms import OpenAI
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.document_loaders import DirectoryLoader
-from langchain.vectorstores import Chroma
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.chains import RetrievalQA
-from langchain.schema import Document
-from langchain.indexes import VectorstoreIndexCreator
 from langchain import PromptTemplate, FewShotPromptTemplate
-from langchain.prompts.example_selector import LengthBasedExampleSelector
-from src.constants import OPENAI_API_KEY, TARGET_CHANNEL_ID, BOT_INSTRUCTIONS, BOT_NAME, EXAMPLE_CONVOS
+from langchain.prompts.example_selector.base import BaseExampleSelector
+import numpy as np
+from src.constants import OPENAI_API_KEY, BOT_INSTRUCTIONS, BOT_NAME, EXAMPLE_CONVOS
+from src.constants import INTRO_EXAMPLES_K, INTRO_EXAMPLES_MAX_TOKENS, INTRO_QUERY_CACHE_SIZE, EMBEDDING_BATCH_SIZE
+from src.embeddings import embed_texts_with_retries, cached_embed_texts, count_tokens, query_embeddings
 from src.moderation import moderate_message, send_moderation_flagged_message, send_moderation_blocked_message
 from src.utils import split_into_shorter_messages, close_thread, logger
 from src.base import BaseRetriever, Message, Prompt, Conversation
+from src.registry import registry
+from src.corpus import GuildCorpora
+from src.singleflight import SingleFlight
+from src.outbound import send_queue, Priority
+from src.workers import worker_pool
+from src.metrics import span, record_cache
 from src.moderation import send_moderation_flagged_message, send_moderation_blocked_message
 import functools
+import contextvars
 import concurrent.futures
 import asyncio
 from typing import List
@@ -58,27 +61,64 @@ class CompletionData:
 
 # Retriever class for searching embeddings db
 class CustomRetriever(BaseRetriever):
-    def search(self, query):
-        results = super().search(query)
+    def search(self, query, query_vector=None, filters=None, since=None, until=None, guild_id=None):
+        results = super().search(query, query_vector=query_vector, filters=filters, since=since, until=until, guild_id=guild_id)
         return results
 
-# Create an instance of CustomRetriever
-retriever = CustomRetriever()
+# Register the per-guild corpora, the default guild index is built during warm-up (see src/startup.py)
+# /reload leaves the loaded indexes alone unless asked by name, /reindex and the documents watcher rebuild them
+registry.register("corpora", lambda: GuildCorpora(CustomRetriever), reload_with_all=False)
+
+def search_guild_documents(query: str, guild_id: Optional[int], query_vector: Optional[np.ndarray] = None, filters: Optional[Dict[str, str]] = None, since: Optional[str] = None, until: Optional[str] = None) -> List[str]:
+    # blocking, the guild's index is loaded on first use
+    return registry.get("corpora").get(guild_id).search(query, query_vector=query_vector, filters=filters, since=since, until=until, guild_id=guild_id)
+
+# Concurrent identical questions against the same index share one retrieval and LLM call
+qa_flights = SingleFlight()
+
+def normalize_question(question: str) -> str:
+    # questions differing only by case, spacing or final punctuation get the same answer
+    return " ".join(question.lower().split()).rstrip("?!. ")
 
 #### QA SYSTEM ####
 async def generate_qa_completion_response(query: List[str]
-, user: str) -> CompletionData:
+, user: str, guild_id: Optional[int] = None, filters: Optional[Dict[str, str]] = None, since: Optional[str] = None, until: Optional[str] = None) -> CompletionData:
     inputs = ["{}: {}".format("Leo" if query.user == "Leo" else "user", query.text) for query in query]
     inputs_str = "\n".join(inputs)
 
     logger.debug("Deploying BaseRetriever to search for answer...")
 
-    loop = asyncio.get_event_loop()
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        response = await loop.run_in_executor(executor, functools.partial(
-            retriever.search,
-            query=inputs_str,
-        ))
+    async def search():
+        # the query is embedded together with the other requests arriving at the same time
+        with span("embedding"):
+            query_vector = await query_embeddings.embed(inputs_str)
+        if worker_pool.running:
+            # the worker process runs the retrieval and the LLM call
+            with span("retrieval_and_llm"):
+                return await worker_pool.submit("search_guild_documents", query=inputs_str, guild_id=guild_id, query_vector=query_vector, filters=filters, since=since, until=until)
+        loop = asyncio.get_event_loop()
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            # run in the request's context, so the retrieval and LLM spans are recorded in its trace
+            return await loop.run_in_executor(executor, functools.partial(
+                contextvars.copy_context().run,
+                search_guild_documents,
+                query=inputs_str,
+                guild_id=guild_id,
+                query_vector=query_vector,
+                filters=filters,
+                since=since,
+                until=until,
+            ))
+
+    # the index version is part of the key, so questions asked after a reload are answered from the new index
+    # (the worker processes own the indexes, their reloads bump the pool generation instead)
+    corpora = registry.get("corpora")
+    version = worker_pool.generation if worker_pool.running else corpora.version(guild_id)
+    # the guild and filters change which chunks are searched, so they are part of the key too
+    key = (corpora.docs_dir(guild_id), version, guild_id, tuple(sorted((filters or {}).items())), since, until, normalize_question(inputs_str))
+    # requests joining an identical request already running share its answer
+    record_cache("qa_answers", hit=qa_flights.in_flight(key))
+    response = await qa_flights.do(key, search)
     response_text = response[0]  # Get the first element from the 'response' list
     logger.debug("Received response from OpenAI API")
     response_data = CompletionData(
@@ -102,11 +142,13 @@ async def process_qa_response(user: str, interaction: discord.Interaction, quest
             await interaction.followup.send(content="No response generated.", ephemeral=True)
 
         if status is CompletionResult.MODERATION_FLAGGED:
-            await interaction.channel.send(
+            await send_queue.send(
+                interaction.channel,
                 f"⚠️ **This conversation has been flagged by moderation.**"
             )
     elif status is CompletionResult.MODERATION_BLOCKED:
-        await interaction.channel.send(
+        await send_queue.send(
+            interaction.channel,
             f"❌ **The response has been blocked by moderation.**"
         )
 
@@ -116,6 +158,62 @@ async def process_qa_response(user: str, interaction: discord.Interaction, quest
         )
 
 ## Onboarding Project Recommender System ##
+# Example selector that picks the intro examples most similar to the input message
+class SemanticExampleSelector(BaseExampleSelector):
+    def __init__(self, examples: List[dict], example_prompt: PromptTemplate, k: int = INTRO_EXAMPLES_K, max_tokens: int = INTRO_EXAMPLES_MAX_TOKENS):
+        self.examples = examples
+        self.example_prompt = example_prompt
+        self.k = k
+        self.max_tokens = max_tokens
+        # embed the examples once, the vectors are cached on disk between runs
+        self.vectors = cached_embed_texts([str(e["message"]) for e in examples], name="intro_examples")
+        self.example_tokens = [count_tokens(example_prompt.format(**e)) for e in examples]
+        # message embeddings fetched ahead of time by IntroDetector.prefetch, most recent last
+        self.query_vectors: "OrderedDict[str, np.ndarray]" = OrderedDict()
+
+    def add_query_vector(self, message: str, vector: np.ndarray) -> None:
+        self.query_vectors[message] = vector
+        self.query_vectors.move_to_end(message)
+        while len(self.query_vectors) > INTRO_QUERY_CACHE_SIZE:
+            self.query_vectors.popitem(last=False)
+
+    def has_query_vector(self, message: str) -> bool:
+        return message in self.query_vectors
+
+    def add_examples(self, examples: List[Dict[str, str]]) -> None:
+        # the new examples are embedded together, in one request
+        self.examples.extend(examples)
+        self.vectors = np.vstack([self.vectors, embed_texts_with_retries([str(e["message"]) for e in examples])])
+        self.example_tokens.extend(count_tokens(self.example_prompt.format(**e)) for e in examples)
+
+    def rank_examples(self, message: str) -> List[int]:
+        query_vector = self.query_vectors.get(message)
+        record_cache("intro_query_vectors", hit=query_vector is not None)
+        if query_vector is None:
+            # IntroDetector.classify and prefetch embed the messages in batches before they are classified, a message
+            # they couldn't embed (empty, or the embeddings API was down) keeps the csv order instead of being
+            # embedded here with a request of its own
+            if message.strip():
+                logger.warning("Intro message was not embedded ahead of classification, using the csv order")
+            return list(range(len(self.examples)))
+        # ada embeddings are unit length, so the dot product is the cosine similarity
+        scores = self.vectors @ query_vector
+        return list(np.argsort(-scores))
+
+    def select_examples(self, input_variables: Dict[str, str]) -> List[dict]:
+        message = " ".join(input_variables.values())
+        budget = self.max_tokens - count_tokens(message)
+        selected = []
+        for i in self.rank_examples(message):
+            if len(selected) >= self.k:
+                break
+            # skip examples that don't fit, a shorter one further down may still fit
+            if self.example_tokens[i] > budget:
+                continue
+            selected.append(self.examples[i])
+            budget -= self.example_tokens[i]
+        return selected
+
 # Template class for building prompts
 class OnboardPromptTemplate:
     # initialize
@@ -141,15 +239,15 @@ class OnboardPromptTemplate:
             template=example_formatter_template,
         )
 
-        # We'll use the `LengthBasedExampleSelector` to select the examples.
-        example_selector = LengthBasedExampleSelector(
+        # We'll use the `SemanticExampleSelector` to select the examples.
+        example_selector = SemanticExampleSelector(
             # These are the examples is has available to choose from.
             examples=examples_dict, 
             # This is the PromptTemplate being used to format the examples.
             example_prompt=example_prompt, 
-            # This is the maximum length that the formatted examples should be.
-            # Length is measured by the get_text_length function below.
-            max_length=300,
+            # The k most similar examples are kept while they fit in the token budget.
+            k=INTRO_EXAMPLES_K,
+            max_tokens=INTRO_EXAMPLES_MAX_TOKENS,
         )
         # We can now use the `example_selector` to create a `FewShotPromptTemplate`.
         dynamic_prompt = FewShotPromptTemplate(
@@ -164,17 +262,54 @@ class OnboardPromptTemplate:
         return dynamic_prompt
                      
                      
-# initalize an instance of the OnboardPromptTemplate class
-onboard_prompt_template_instance = OnboardPromptTemplate()
-                     
 class IntroDetector:
     def __init__(self):
-        self.model = OpenAI(openai_api_key=OPENAI_API_KEY)
-        onboard_prompt_template_instance = OnboardPromptTemplate()
+        # the llm and prompt template are shared with the rest of the bot through the registry
+        self.model = registry.get("llm")
+        onboard_prompt_template_instance = registry.get("onboard_prompt_template")
         self.examples = onboard_prompt_template_instance.load_examples()
         self.prompt = onboard_prompt_template_instance.get_dynamic_prompt(self.examples)
 
+    async def prefetch(self, messages: List[str]) -> None:
+        """Embeds the messages about to be classified, together with the other queries embedded at the same time."""
+        selector = self.prompt.example_selector
+        # the embeddings API rejects empty inputs
+        messages = [m for m in messages if m.strip()]
+        try:
+            vectors = await asyncio.gather(*(query_embeddings.embed(m) for m in messages))
+        except Exception as e:
+            # classify embeds them instead
+            logger.exception(e)
+            return
+        for message, vector in zip(messages, vectors):
+            selector.add_query_vector(message, vector)
+
+    def classify(self, messages: List[str]) -> List[bool]:
+        """Returns whether each message is an introduction. Blocking, run it in a thread.
+            The messages prefetch didn't embed are embedded together, EMBEDDING_BATCH_SIZE per request,
+            before they are classified.
+        """
+        selector = self.prompt.example_selector
+        flags = []
+        # a batch at a time, so the batch's vectors are still cached when its messages are classified
+        for start in range(0, len(messages), EMBEDDING_BATCH_SIZE):
+            batch = messages[start : start + EMBEDDING_BATCH_SIZE]
+            # the embeddings API rejects empty inputs
+            missing = list(dict.fromkeys(m for m in batch if m.strip() and not selector.has_query_vector(m)))
+            if missing:
+                try:
+                    for message, vector in zip(missing, embed_texts_with_retries(missing)):
+                        selector.add_query_vector(message, vector)
+                except Exception as e:
+                    # the examples are picked in the csv order instead
+                    logger.exception(e)
+            flags.extend(self._classify(message) for message in batch)
+        return flags
+
     def is_intro(self, message: str) -> bool:
+        return self.classify([message])[0]
+
+    def _classify(self, message: str) -> bool:
         prompt = self.prompt.format(input=message)
         response = self.model(prompt)
         classification_result = response.strip()
@@ -184,9 +319,14 @@ class IntroDetector:
         return f"What are one or two projects that might be interesting for a user with the following intro: {intro}? \nPlease exlpained in a helpful tone."
 
 
+# Register the onboarding objects, they are built once and reused by every /onboard run
+registry.register("onboard_prompt_template", OnboardPromptTemplate)
+registry.register("intro_detector", IntroDetector, depends_on=["llm", "onboard_prompt_template"])
+
+
 # build out functionality of onboard command   
 async def generate_onboard_completion_response(intro: List[str]
-, user: str) -> CompletionData:
+, user: str, guild_id: Optional[int] = None) -> CompletionData:
     # Process messages and ignore the ones from "leo-bot"
     inputs = [msg for msg in intro if not msg.startswith("leo-bot:")]
     inputs_str = "\n".join(inputs)
@@ -197,14 +337,25 @@ async def generate_onboard_completion_response(intro: List[str]
 
     logger.debug("Deploying OnboardBot to search for relevant projects...")
 
-    # run the event loop in a thread pool to prevent blocking from discord
-    loop = asyncio.get_event_loop()
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        # run the search in the thread pool with our query
-        response = await loop.run_in_executor(executor, functools.partial(
-            retriever.search,
-            query=query,
-        ))
+    # the query is embedded together with the other requests arriving at the same time
+    with span("embedding"):
+        query_vector = await query_embeddings.embed(query)
+
+    if worker_pool.running:
+        with span("retrieval_and_llm"):
+            response = await worker_pool.submit("search_guild_documents", query=query, guild_id=guild_id, query_vector=query_vector)
+    else:
+        # run the event loop in a thread pool to prevent blocking from discord
+        loop = asyncio.get_event_loop()
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            # run the search in the thread pool with our query, in the request's context so its spans are traced
+            response = await loop.run_in_executor(executor, functools.partial(
+                contextvars.copy_context().run,
+                search_guild_documents,
+                query=query,
+                guild_id=guild_id,
+                query_vector=query_vector,
+            ))
     response_text = response[0]  # Get the first element from the 'response' list
     logger.debug("Received response from OpenAI API")
     response_data = CompletionData(
@@ -216,32 +367,35 @@ async def generate_onboard_completion_response(intro: List[str]
 
 
 ### Process the response from discord handling
-async def process_onboard_response(user: str, interaction: discord.Interaction, message_id: int, response_data: CompletionData):
+async def process_onboard_response(user: discord.abc.User, notify_channel: Optional[discord.abc.Messageable], original_message: discord.Message, response_data: CompletionData):
     status = response_data.status
     reply_text = response_data.reply_text
     status_text = response_data.status_text
 
-    # Find the original message using the message ID
-    target_channel = await interaction.client.fetch_channel(TARGET_CHANNEL_ID)
-    original_message = await target_channel.fetch_message(message_id)
+    target_channel = original_message.channel
 
+    # runs in a background job after the /onboard interaction is gone, so problems are logged
+    # and moderation notices are posted to the channel /onboard was used in
     if status is CompletionResult.OK or status is CompletionResult.MODERATION_FLAGGED:
         if reply_text:
             formatted_reply_text = f"Hey {user.mention}!\n\n{reply_text}"
-            await original_message.reply(formatted_reply_text)
+            await send_queue.call(target_channel, lambda: original_message.reply(formatted_reply_text), priority=Priority.ONBOARD)
         else:
-            await interaction.followup.send(content="No response generated.", ephemeral=True)
+            logger.warning(f"No response generated for message {original_message.id}")
 
-        if status is CompletionResult.MODERATION_FLAGGED:
-            await interaction.channel.send(
-                f"⚠️ **This conversation has been flagged by moderation.**"
+        if status is CompletionResult.MODERATION_FLAGGED and notify_channel:
+            await send_queue.send(
+                notify_channel,
+                f"⚠️ **This conversation has been flagged by moderation.**",
+                priority=Priority.ONBOARD,
             )
     elif status is CompletionResult.MODERATION_BLOCKED:
-        await interaction.channel.send(
-            f"❌ **The response has been blocked by moderation.**"
-        )
+        if notify_channel:
+            await send_queue.send(
+                notify_channel,
+                f"❌ **The response has been blocked by moderation.**",
+                priority=Priority.ONBOARD,
+            )
 
     elif status is CompletionResult.TOO_LONG or status is CompletionResult.INVALID_REQUEST or status is CompletionResult.OTHER_ERROR:
-        await interaction.followup.send(
-            content=f"**Error** - {status_text}", ephemeral=True
-        )
\ No newline at end of file
+        logger.error(f"Failed to reply to message {original_message.id}: {status_text}")
\ No newline at end of file
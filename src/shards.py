@@ -0,0 +1,36 @@
+# Description: This file contains the helpers that partition the bot's in-memory state by gateway shard
+# Each guild belongs to exactly one shard, so state kept per shard (send queues, fetched channels) never has to be
+# shared between the processes running different shards.
+from typing import Callable, Dict, Generic, Iterator, Optional, TypeVar
+
+from src.constants import SHARD_COUNT
+
+T = TypeVar("T")
+
+
+def shard_for(guild_id: Optional[int], shard_count: int = SHARD_COUNT) -> int:
+    """Returns the shard a guild's events are received on, Discord's (guild_id >> 22) % shard_count.
+        Direct messages, which have no guild, are received on shard 0.
+    """
+    if not guild_id or shard_count <= 1:
+        return 0
+    return (int(guild_id) >> 22) % shard_count
+
+
+class ShardMap(Generic[T]):
+    """Lazily creates one object per shard with factory(shard_id)."""
+    def __init__(self, factory: Callable[[int], T], shard_count: int = SHARD_COUNT):
+        self.factory = factory
+        self.shard_count = shard_count
+        self._shards: Dict[int, T] = {}
+
+    def __getitem__(self, shard_id: int) -> T:
+        if shard_id not in self._shards:
+            self._shards[shard_id] = self.factory(shard_id)
+        return self._shards[shard_id]
+
+    def for_guild(self, guild_id: Optional[int]) -> T:
+        return self[shard_for(guild_id, self.shard_count)]
+
+    def items(self) -> Iterator:
+        return iter(self._shards.items())
@@ -0,0 +1,38 @@
+# Description: This file contains the single-flight helper that de-duplicates concurrent identical requests
+# When many users ask the same thing at once (e.g. right after an announcement), only the first request runs;
+# the others wait for it and get the same result.
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+# logger
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        # number of requests that were answered by another request's call
+        self.shared = 0
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Runs fn, unless a call with the same key is already running, in which case its result is returned.
+            Args:
+                key: identifies identical requests
+                fn: coroutine function computing the result
+            Returns:
+                the result of fn, shared by every request with the same key that arrived while it ran
+        """
+        task = self._calls.get(key)
+        if task is None:
+            # run the call in its own task, so a cancelled request doesn't cancel it for the others
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.shared += 1
+            logger.debug(f"Joining in-flight request {key}")
+        return await asyncio.shield(task)
@@ -0,0 +1,97 @@
+# Description: This file contains the startup bookkeeping for the bot: phase timings and background warm-up
+# Heavy modules (pandas, langchain) and components (document index, LLM clients, intro detector) are loaded here in a
+# background thread, so the Discord gateway can connect and sync commands before they are ready.
+import time
+import logging
+import importlib
+from typing import Dict, List, Optional
+
+from src.registry import registry
+
+# logger
+logger = logging.getLogger("leo_logger")
+
+# perf_counter value when the bot process started importing its modules
+STARTED_AT = time.perf_counter()
+
+# Components each command needs before it can answer, loaded in this order during warm-up
+COMMAND_COMPONENTS: Dict[str, List[str]] = {
+    "ask": ["llm", "corpora"],
+    "onboard": ["llm", "corpora", "intro_detector"],
+}
+
+WARMING_UP_MESSAGE = "🤖 I'm still warming up, please try again in a minute."
+
+# seconds since process start at which each startup phase finished
+phases: Dict[str, float] = {}
+# set when warm-up failed, so commands can report why they are unavailable
+warm_up_error: Optional[Exception] = None
+
+
+def mark(phase: str) -> float:
+    """Records the time since process start at which a startup phase finished and logs it."""
+    phases[phase] = time.perf_counter() - STARTED_AT
+    logger.info(f"Startup phase {phase} finished after {phases[phase]:.2f}s")
+    return phases[phase]
+
+
+def is_ready(command: str) -> bool:
+    # with worker processes the components are loaded in the workers, not in this process
+    from src.workers import worker_pool
+    if worker_pool.running:
+        return worker_pool.ready
+    names = COMMAND_COMPONENTS[command]
+    if not all(registry.is_loaded(name) for name in names):
+        return False
+    # the corpora are created empty, the commands wait until the default index has been loaded into them
+    return "corpora" not in names or "default_index" in phases
+
+
+def not_ready_message() -> str:
+    from src.workers import worker_pool
+    if worker_pool.error is not None:
+        return f"🤖 I failed to warm up, ask an admin to run /reload. {worker_pool.error}"
+    if warm_up_error is not None:
+        return f"🤖 I failed to warm up, ask an admin to run /reload. {str(warm_up_error)}"
+    return WARMING_UP_MESSAGE
+
+
+def warm_up() -> None:
+    """Imports the heavy modules and builds every component the commands need. Blocking, run it in a thread."""
+    global warm_up_error
+    warm_up_error = None
+    try:
+        # importing src.search pulls in pandas and langchain and registers the onboarding components
+        importlib.import_module("src.search")
+        mark("heavy_imports")
+        for command, names in COMMAND_COMPONENTS.items():
+            for name in names:
+                registry.get(name)
+            # guilds without their own documents share the default index, load it before the first /ask
+            if "corpora" in names and registry.get("corpora").version(None) is None:
+                registry.get("corpora").get(None)
+                mark("default_index")
+            mark(f"{command}_ready")
+        mark("warm_up")
+    except Exception as e:
+        warm_up_error = e
+        logger.exception("Warm-up failed: %s", e)
+
+
+def reload(name: Optional[str] = None) -> Dict[str, float]:
+    """Backs /reload: re-runs a failed warm-up, otherwise rebuilds the named component or every component
+        (see ModelRegistry.reload). Blocking, run it in a thread.
+        Returns:
+            load timings of the rebuilt components
+    """
+    if warm_up_error is not None:
+        # e.g. the heavy imports failed, then the onboarding components were never registered
+        warm_up()
+        if warm_up_error is not None:
+            raise warm_up_error
+        return dict(registry.timings)
+    timings = registry.reload(name)
+    if "corpora" in timings:
+        # the new corpora are empty, load the default index again before answering
+        registry.get("corpora").get(None)
+    return timings
@@ -0,0 +1,136 @@
+# Description: This file contains the local state store shared by the bot processes running different shards
+# It is a small SQLite database, so processes on the same machine agree on limits that apply to the whole bot,
+# like Discord's global rate limit, without running another service.
+import os
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+import concurrent.futures
+from typing import Optional, Tuple
+
+from src.constants import SHARED_STATE_PATH
+
+# logger
+logger = logging.getLogger(__name__)
+
+# Each process reserves this many seconds worth of the shared tokens at a time
+RESERVE_SECONDS = 0.1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS token_buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class SharedState:
+    def __init__(self, path: str = SHARED_STATE_PATH):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        # the database calls block on the other processes' transactions, they run in this thread instead of the
+        # event loop (and not in the default executor, which moderation and the workers can keep busy)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            # wait for the other processes' transactions instead of failing with "database is locked"
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def reserve_tokens(self, name: str, rate: float, capacity: float, want: float) -> Tuple[float, float]:
+        """Refills a token bucket shared by every process and takes up to want whole tokens from it.
+            Blocks on the other processes' transactions, so call it from an executor, not the event loop.
+            Args:
+                name: identifies the bucket
+                rate: tokens added per second
+                capacity: maximum number of tokens
+                want: tokens to take
+            Returns:
+                the tokens taken, and the seconds until a token is available if none were
+        """
+        with self._lock:
+            conn = self._connect()
+            # read the level first, the write lock is only taken when there are tokens to take
+            row = conn.execute("SELECT tokens, updated_at FROM token_buckets WHERE name = ?", (name,)).fetchone()
+            if row is not None:
+                level = self._refilled(row, rate, capacity)
+                if level < 1:
+                    return 0.0, (1 - level) / rate
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT tokens, updated_at FROM token_buckets WHERE name = ?", (name,)).fetchone()
+                # wall clock time, monotonic clocks are not comparable between processes
+                now = time.time()
+                tokens = capacity if row is None else self._refilled(row, rate, capacity, now)
+                taken = float(max(0, min(int(want), int(tokens))))
+                conn.execute("INSERT OR REPLACE INTO token_buckets (name, tokens, updated_at) VALUES (?, ?, ?)", (name, tokens - taken, now))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return taken, 0.0 if taken else (1 - tokens) / rate
+
+    @staticmethod
+    def _refilled(row: Tuple[float, float], rate: float, capacity: float, now: Optional[float] = None) -> float:
+        tokens, updated_at = row
+        return min(capacity, tokens + max(0.0, (now or time.time()) - updated_at) * rate)
+
+
+class SharedTokenBucket:
+    """Same interface as src.outbound.TokenBucket, with the tokens kept in the shared state store.
+        The send loop never touches the database: tokens are reserved from the shared bucket a batch at a time, in
+        the state store's own thread, and spent from a local count.
+    """
+    def __init__(self, state: SharedState, name: str, rate: float, capacity: float):
+        self.state = state
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        # tokens reserved from the shared bucket and not spent yet
+        self.tokens = 0.0
+        self._batch = max(1.0, rate * RESERVE_SECONDS)
+        # seconds until the shared bucket has a token, from the last reservation that got none
+        self._retry_after = 0.0
+        self._reserving: Optional[asyncio.Future] = None
+
+    def _reserve(self) -> None:
+        if self._reserving is None or self._reserving.done():
+            self._reserving = asyncio.ensure_future(self._reserve_batch())
+
+    async def _reserve_batch(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            taken, self._retry_after = await loop.run_in_executor(
+                self.state.executor, self.state.reserve_tokens, self.name, self.rate, self.capacity, self._batch
+            )
+            self.tokens += taken
+        except sqlite3.Error as e:
+            # keep sending at the local rate rather than stopping if the state store is unavailable
+            logger.warning(f"Could not reserve {self.name} tokens from the shared state store: {e}")
+            self.tokens += 1
+            self._retry_after = 1 / self.rate
+
+    def wait_time(self, now: float) -> float:
+        if self.tokens >= 1:
+            return 0.0
+        self._reserve()
+        # check again once the reservation is back, or when the shared bucket should have refilled
+        return max(self._retry_after, 1 / self.rate)
+
+    def take(self, now: float) -> None:
+        self.tokens -= 1
+        if self.tokens < 1:
+            # reserve the next batch before it is needed
+            self._reserve()
+
+
+# Initialize the shared state store instance
+shared_state = SharedState()
@@ -11,6 +11,7 @@ from typing import Optional, List, Tuple
 import discord
 
 from src.constants import MAX_CHARS_PER_REPLY_MSG, INACTIVATE_THREAD_PREFIX
+from src.outbound import send_queue, EDIT
 
 
 
@@ -57,14 +58,15 @@ def is_last_message_stale(
 
 
 async def close_thread(thread: discord.Thread):
-    await thread.edit(name=INACTIVATE_THREAD_PREFIX)
-    await thread.send(
+    await send_queue.call(thread, lambda: thread.edit(name=INACTIVATE_THREAD_PREFIX), kind=EDIT)
+    await send_queue.send(
+        thread,
         embed=discord.Embed(
             description="**Thread closed** - Context limit reached, closing...",
             color=discord.Color.blue(),
         )
     )
-    await thread.edit(archived=True, locked=True)
+    await send_queue.call(thread, lambda: thread.edit(archived=True, locked=True), kind=EDIT)
 
 
 def should_block(guild: Optional[discord.Guild]) -> bool:
@@ -0,0 +1,108 @@
+# Description: This file contains the watchdog that detects and attributes event loop stalls
+# A heartbeat coroutine wakes up every few milliseconds and records how late it woke up (the loop lag). A thread watches
+# the heartbeat: when it is late by more than LOOP_STALL_THRESHOLD_MS, something is blocking the loop, so the thread
+# captures the loop thread's stack while it is still blocked. Once the loop is back, the stall is logged with that stack
+# and counted per call site (the innermost function of the bot in the stack, e.g. src.moderation.moderate_message).
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import deque
+from typing import Deque, List, Optional
+
+from src.constants import LOOP_STALL_THRESHOLD_MS
+from src.metrics import metrics
+
+# logger
+logger = logging.getLogger("leo_logger")
+
+# get the parent directory of the current file
+LEO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+# Number of stall reports kept for the /stalls endpoint
+STALL_REPORTS_KEPT = 50
+
+
+def call_site(stack: List[traceback.FrameSummary]) -> str:
+    """Names the innermost function of the bot in a stack, e.g. src.moderation.moderate_message.
+        Library frames (discord, openai, pandas...) are skipped, so a stall is blamed on the bot's code that made the call.
+    """
+    for frame in reversed(stack):
+        path = os.path.realpath(frame.filename)
+        if path.startswith(LEO_DIR + os.sep) and "site-packages" not in path and path != os.path.realpath(__file__):
+            module = os.path.splitext(os.path.relpath(path, LEO_DIR))[0].replace(os.sep, ".")
+            return f"{module}.{frame.name}"
+    # no frame of the bot, e.g. a library callback
+    return f"{os.path.basename(stack[-1].filename)}:{stack[-1].name}" if stack else "unknown"
+
+
+class LoopWatchdog:
+    def __init__(self, threshold_ms: float = LOOP_STALL_THRESHOLD_MS):
+        self.threshold = threshold_ms / 1000
+        # the heartbeat is checked a few times per threshold, so stalls are caught while they are happening
+        self.interval = self.threshold / 4
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._last_beat = time.monotonic()
+        self._lock = threading.Lock()
+        # (call site, stack) of the stall in progress, captured by the watching thread
+        self._captured: Optional[tuple] = None
+        self._stopped = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.reports: Deque[dict] = deque(maxlen=STALL_REPORTS_KEPT)
+
+    def start(self) -> None:
+        """Starts watching the running event loop. Must be called from the loop."""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        logger.info(f"Watching the event loop for stalls over {self.threshold * 1000:.0f}ms")
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _heartbeat(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            with self._lock:
+                self._last_beat = time.monotonic()
+                captured, self._captured = self._captured, None
+            metrics.observe("leo_event_loop_lag_seconds", "How late the event loop ran a callback scheduled on time", lag)
+            if captured is not None and lag >= self.threshold:
+                self._report(lag, *captured)
+
+    def _watch(self) -> None:
+        # runs in its own thread, so it keeps running while the loop is blocked
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                late = time.monotonic() - self._last_beat - self.interval
+                if late < self.threshold or self._captured is not None:
+                    continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            with self._lock:
+                # the loop may have caught up while the stack was extracted
+                if time.monotonic() - self._last_beat - self.interval >= self.threshold:
+                    self._captured = (call_site(stack), stack)
+
+    def _report(self, seconds: float, site: str, stack: List[traceback.FrameSummary]) -> None:
+        metrics.inc("leo_event_loop_stalls_total", "Event loop stalls longer than LOOP_STALL_THRESHOLD_MS, by the call site that blocked", call_site=site)
+        metrics.observe("leo_event_loop_stall_seconds", "Duration of the event loop stalls, by the call site that blocked", seconds, call_site=site)
+        formatted = "".join(traceback.format_list(stack))
+        self.reports.append({"call_site": site, "seconds": round(seconds, 3), "time": time.time(), "stack": formatted})
+        logger.warning(f"Event loop blocked for {seconds * 1000:.0f}ms in {site}\n{formatted}")
+
+
+# Initialize the shared watchdog instance
+watchdog = LoopWatchdog()
@@ -0,0 +1,269 @@
+# Description: This file contains the optional worker process pool the bot can run its heavy work in
+# With WORKER_PROCESSES > 0 the main process only runs the Discord gateway and dispatches the document search,
+# intro classification and chat completions over multiprocessing queues to worker processes, which each own
+# their own LLM clients, intro detector and document indexes. CPU work then scales across cores and a slow request
+# can't delay the gateway heartbeats.
+import time
+import queue
+import asyncio
+import logging
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from src.constants import WORKER_PROCESSES, WORKER_THREADS
+
+# logger
+logger = logging.getLogger("leo_logger")
+
+# Messages sent back by the workers: (request id, kind, value)
+READY = "ready"
+RESULT = "result"
+ERROR = "error"
+
+
+#### TASKS, run in the worker processes ####
+
+def _search_guild_documents(query: str, guild_id: Optional[int], query_vector=None, filters=None, since=None, until=None) -> List[str]:
+    from src.search import search_guild_documents
+    return search_guild_documents(query=query, guild_id=guild_id, query_vector=query_vector, filters=filters, since=since, until=until)
+
+
+def _classify_intros(messages: List[str]) -> List[bool]:
+    from src.registry import registry
+    # the messages are embedded in batches before they are classified
+    return registry.get("intro_detector").classify(messages)
+
+
+def _chat_completion(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo") -> Dict[str, Any]:
+    import openai
+    # the reply is sent back once it is complete, with the token usage the API returns
+    response = openai.ChatCompletion.create(model=model, messages=messages)
+    return {"content": response["choices"][0]["message"]["content"], "model": response["model"], "usage": dict(response["usage"])}
+
+
+def _reload(name: Optional[str] = None) -> Dict[str, float]:
+    from src import startup
+    return startup.reload(name)
+
+
+def _reindex(guild_id: Optional[int]) -> tuple:
+    from src.registry import registry
+    retriever = registry.get("corpora").reload(guild_id)
+    return len(retriever.index), retriever.root
+
+
+def _reload_changed_docs() -> List[str]:
+    from src.registry import registry
+    if not registry.is_loaded("corpora"):
+        return []
+    corpora = registry.get("corpora")
+    roots = corpora.changed_docs_dirs()
+    for root in roots:
+        corpora.reload_docs_dir(root)
+    return roots
+
+
+# Tasks the gateway can request, by name
+TASKS: Dict[str, Callable] = {
+    "search_guild_documents": _search_guild_documents,
+    "classify_intros": _classify_intros,
+    "chat_completion": _chat_completion,
+    "reload": _reload,
+    "reindex": _reindex,
+    "reload_changed_docs": _reload_changed_docs,
+}
+
+
+def _run_task(results: multiprocessing.Queue, request_id: int, task: str, kwargs: Dict[str, Any]) -> None:
+    try:
+        results.put((request_id, RESULT, TASKS[task](**kwargs)))
+    except Exception as e:
+        logging.getLogger("leo_logger").exception(f"Task {task} failed: {e}")
+        results.put((request_id, ERROR, f"{type(e).__name__}: {e}"))
+
+
+def _worker_main(index: int, requests: multiprocessing.Queue, results: multiprocessing.Queue, threads: int) -> None:
+    """Entry point of a worker process: warms up, then runs the requests it receives until it gets None."""
+    logging.basicConfig(level=logging.INFO, format=f"[worker {index}] %(message)s")
+    from src import startup
+    startup.warm_up()
+    error = str(startup.warm_up_error) if startup.warm_up_error is not None else None
+    results.put((None, READY, (index, error)))
+
+    # the LLM and embeddings calls mostly wait on the network, so each worker runs a few requests at once
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            message = requests.get()
+            if message is None:
+                break
+            executor.submit(_run_task, results, *message)
+
+
+#### POOL, used in the gateway process ####
+
+class WorkerPool:
+    def __init__(self, processes: int = WORKER_PROCESSES, threads: int = WORKER_THREADS):
+        self.processes = processes
+        self.threads = threads
+        # spawn instead of fork, the children must not inherit the gateway's event loop and sockets
+        self._context = multiprocessing.get_context("spawn")
+        self._results = None
+        self._workers: List[Optional[multiprocessing.Process]] = []
+        self._queues: List[multiprocessing.Queue] = []
+        self._ready: List[bool] = []
+        # request id -> (worker index, asyncio queue the responses are put in)
+        self._pending: Dict[int, tuple] = {}
+        self._ids = itertools.count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reader: Optional[threading.Thread] = None
+        self._closing = False
+        # whether the workers after the first one were started
+        self._started_all = False
+        # bumped whenever the workers reload their documents, part of the /ask single-flight key
+        self.generation = 0
+        # set when a worker failed to warm up
+        self.error: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    @property
+    def ready(self) -> bool:
+        return any(self._ready)
+
+    def start(self) -> None:
+        """Starts the worker processes. Call it from the event loop the results are delivered to."""
+        if self.running:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._results = self._context.Queue()
+        for index in range(self.processes):
+            self._workers.append(None)
+            self._queues.append(self._context.Queue())
+            self._ready.append(False)
+        # the first worker embeds the documents missing from the embeddings cache, the others are started once
+        # it has warmed up and load its cached vectors instead of each embedding every document again
+        self._spawn(0)
+        self._reader = threading.Thread(target=self._read_results, name="worker-results", daemon=True)
+        self._reader.start()
+        logger.info(f"Started {self.processes} worker processes")
+
+    def _spawn(self, index: int) -> None:
+        self._ready[index] = False
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self._queues[index], self._results, self.threads),
+            name=f"leo-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self._workers[index] = process
+
+    def _read_results(self) -> None:
+        # runs in a thread, hands every response over to the event loop
+        checked = time.monotonic()
+        while not self._closing:
+            try:
+                request_id, kind, value = self._results.get(timeout=1)
+                self._loop.call_soon_threadsafe(self._deliver, request_id, kind, value)
+            except queue.Empty:
+                pass
+            if time.monotonic() - checked >= 1:
+                checked = time.monotonic()
+                self._check_workers()
+
+    def _check_workers(self) -> None:
+        for index, process in enumerate(self._workers):
+            if process is not None and not process.is_alive() and not self._closing:
+                logger.error(f"Worker {index} exited with code {process.exitcode}, restarting it")
+                self._workers[index] = None
+                self._loop.call_soon_threadsafe(self._restart, index)
+
+    def _restart(self, index: int) -> None:
+        # fail the requests the worker was running, their callers get an error instead of waiting forever
+        for request_id, (worker, _) in list(self._pending.items()):
+            if worker == index:
+                self._deliver(request_id, ERROR, f"worker {index} exited")
+        self._queues[index] = self._context.Queue()
+        self._spawn(index)
+        # the first worker died before it was ready, the others embed the documents themselves rather than wait for it
+        self._start_others()
+
+    def _deliver(self, request_id: Optional[int], kind: str, value: Any) -> None:
+        if kind == READY:
+            index, error = value
+            self._start_others()
+            if error is None:
+                self._ready[index] = True
+                logger.info(f"Worker {index} is ready")
+            else:
+                self.error = error
+                logger.error(f"Worker {index} failed to warm up: {error}")
+            return
+        pending = self._pending.get(request_id)
+        if pending is None:
+            return
+        del self._pending[request_id]
+        pending[1].put_nowait((kind, value))
+
+    def _start_others(self) -> None:
+        if self._started_all or self._closing:
+            return
+        # requests already sent to the workers not started yet wait in their queues
+        self._started_all = True
+        for other in range(1, len(self._workers)):
+            self._spawn(other)
+
+    def mark_ready(self) -> None:
+        """Marks every worker ready, after a /reload re-ran their failed warm-up."""
+        self._ready = [True] * len(self._workers)
+        self.error = None
+
+    def _pick_worker(self) -> int:
+        # the ready worker with the fewest requests in flight
+        load = [0] * len(self._workers)
+        for worker, _ in self._pending.values():
+            load[worker] += 1
+        candidates = [i for i in range(len(self._workers)) if self._ready[i]] or list(range(len(self._workers)))
+        return min(candidates, key=lambda i: load[i])
+
+    def _send(self, index: int, task: str, kwargs: Dict[str, Any]) -> asyncio.Queue:
+        request_id = next(self._ids)
+        responses: asyncio.Queue = asyncio.Queue()
+        self._pending[request_id] = (index, responses)
+        self._queues[index].put((request_id, task, kwargs))
+        return responses
+
+    @staticmethod
+    async def _result(responses: asyncio.Queue) -> Any:
+        kind, value = await responses.get()
+        if kind == ERROR:
+            raise RuntimeError(value)
+        return value
+
+    async def submit(self, task: str, **kwargs) -> Any:
+        """Runs a task in the least busy worker and returns its result."""
+        return await self._result(self._send(self._pick_worker(), task, kwargs))
+
+    async def broadcast(self, task: str, **kwargs) -> List[Any]:
+        """Runs a task in every worker, e.g. a reload, and returns their results."""
+        started = time.perf_counter()
+        results = await asyncio.gather(*(self._result(self._send(i, task, kwargs)) for i in range(len(self._workers))))
+        logger.debug(f"Broadcast {task} took {time.perf_counter() - started:.2f}s")
+        return results
+
+    def close(self) -> None:
+        self._closing = True
+        for requests in self._queues:
+            requests.put(None)
+        for process in self._workers:
+            if process is not None:
+                process.join(timeout=5)
+
+
+# Initialize the shared worker pool instance, only started when WORKER_PROCESSES > 0
+worker_pool = WorkerPool()
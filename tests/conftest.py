@@ -0,0 +1,5 @@
+# src/constants.py reads the bot's settings from the environment when imported, the tests don't use them
+import os
+
+for name, value in [("DISCORD_BOT_TOKEN", "test"), ("DISCORD_CLIENT_ID", "0"), ("OPENAI_API_KEY", "sk-test"), ("ALLOWED_SERVER_IDS", "1"), ("TARGET_CHANNEL_ID", "2"), ("SERVER_TO_MODERATION_CHANNEL", "1:3")]:
+    os.environ.setdefault(name, value)
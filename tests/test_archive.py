@@ -0,0 +1,81 @@
+# tests of the incremental export of src/archive.py, from a temporary SQLite table of messages
+# usage: python -m pytest tests/
+import os
+import json
+import sqlite3
+
+import pytest
+
+from src.archive import ARCHIVE_COLUMNS, WATERMARK_FILE, SQLiteSource, CSVSource, export, archive_files, read_pages
+
+MESSAGES = [
+    ("alice", "gm", "", "general", "2023-06-01T09:00:00+00:00"),
+    ("bob", "hello everyone", "", "general", "2023-06-01T09:05:00+00:00"),
+    ("carol", "new proposal is up", "", "governance", "2023-06-02T10:00:00+00:00"),
+]
+# a message sent at the same second as the last exported one but stored after the export ran, and a newer one
+LATE_MESSAGES = [
+    ("dave", "voted yes", "", "governance", "2023-06-02T10:00:00+00:00"),
+    ("erin", "when is the call?", "", "general", "2023-06-03T08:30:00+00:00"),
+]
+
+
+def insert(path: str, rows) -> None:
+    with sqlite3.connect(path) as conn:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS messages ({', '.join(ARCHIVE_COLUMNS)})")
+        conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?)", rows)
+
+
+def exported(out: str) -> list:
+    # (username, content) of every exported message, in the order they were written
+    return [(u, c) for path in archive_files(out) for page in read_pages(path) for u, c in zip(page["username"], page["message_content"])]
+
+
+def watermark(out: str) -> dict:
+    with open(os.path.join(out, WATERMARK_FILE)) as f:
+        return json.load(f)
+
+
+def test_export_only_new_messages(tmp_path):
+    db, out = str(tmp_path / "messages.sqlite3"), str(tmp_path / "archive")
+    insert(db, MESSAGES)
+    assert export(SQLiteSource(db, "messages"), out, page_size=2) == 3
+    assert sorted(os.listdir(out)) == [WATERMARK_FILE, "date=2023-06-01", "date=2023-06-02"]
+    assert watermark(out)["time_stamp"] == "2023-06-02T10:00:00+00:00"
+    assert len(watermark(out)["keys"]) == 1
+
+    # nothing new, nothing written
+    files = archive_files(out)
+    assert export(SQLiteSource(db, "messages"), out) == 0
+    assert archive_files(out) == files
+
+    insert(db, LATE_MESSAGES)
+    assert export(SQLiteSource(db, "messages"), out) == 2
+    assert sorted(exported(out)) == sorted((u, c) for u, c, *_ in MESSAGES + LATE_MESSAGES)
+    assert sorted(os.listdir(out)) == [WATERMARK_FILE, "date=2023-06-01", "date=2023-06-02", "date=2023-06-03"]
+    # the late message of 2023-06-02 was written to a new file in that day's folder
+    assert len(os.listdir(tmp_path / "archive" / "date=2023-06-02")) == 2
+    assert watermark(out)["time_stamp"] == "2023-06-03T08:30:00+00:00"
+    assert len(watermark(out)["keys"]) == 1
+
+
+def test_messages_sharing_the_watermark_time(tmp_path):
+    # several messages at the last exported second, one of them stored after the first export
+    db, out = str(tmp_path / "messages.sqlite3"), str(tmp_path / "archive")
+    insert(db, MESSAGES + LATE_MESSAGES[:1])
+    assert export(SQLiteSource(db, "messages"), out) == 4
+    assert len(watermark(out)["keys"]) == 2
+    insert(db, [("frank", "same second", "", "governance", "2023-06-02T10:00:00+00:00")])
+    assert export(SQLiteSource(db, "messages"), out) == 1
+    assert len(exported(out)) == 5
+    assert len(watermark(out)["keys"]) == 3
+
+
+def test_partition_by_channel(tmp_path):
+    csv, out = tmp_path / "messages.csv", str(tmp_path / "archive")
+    csv.write_text(",".join(ARCHIVE_COLUMNS) + "\n" + "".join(",".join(row) + "\n" for row in MESSAGES))
+    assert export(CSVSource(str(csv)), out, partition_by="channel") == 3
+    assert sorted(os.listdir(out)) == [WATERMARK_FILE, "channel=general", "channel=governance"]
+    # an archive keeps the partitioning it was created with
+    with pytest.raises(ValueError):
+        export(CSVSource(str(csv)), out, partition_by="date")
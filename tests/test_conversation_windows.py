@@ -0,0 +1,78 @@
+# tests of the grouping of archived Discord messages into conversation windows (src/archive.py)
+# usage: python -m pytest tests/
+import pandas as pd
+import pytest
+
+from src import embeddings
+from src.archive import ARCHIVE_COLUMNS, conversation_windows
+
+
+class WordEncoding:
+    # one token per word, so the tests don't download a tiktoken encoding
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(embeddings, "get_encoding", lambda model=None: WordEncoding())
+
+
+def page(*messages) -> pd.DataFrame:
+    # (username, content, channel, "HH:MM") -> a page as read_pages returns it
+    rows = [(user, content, "", channel, pd.Timestamp(f"2023-06-01 {time}", tz="UTC")) for user, content, channel, time in messages]
+    return pd.DataFrame(rows, columns=ARCHIVE_COLUMNS)
+
+
+def windows(pages, gap_minutes=30, max_tokens=100):
+    return [(w.channel, w.lines) for w in conversation_windows(pages, gap_minutes=gap_minutes, max_tokens=max_tokens)]
+
+
+def test_gap_starts_a_new_window():
+    messages = page(
+        ("alice", "gm", "general", "09:00"),
+        ("bob", "gm gm", "general", "09:20"),
+        # 40 minutes after bob
+        ("carol", "anyone around?", "general", "10:00"),
+    )
+    assert windows([messages]) == [("general", ["alice: gm", "bob: gm gm"]), ("general", ["carol: anyone around?"])]
+
+
+def test_token_budget_closes_a_window():
+    messages = page(
+        ("alice", "one two three", "general", "09:00"),
+        ("bob", "four five", "general", "09:01"),
+        ("carol", "six", "general", "09:02"),
+    )
+    # "alice: one two three" is 4 tokens, "bob: four five" 3, "carol: six" 2
+    assert windows([messages], max_tokens=7) == [("general", ["alice: one two three", "bob: four five"]), ("general", ["carol: six"])]
+
+
+def test_long_message_is_truncated():
+    messages = page(("alice", "a b c d e f g h", "general", "09:00"))
+    assert windows([messages], max_tokens=4) == [("general", ["alice: a b c"])]
+
+
+def test_channels_are_windowed_separately():
+    messages = page(
+        ("alice", "gm", "general", "09:00"),
+        ("bob", "new proposal", "governance", "09:01"),
+        ("carol", "hi", "general", "09:02"),
+        ("dave", "", "general", "09:03"),
+    )
+    result = windows([messages])
+    assert sorted(result) == [("general", ["alice: gm", "carol: hi"]), ("governance", ["bob: new proposal"])]
+
+
+def test_windows_continue_across_pages():
+    first = page(("alice", "gm", "general", "09:00"), ("bob", "proposal", "governance", "09:00"))
+    second = page(("carol", "gm", "general", "09:10"), ("dave", "late", "random", "09:50"))
+    # general continues on the second page, then it and governance are closed once quiet for longer than the gap
+    assert windows([first, second]) == [
+        ("general", ["alice: gm", "carol: gm"]),
+        ("governance", ["bob: proposal"]),
+        ("random", ["dave: late"]),
+    ]
@@ -0,0 +1,114 @@
+# tests of utils/crawler.py against a local website served by aiohttp
+# usage: python -m pytest tests/
+import os
+import asyncio
+import hashlib
+from collections import Counter
+
+from aiohttp import web
+
+from utils import crawler as crawler_module
+from utils.crawler import Crawler, page_path
+
+LEO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+FOOTER = "Subscribe to the newsletter to get every new post in your inbox"
+with open(os.path.join(LEO_DIR, "text", "example.txt"), encoding="utf-8") as f:
+    ARTICLE_WORDS = f.read().split()[:400]
+ARTICLE = " ".join(ARTICLE_WORDS)
+
+PAGES = {
+    "/": '<a href="/a">A</a> <a href="/b/">B</a> <a href="/c#top">C</a> <a href="/d">D</a> <a href="https://example.com/x">out</a>',
+    "/a": '<p>Page A is about DAO governance and voting.</p><a href="/">home</a> <a href="/b">B</a>',
+    "/b": '<p>Page B is about contributor onboarding.</p><a href="/a">A</a>',
+    "/c": f"<p>{ARTICLE}</p>",
+    # the same article with one word changed, e.g. a reposted page
+    "/d": f"<p>{' '.join(ARTICLE_WORDS[:200] + ['reposted'] + ARTICLE_WORDS[201:])}</p>",
+}
+
+
+def html(path: str) -> str:
+    # every page has a navigation bar and the same footer line, like the pages of a real site
+    return f'<html><body><nav><a href="/">Home</a> <a href="/a">A</a></nav>{PAGES[path]}<p>{FOOTER}</p></body></html>'
+
+
+async def start_site(requests: Counter):
+    """Serves PAGES on an ephemeral port with ETags, counting the requests by (path, status)."""
+    async def handle(request):
+        path = request.path if request.path == "/" else request.path.rstrip("/")
+        if path not in PAGES:
+            requests[(path, 404)] += 1
+            raise web.HTTPNotFound()
+        body = html(path)
+        etag = '"' + hashlib.sha1(body.encode()).hexdigest() + '"'
+        if request.headers.get("If-None-Match") == etag:
+            requests[(path, 304)] += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        requests[(path, 200)] += 1
+        return web.Response(text=body, content_type="text/html", headers={"ETag": etag})
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def crawl_twice(tmp_path, monkeypatch):
+    """Crawls the site, then crawls it again with the saved cache. Returns what each crawl did."""
+    parsed = Counter()
+    parse_page = crawler_module.parse_page
+
+    def counting_parse_page(page_html, url, local_domain):
+        parsed[url] += 1
+        return parse_page(page_html, url, local_domain)
+
+    monkeypatch.setattr(crawler_module, "parse_page", counting_parse_page)
+
+    async def run():
+        requests = Counter()
+        runner, url = await start_site(requests)
+        try:
+            out, cache = str(tmp_path / "text"), str(tmp_path / "crawl.json")
+            first = await Crawler(url + "/", out=out, cache_path=cache).crawl()
+            first_requests, first_parsed = Counter(requests), Counter(parsed)
+            folder = os.path.join(out, Crawler(url).local_domain)
+            files = {name: (os.stat(os.path.join(folder, name)).st_mtime_ns, open(os.path.join(folder, name), encoding="utf-8").read()) for name in os.listdir(folder)}
+            requests.clear()
+            parsed.clear()
+            second = await Crawler(url + "/", out=out, cache_path=cache).crawl()
+            files_after = {name: (os.stat(os.path.join(folder, name)).st_mtime_ns, open(os.path.join(folder, name), encoding="utf-8").read()) for name in os.listdir(folder)}
+            return url, out, (first, first_requests, first_parsed, files), (second, Counter(requests), Counter(parsed), files_after)
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_crawl(tmp_path, monkeypatch):
+    url, out, first, second = crawl_twice(tmp_path, monkeypatch)
+    stats, requests, parsed, files = first
+
+    # each page is downloaded and parsed once, whatever the form of the links to it
+    assert requests == Counter({(path, 200): 1 for path in PAGES})
+    assert set(parsed.values()) == {1} and len(parsed) == len(PAGES)
+    assert stats["fetched"] == len(PAGES) and stats["failed"] == 0
+
+    # the footer every page repeats is removed, and the reposted article is deleted as a near-duplicate of the first
+    assert stats["duplicates"] == 1
+    assert len(files) == len(PAGES) - 1
+    assert all(FOOTER not in text and "Home" not in text for _, text in files.values())
+    with open(page_path(out, url.split("://", 1)[1], url + "/a"), encoding="utf-8") as f:
+        assert "DAO governance" in f.read()
+
+
+def test_recrawl_gets_304s(tmp_path, monkeypatch):
+    url, out, first, second = crawl_twice(tmp_path, monkeypatch)
+    stats, requests, parsed, files_after = second
+
+    # the unchanged pages are answered with a 304, nothing is parsed or written again
+    assert requests == Counter({(path, 304): 1 for path in PAGES})
+    assert not parsed
+    assert stats["unchanged"] == len(PAGES) and stats["fetched"] == 0
+    assert files_after == first[3]
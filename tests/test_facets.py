@@ -0,0 +1,72 @@
+# tests of the filtered search posting lists of src/facets.py
+# usage: python -m pytest tests/
+import numpy as np
+import pytest
+
+from src.facets import FacetIndex, chunk_facet
+from src.index import Chunk
+
+# 64 archive windows: the channels and dates hold many rows each (bitmap posting lists), the sources one each
+CHUNKS = [
+    Chunk(
+        text=f"window {i}",
+        source=f"_archive/window-{i}.txt",
+        channel="general" if i % 2 == 0 else "random",
+        time_stamp="2023-06-01T09:00:00" if i < 32 else "2023-06-02T09:00:00",
+        guild=1 if i < 48 else 2,
+    )
+    for i in range(64)
+]
+
+
+def expected(filters) -> list:
+    # the rows matching the filters, checked chunk by chunk
+    def matches(chunk, facet, values):
+        return chunk_facet(chunk, facet) in ([values] if isinstance(values, str) else values)
+    return [i for i, c in enumerate(CHUNKS) if all(matches(c, f, v) for f, v in filters.items())]
+
+
+@pytest.fixture(scope="module")
+def index():
+    return FacetIndex(CHUNKS)
+
+
+def test_postings_are_bitmaps_or_rows(index):
+    assert all(p.dtype == np.uint8 for p in index.postings["channel"])
+    assert all(p.dtype == np.int32 and len(p) == 1 for p in index.postings["source"])
+
+
+@pytest.mark.parametrize("filters", [
+    {"channel": "general"},
+    # two bitmap facets
+    {"channel": "general", "date": "2023-06-02"},
+    # several values of a facet match any of them
+    {"channel": ["general", "random"], "date": "2023-06-01"},
+    # row numbers checked against a bitmap facet
+    {"source": ["_archive/window-3.txt", "_archive/window-4.txt"], "channel": "general"},
+    {"source": "_archive/window-40.txt", "date": "2023-06-02", "guild": "1"},
+])
+def test_rows_match_the_filters(index, filters):
+    rows = index.rows(filters)
+    assert rows.tolist() == expected(filters)
+    assert np.all(np.diff(rows) > 0)
+
+
+def test_unknown_values(index):
+    assert len(index.rows({"channel": "announcements"})) == 0
+    # the known values still match
+    assert index.rows({"channel": ["announcements", "random"]}).tolist() == expected({"channel": "random"})
+    assert len(index.rows({"channel": "general", "date": "2023-07-01"})) == 0
+    with pytest.raises(ValueError):
+        index.rows({"author": "alice"})
+
+
+def test_no_filters(index):
+    assert index.rows({}).tolist() == list(range(64))
+
+
+def test_exclude_other_guilds(index):
+    assert index.exclude_other_guilds(None, 1).tolist() == list(range(48))
+    assert index.exclude_other_guilds(np.array([0, 50, 60], dtype=np.int32), 2).tolist() == [50, 60]
+    # a guild without chunks of its own only searches the chunks that belong to no guild
+    assert len(index.exclude_other_guilds(None, 3)) == 0
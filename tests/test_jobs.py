@@ -0,0 +1,153 @@
+# tests of the persistent background job queue of src/jobs.py, on a temporary SQLite database
+# usage: python -m pytest tests/
+import time
+import sqlite3
+import asyncio
+
+from src import jobs as jobs_module
+from src.jobs import JobQueue, QUEUED, RUNNING, DONE, FAILED
+
+GUILD = 1
+
+
+def make_queue(tmp_path, **kwargs) -> JobQueue:
+    return JobQueue(path=str(tmp_path / "jobs.sqlite3"), workers=2, retry_base_seconds=0.01, **kwargs)
+
+
+async def wait_for(queue: JobQueue, job_id: int, states=(DONE, FAILED), guild_id=GUILD, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = await queue.get(job_id, guild_id=guild_id)
+        if job.state in states or time.monotonic() > deadline:
+            return job
+        await asyncio.sleep(0.01)
+
+
+def test_retry_resumes_from_checkpoint(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=3)
+    processed = []
+
+    @queue.handler("count")
+    async def count(ctx):
+        if "items" not in ctx.payload:
+            await ctx.update_payload(items=list(range(5)))
+            await ctx.set_total(5)
+        for item in ctx.payload["items"]:
+            if ctx.is_done(item):
+                continue
+            # the first attempt fails half way
+            if item == 3 and ctx.job.attempts == 1:
+                raise RuntimeError("API unavailable")
+            processed.append(item)
+            await ctx.checkpoint(item)
+
+    async def main():
+        queue.start()
+        job_id = await queue.enqueue("count", {}, guild_id=GUILD)
+        job = await wait_for(queue, job_id)
+        await queue.stop()
+        return job
+
+    job = asyncio.run(main())
+    assert job.state == DONE
+    assert job.attempts == 2
+    assert (job.items_done, job.items_total) == (5, 5)
+    assert job.error is None
+    # the items done before the failure weren't processed again
+    assert processed == [0, 1, 2, 3, 4]
+
+
+def test_fails_after_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=2)
+
+    @queue.handler("broken")
+    async def broken(ctx):
+        raise ValueError("bad payload")
+
+    async def main():
+        queue.start()
+        job = await wait_for(queue, await queue.enqueue("broken", {}, guild_id=GUILD))
+        await queue.stop()
+        return job
+
+    job = asyncio.run(main())
+    assert (job.state, job.attempts, job.error) == (FAILED, 2, "bad payload")
+
+
+def test_interrupted_job_is_resumed(tmp_path):
+    async def enqueue():
+        queue = make_queue(tmp_path)
+        queue.handler("slow")(lambda ctx: None)
+        return await queue.enqueue("slow", {}, guild_id=GUILD)
+
+    job_id = asyncio.run(enqueue())
+    # the bot was killed while running the job's first attempt, after it checkpointed an item
+    with sqlite3.connect(str(tmp_path / "jobs.sqlite3")) as conn:
+        conn.execute("UPDATE jobs SET state = ?, attempts = 1, owner = ? WHERE id = ?", (RUNNING, jobs_module.OWNER, job_id))
+        conn.execute("INSERT INTO job_items (job_id, item) VALUES (?, 'a')", (job_id,))
+
+    async def restart():
+        queue = make_queue(tmp_path)
+        done_items = []
+
+        @queue.handler("slow")
+        async def slow(ctx):
+            done_items.append((ctx.is_done("a"), ctx.is_done("b")))
+
+        queue.start()
+        job = await wait_for(queue, job_id)
+        await queue.stop()
+        return job, done_items
+
+    job, done_items = asyncio.run(restart())
+    assert job.state == DONE
+    # the interrupted attempt doesn't count towards the retries
+    assert job.attempts == 1
+    assert done_items == [(True, False)]
+
+
+def test_claims_only_own_shards(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs_module, "shard_for", lambda guild_id: guild_id % 2)
+    ran = []
+
+    async def main():
+        queue = make_queue(tmp_path, shard_ids=[0])
+
+        @queue.handler("noop")
+        async def noop(ctx):
+            ran.append(ctx.job.guild_id)
+
+        queue.start()
+        own = await queue.enqueue("noop", {}, guild_id=2)
+        other = await queue.enqueue("noop", {}, guild_id=3)
+        job = await wait_for(queue, own, guild_id=2)
+        await asyncio.sleep(0.1)
+        other_job = await queue.get(other, guild_id=3)
+        await queue.stop()
+        return job, other_job
+
+    job, other_job = asyncio.run(main())
+    assert job.state == DONE
+    # the other shard's process runs it
+    assert other_job.state == QUEUED
+    assert ran == [2]
+
+
+def test_jobs_are_listed_per_guild(tmp_path):
+    async def main():
+        queue = make_queue(tmp_path)
+        queue.handler("noop")(lambda ctx: None)
+        first = await queue.enqueue("noop", {}, guild_id=GUILD)
+        second = await queue.enqueue("noop", {}, guild_id=GUILD)
+        other = await queue.enqueue("noop", {}, guild_id=99)
+        return (
+            [job.id for job in await queue.recent(guild_id=GUILD)],
+            await queue.get(other, guild_id=GUILD),
+            (await queue.get(other, guild_id=99)).id,
+            [first, second, other],
+        )
+
+    recent, hidden, found, (first, second, other) = asyncio.run(main())
+    assert recent == [second, first]
+    assert hidden is None
+    assert found == other
@@ -0,0 +1,100 @@
+# tests of the rate limited outbound queue of src/outbound.py, sending to fake channels
+# usage: python -m pytest tests/
+import time
+import asyncio
+
+from src.outbound import SendQueue, TokenBucket, Priority, EDIT, MAX_MESSAGE_CHARS
+
+
+class FakeChannel:
+    # records what is sent to it, in order, with the time it was sent
+    def __init__(self, channel_id: int, log: list):
+        self.id = channel_id
+        self.guild = None
+        self.log = log
+
+    async def send(self, content=None, **kwargs):
+        message = {"channel": self.id, "content": content, "at": time.monotonic()}
+        self.log.append(message)
+        await asyncio.sleep(0)
+        return message
+
+
+def run(main):
+    log = []
+    return asyncio.run(main(log)), log
+
+
+def test_channel_order_and_priority():
+    async def main(log):
+        # one request at a time overall, so the queue has to pick which one goes next
+        queue = SendQueue(global_bucket=TokenBucket(rate=20, capacity=1))
+        general, moderation = FakeChannel(1, log), FakeChannel(2, log)
+        await asyncio.gather(
+            queue.send(moderation, "flagged", priority=Priority.MODERATION),
+            queue.send(general, "first"),
+            queue.send(general, "second"),
+        )
+
+    _, log = run(main)
+    # chat goes before the moderation log, and a channel's messages keep their order
+    assert [m["content"] for m in log] == ["first", "second", "flagged"]
+
+
+def test_parts_of_one_reply_are_merged():
+    async def main(log):
+        queue = SendQueue()
+        thread = FakeChannel(1, log)
+        messages = await queue.send_parts(thread, ["part one", "part two", "x" * (MAX_MESSAGE_CHARS - 5)])
+        return messages, queue.merged
+
+    (messages, merged), log = run(main)
+    # the long part doesn't fit with the others
+    assert [m["content"] for m in log] == ["part one\npart two", "x" * (MAX_MESSAGE_CHARS - 5)]
+    assert messages[0] is messages[1] and messages[1] is not messages[2]
+    assert merged == 1
+
+
+def test_other_callers_messages_are_not_merged():
+    async def main(log):
+        queue = SendQueue()
+        channel = FakeChannel(1, log)
+        return await asyncio.gather(
+            queue.send(channel, "reply to alice"),
+            queue.send_parts(channel, ["reply to bob,", "continued"]),
+            queue.send(channel, "notice"),
+        )
+
+    (alice, bob, notice), log = run(main)
+    assert [m["content"] for m in log] == ["reply to alice", "reply to bob,\ncontinued", "notice"]
+    assert alice is not bob[0] and notice is not bob[0]
+
+
+def test_channel_rate_limit():
+    async def main(log):
+        # 10 sends per second, after a burst of 50
+        queue = SendQueue(channel_sends_per_5s=50)
+        channel = FakeChannel(1, log)
+        start = time.monotonic()
+        await asyncio.gather(*(queue.send(channel, str(i)) for i in range(51)))
+        return start
+
+    start, log = run(main)
+    assert [m["content"] for m in log] == [str(i) for i in range(51)]
+    assert log[49]["at"] - start < 0.05
+    assert log[50]["at"] - start >= 0.08
+
+
+def test_edits_have_their_own_bucket():
+    async def main(log):
+        queue = SendQueue(channel_sends_per_5s=1)
+        channel = FakeChannel(1, log)
+        start = time.monotonic()
+        await queue.send(channel, "hello")
+        # the send used up the channel's send budget for 5 seconds, the edit isn't held back by it
+        await queue.call(channel, lambda: channel.send("edited"), kind=EDIT)
+        return time.monotonic() - start
+
+    elapsed, log = run(main)
+    assert [m["content"] for m in log] == ["hello", "edited"]
+    assert elapsed < 1
@@ -0,0 +1,86 @@
+# tests of the de-duplication of concurrent identical requests by src/singleflight.py
+# usage: python -m pytest tests/
+import asyncio
+
+import pytest
+
+from src.singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_result():
+    calls = []
+
+    async def answer():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "42"
+
+    async def main():
+        flights = SingleFlight()
+        results = await asyncio.gather(*(flights.do("question", answer) for _ in range(5)))
+        return results, flights
+
+    results, flights = asyncio.run(main())
+    assert results == ["42"] * 5
+    assert len(calls) == 1
+    assert flights.shared == 4
+    assert not flights.in_flight("question")
+
+
+def test_different_keys_and_later_calls_run_again():
+    calls = []
+
+    async def answer(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key
+
+    async def main():
+        flights = SingleFlight()
+        first = await asyncio.gather(flights.do("a", lambda: answer("a")), flights.do("b", lambda: answer("b")))
+        # the first call is over, so the next one isn't served its result
+        second = await flights.do("a", lambda: answer("a"))
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first == ["a", "b"] and second == "a"
+    assert calls == ["a", "b", "a"]
+
+
+def test_errors_are_shared_and_not_cached():
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        if len(attempts) == 1:
+            raise RuntimeError("API unavailable")
+        return "ok"
+
+    async def main():
+        flights = SingleFlight()
+        results = await asyncio.gather(flights.do("q", flaky), flights.do("q", flaky), return_exceptions=True)
+        return results, await flights.do("q", flaky)
+
+    results, retry = asyncio.run(main())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert retry == "ok"
+    assert len(attempts) == 2
+
+
+def test_cancelled_caller_does_not_cancel_the_others():
+    async def answer():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def main():
+        flights = SingleFlight()
+        first = asyncio.ensure_future(flights.do("q", answer))
+        second = asyncio.ensure_future(flights.do("q", answer))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == "done"
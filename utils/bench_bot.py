@@ -0,0 +1,313 @@
+# this benchmarks the bot's commands end to end without Discord or OpenAI
+# the real handlers of src/main.py run against FakeDiscord channels, threads and interactions and a FakeOpenAI server
+# on localhost (see utils/fakes.py), so moderation, the send queue, embeddings batching, retrieval and the LLM calls
+# all run as in production, only the network is simulated
+# it reports throughput and p50/p95/p99 latency of /chat, thread replies, /ask and /onboard at each concurrency, with
+# the mean time spent in each stage, and saves them as JSON so runs can be compared
+# usage: python -m utils.bench_bot --commands chat,thread,ask,onboard --concurrency 1,8,32 --requests 50
+# compare with an earlier run: python -m utils.bench_bot --baseline data/bench/bot-20230601-120000.json
+# note: the send queue keeps the bot under Discord's global rate limit (DISCORD_GLOBAL_REQUESTS_PER_SECOND), which
+# caps the throughput of the commands sending several messages
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import datetime
+import tempfile
+import contextvars
+import subprocess
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+from utils.fakes import FakeDiscord, FakeOpenAI
+
+# get the parent directory of the current file
+LEO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+COMMANDS = ("chat", "thread", "ask", "onboard")
+# name of each command's trace (see src/metrics.py), its stages are reported with it
+TRACE_NAMES = {"chat": "chat", "thread": "thread_message", "ask": "ask", "onboard": "onboard_job"}
+QUESTIONS = [
+    "What projects is talentDAO working on?",
+    "How can I contribute to the research guild?",
+    "Who are the core team members?",
+    "What is the Journal of Decentralized Work about?",
+]
+INTRO = "Hi everyone! I'm {name}, a data scientist interested in organizational research and DAO tooling. Happy to be here!"
+
+
+def point_at_fakes(openai_url: str, workdir: str, workers: int = 0) -> None:
+    """Configures the bot to talk to the fake OpenAI server. Call it before importing src, the constants are read
+        from the environment at import time, and the worker processes inherit it.
+    """
+    os.environ["OPENAI_API_BASE"] = openai_url
+    # the fake vectors must not end up in the bot's embeddings cache
+    os.environ["EMBEDDING_CACHE_DIR"] = os.path.join(workdir, "cache")
+    os.environ["WORKER_PROCESSES"] = str(workers)
+    os.environ["METRICS_PORT"] = "0"
+    os.environ["LOOP_STALL_THRESHOLD_MS"] = "0"
+    os.environ["INDEX_WATCH_SECONDS"] = "0"
+    # the bot refuses to start without these, their values don't matter offline
+    for name, value in [("DISCORD_BOT_TOKEN", "fake"), ("DISCORD_CLIENT_ID", "0"), ("OPENAI_API_KEY", "sk-fake"), ("ALLOWED_SERVER_IDS", "1"), ("TARGET_CHANNEL_ID", "2")]:
+        os.environ.setdefault(name, value)
+
+
+async def warm_up(commands: List[str]) -> Optional[str]:
+    """Loads what /ask and /onboard need, in the worker processes if any. Returns why it failed, if it did."""
+    from src import startup
+    from src.workers import worker_pool
+    if worker_pool.processes > 0:
+        worker_pool.start()
+        while not worker_pool.ready and worker_pool.error is None:
+            await asyncio.sleep(0.1)
+        return worker_pool.error
+    if any(c in ("ask", "onboard") for c in commands):
+        await asyncio.get_running_loop().run_in_executor(None, startup.warm_up)
+        if startup.warm_up_error is not None:
+            return f"{type(startup.warm_up_error).__name__}: {startup.warm_up_error}"
+    return None
+
+
+class BotRequests:
+    """Sends one request of each command to the bot's handlers, each in its own channel or thread, and checks it was answered."""
+    def __init__(self, fake: FakeDiscord, workdir: str, history: int = 10, intros: int = 5):
+        from src import main as bot
+        from src.jobs import JobQueue
+        from src.constants import ACTIVATE_THREAD_PREFX, MAX_THREAD_MESSAGES, TARGET_CHANNEL_ID
+        self.bot = bot
+        self.fake = fake
+        self.thread_prefix = ACTIVATE_THREAD_PREFX
+        # earlier messages of each thread, the bot sends them all to the model
+        self.history = min(history, MAX_THREAD_MESSAGES - 1)
+        self.intros = intros
+        # the onboarding jobs are run directly, from a queue of their own
+        self.jobs = JobQueue(path=os.path.join(workdir, "jobs.sqlite3"))
+        self.jobs.handler("onboard")(bot.run_onboard_job)
+        # every /onboard run reads its own intro channel, so concurrent runs don't skip each other's intros
+        self._intro_channel: contextvars.ContextVar = contextvars.ContextVar("intro_channel", default=None)
+        fake.install(bot.client)
+        bot.client.get_channel = lambda channel_id: self._intro_channel.get() if channel_id == TARGET_CHANNEL_ID else fake.get_channel(channel_id)
+
+    def _answered(self, channel) -> bool:
+        last = channel.messages[-1] if channel.messages else None
+        return last is not None and last.author is self.fake.bot and bool(last.content)
+
+    async def chat(self, i: int) -> bool:
+        channel = self.fake.text_channel(f"chat-{i}")
+        interaction = self.fake.interaction(self.fake.user(f"user{i}"), channel)
+        await self.bot.chat_command.callback(interaction, message=QUESTIONS[i % len(QUESTIONS)])
+        return bool(channel.threads) and self._answered(channel.threads[-1])
+
+    async def thread(self, i: int) -> bool:
+        user = self.fake.user(f"user{i}")
+        thread = self.fake.thread(self.fake.text_channel(f"chat-{i}"), f"{self.thread_prefix} {user.name} - benchmark")
+        for turn in range(self.history):
+            thread.add_message(user if turn % 2 == 0 else self.fake.bot, f"{QUESTIONS[turn % len(QUESTIONS)]} (turn {turn})")
+        message = thread.add_message(user, QUESTIONS[i % len(QUESTIONS)])
+        await self.bot.on_message(message)
+        return self._answered(thread)
+
+    async def ask(self, i: int) -> bool:
+        interaction = self.fake.interaction(self.fake.user(f"user{i}"), self.fake.text_channel(f"ask-{i}"))
+        # numbered, identical questions asked at the same time would share one answer
+        await self.bot.ask_command.callback(interaction, question=f"{QUESTIONS[i % len(QUESTIONS)]} #{i}")
+        return interaction.original is not None and interaction.original.content.startswith("**Question:**")
+
+    async def onboard(self, i: int) -> bool:
+        intro_channel = self.fake.text_channel(f"intros-{i}")
+        for n in range(self.intros):
+            intro_channel.add_message(self.fake.user(f"newcomer{i}-{n}"), INTRO.format(name=f"newcomer {n}"))
+        notify_channel = self.fake.text_channel(f"onboard-{i}")
+        job_id = await self.jobs.enqueue("onboard", {"limit": self.intros, "guild_id": self.fake.guild.id, "notify_channel_id": notify_channel.id}, guild_id=self.fake.guild.id)
+        token = self._intro_channel.set(intro_channel)
+        try:
+            await self.bot.run_onboard_job(await self.jobs.context(await self.jobs.get(job_id, guild_id=self.fake.guild.id)))
+        finally:
+            self._intro_channel.reset(token)
+        # the fake LLM classifies every message as an intro, each one gets a reply
+        return sum(1 for m in intro_channel.messages if m.reference is not None) == self.intros
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    ms = 1000 * np.asarray(latencies)
+    return {
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "mean_ms": float(ms.mean()),
+        "max_ms": float(ms.max()),
+    }
+
+
+async def run_concurrently(request: Callable[[int], Awaitable[bool]], requests: int, concurrency: int) -> dict:
+    """Sends requests with at most concurrency of them in flight, returns the throughput and latency percentiles."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    failures = 0
+
+    async def one(i: int) -> None:
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                answered = await request(i)
+            except Exception as e:
+                logging.getLogger("leo_logger").exception(f"Request {i} failed: {e}")
+                answered = False
+            latencies.append(time.perf_counter() - start)
+            failures += not answered
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    seconds = time.perf_counter() - start
+    return {"requests": requests, "failures": failures, "seconds": seconds, "throughput_per_s": requests / seconds, **latency_summary(latencies)}
+
+
+def stage_totals() -> Dict[tuple, tuple]:
+    """(request, stage) -> (total seconds, count) recorded so far in the leo_stage_seconds histogram."""
+    from src.metrics import metrics
+    histogram = metrics.histogram("leo_stage_seconds", "Time spent in each stage of a request")
+    return {tuple(v for _, v in labels): (total, n) for labels, (_, total, n) in list(histogram.values.items())}
+
+
+def stage_means(before: Dict[tuple, tuple], after: Dict[tuple, tuple], request: str) -> Dict[str, float]:
+    """Mean milliseconds spent in each stage of a request between two stage_totals."""
+    means = {}
+    for (name, stage), (total, n) in after.items():
+        previous_total, previous_n = before.get((name, stage), (0.0, 0))
+        if name == request and n > previous_n:
+            means[stage] = 1000 * (total - previous_total) / (n - previous_n)
+    return means
+
+
+def counter_delta(before: Counter, after: Counter) -> Dict[str, int]:
+    return {" ".join(map(str, k)) if isinstance(k, tuple) else k: n for k, n in sorted((after - before).items())}
+
+
+async def benchmark(args, openai: FakeOpenAI, workdir: str) -> List[dict]:
+    from src import main as bot
+    from src.constants import ALLOWED_SERVER_IDS
+    from src.workers import worker_pool
+    import openai as openai_client
+    # in case openai was imported before OPENAI_API_BASE was set
+    openai_client.api_base = openai.url
+    if args.verbose:
+        logging.getLogger("leo_logger").setLevel(logging.INFO)
+    else:
+        # failures are counted in the results, --verbose logs why they failed
+        logging.disable(logging.ERROR)
+    # the bot waits this long for follow-up messages before answering in a thread
+    bot.SECONDS_DELAY_RECEIVING_MSG = args.reply_delay
+
+    fake = FakeDiscord(guild_id=ALLOWED_SERVER_IDS[0], latency_ms=args.discord_latency_ms)
+    requests = BotRequests(fake, workdir, history=args.history, intros=args.intros)
+    error = await warm_up(args.commands)
+
+    results = []
+    for command in args.commands:
+        if command in ("ask", "onboard") and error is not None:
+            print(f"Skipping {command}, the bot failed to warm up: {error}")
+            results.append({"command": command, "skipped": error})
+            continue
+        for concurrency in args.concurrency:
+            stages, upstream, discord_requests = stage_totals(), openai.requests.copy(), fake.requests.copy()
+            result = await run_concurrently(getattr(requests, command), args.requests, concurrency)
+            results.append({
+                "command": command,
+                "concurrency": concurrency,
+                **result,
+                "stages_ms": stage_means(stages, stage_totals(), TRACE_NAMES[command]),
+                "openai_requests": counter_delta(upstream, openai.requests),
+                "discord_requests": counter_delta(discord_requests, fake.requests),
+            })
+            print_result(results[-1])
+    if worker_pool.running:
+        worker_pool.close()
+    return results
+
+
+def print_result(r: dict) -> None:
+    print(
+        f"{r['command']:<8} {r['concurrency']:>5} {r['requests']:>8} {r['failures']:>8} {r['throughput_per_s']:>9.2f} "
+        f"{r['p50_ms']:>9.0f} {r['p95_ms']:>9.0f} {r['p99_ms']:>9.0f}"
+    )
+
+
+def compare(results: List[dict], baseline_path: str) -> None:
+    """Prints the change of each command's throughput and latency since an earlier run."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(r["command"], r.get("concurrency")): r for r in json.load(f)["results"] if "skipped" not in r}
+    print(f"\nChange since {baseline_path}:")
+    print(f"{'command':<8} {'conc':>5} {'req/s':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for r in results:
+        old = baseline.get((r["command"], r.get("concurrency")))
+        if old is None or "skipped" in r:
+            continue
+        change = lambda key: f"{100 * (r[key] - old[key]) / old[key]:+.0f}%" if old[key] else "-"
+        print(f"{r['command']:<8} {r['concurrency']:>5} {change('throughput_per_s'):>9} {change('p50_ms'):>9} {change('p95_ms'):>9} {change('p99_ms'):>9}")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=LEO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's commands against fake Discord and OpenAI")
+    parser.add_argument("--commands", default=",".join(COMMANDS), help=f"commands to benchmark, among {','.join(COMMANDS)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="requests in flight at once, one run per value")
+    parser.add_argument("--requests", type=int, default=50, help="requests per command and concurrency")
+    parser.add_argument("--latency-ms", type=float, default=300, help="OpenAI response time, before the first token")
+    parser.add_argument("--token-ms", type=float, default=10, help="OpenAI time per generated token, streamed replies send one at a time")
+    parser.add_argument("--reply-words", type=int, default=60, help="length of the fake model replies")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fraction of OpenAI requests answered with a 429")
+    parser.add_argument("--discord-latency-ms", type=float, default=50, help="time each Discord request takes")
+    parser.add_argument("--history", type=int, default=10, help="earlier messages in each thread")
+    parser.add_argument("--intros", type=int, default=5, help="intro messages read by each /onboard run")
+    parser.add_argument("--reply-delay", type=float, default=0, help="seconds the bot waits for follow-ups in a thread (SECONDS_DELAY_RECEIVING_MSG)")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes, as WORKER_PROCESSES")
+    parser.add_argument("--out", help="JSON file to save the results to, data/bench/bot-<time>.json by default")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's logs")
+    args = parser.parse_args()
+    args.commands = [c for c in args.commands.split(",") if c]
+    unknown = set(args.commands) - set(COMMANDS)
+    if unknown:
+        parser.error(f"unknown commands {', '.join(sorted(unknown))}, use {','.join(COMMANDS)}")
+    args.concurrency = [int(c) for c in args.concurrency.split(",")]
+    started = datetime.datetime.now()
+    out = os.path.abspath(args.out or os.path.join(LEO_DIR, "data", "bench", f"bot-{started:%Y%m%d-%H%M%S}.json"))
+
+    openai = FakeOpenAI(latency_ms=args.latency_ms, token_ms=args.token_ms, reply_words=args.reply_words, rate_limit=args.rate_limit)
+    url = openai.start()
+    with tempfile.TemporaryDirectory(prefix="leo-bench-") as workdir:
+        point_at_fakes(url, workdir, workers=args.workers)
+        # /onboard saves the messages it read to msg_log/ in the working directory, keep them out of the repo.
+        # The repo stays importable for the worker processes
+        sys.path.insert(0, LEO_DIR)
+        os.chdir(workdir)
+        print(f"Fake OpenAI on {url}, {args.requests} requests per command and concurrency")
+        print(f"{'command':<8} {'conc':>5} {'requests':>8} {'failures':>8} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        results = asyncio.run(benchmark(args, openai, workdir))
+        os.chdir(LEO_DIR)
+    openai.stop()
+
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        config = {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "verbose")}
+        json.dump({"time": started.isoformat(timespec="seconds"), "commit": git_commit(), "config": config, "results": results}, f, indent=2)
+    print(f"Saved results to {out}")
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
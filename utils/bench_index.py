@@ -0,0 +1,75 @@
+# this benchmarks the vector index storage modes (float32, float16, int8) used for document search
+# it reports memory, search latency and recall@k against exact float32 search for each mode
+# run it from the repo root: python -m utils.bench_index --vectors 100000
+# pass --embeddings path/to/vectors.npy to benchmark real ada embeddings instead of random ones
+
+import time
+import argparse
+import numpy as np
+
+from src.index import Chunk, VectorIndex
+
+
+def random_unit_vectors(n: int, dim: int, rng: np.random.Generator) -> np.ndarray:
+    vectors = rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_queries(vectors: np.ndarray, n: int, noise: float, rng: np.random.Generator) -> np.ndarray:
+    # queries near existing vectors, like a question close to a document chunk
+    picks = vectors[rng.integers(0, len(vectors), n)]
+    queries = picks + noise * random_unit_vectors(n, vectors.shape[1], rng)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def benchmark(vectors: np.ndarray, queries: np.ndarray, k: int, dtypes):
+    chunks = [Chunk(text="", source=str(i)) for i in range(len(vectors))]
+    exact = VectorIndex(chunks, vectors, dtype="float32")
+    truth = [{c.source for c, _ in exact.search(q, k=k)} for q in queries]
+
+    results = []
+    for dtype in dtypes:
+        index = VectorIndex(chunks, vectors, dtype=dtype)
+        latencies = []
+        hits = 0
+        for q, expected in zip(queries, truth):
+            start = time.perf_counter()
+            found = index.search(q, k=k)
+            latencies.append(time.perf_counter() - start)
+            hits += len(expected & {c.source for c, _ in found})
+        results.append({
+            "dtype": dtype,
+            "memory_mb": index.nbytes / 1e6,
+            "p50_ms": 1000 * float(np.percentile(latencies, 50)),
+            "p95_ms": 1000 * float(np.percentile(latencies, 95)),
+            f"recall@{k}": hits / (k * len(queries)),
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark vector index storage modes")
+    parser.add_argument("--vectors", type=int, default=100_000, help="number of random vectors to index")
+    parser.add_argument("--dim", type=int, default=1536, help="dimension of the random vectors (ada is 1536)")
+    parser.add_argument("--embeddings", help=".npy file with real embeddings to index instead of random vectors")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.8, help="how far the queries are from the indexed vectors")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--dtypes", default="float32,float16,int8")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.embeddings:
+        vectors = np.load(args.embeddings).astype(np.float32)
+    else:
+        vectors = random_unit_vectors(args.vectors, args.dim, rng)
+    queries = make_queries(vectors, args.queries, args.noise, rng)
+
+    print(f"{len(vectors)} vectors x {vectors.shape[1]} dims, {len(queries)} queries, k={args.k}")
+    print(f"{'dtype':<8} {'memory MB':>10} {'p50 ms':>8} {'p95 ms':>8} {'recall@' + str(args.k):>9}")
+    for r in benchmark(vectors, queries, args.k, args.dtypes.split(",")):
+        print(f"{r['dtype']:<8} {r['memory_mb']:>10.1f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['recall@' + str(args.k)]:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
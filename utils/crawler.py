@@ -1,28 +1,22 @@
-################################################################################
-### Step 1
-################################################################################
-from dotenv import load_dotenv
-
-import requests
-import re
-import urllib.request
-from bs4 import BeautifulSoup
-from collections import deque
-from html.parser import HTMLParser
-from urllib.parse import urlparse
-import os
-import pandas as pd
-import tiktoken
-import openai
-import numpy as np
-from openai.embeddings_utils import distances_from_embeddings, cosine_similarity
+# this is the crawler we use to download the pages of a website into text/ for question and answering
+# pages are fetched concurrently (a few at a time per host), each page is downloaded and parsed once for both its
+# text and its links, and the ETag/Last-Modified of every page is saved so a recrawl skips the pages that didn't change
+# once the crawl is done, the lines every page repeats (navigation, footers) are removed and near-duplicate pages deleted
+# usage: python -m utils.crawler https://talentdao.substack.com/p/nodw-13-qualitative-insights-from
 
-load_dotenv(r'/Users/kennycavanagh/Desktop/files/lab/repositories/leo/botenv.env')
-OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
-openai.api_key=OPENAI_API_KEY
+"""This is the logic for crawling a website into text files."""
+import os
+import json
+import asyncio
+import argparse
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import urljoin, urldefrag, urlparse
+
+import aiohttp
+from bs4 import BeautifulSoup
 
-# Regex pattern to match a URL
-HTTP_URL_PATTERN = r'^http[s]*://.+'
+from src.dedup import SimHashIndex, find_boilerplate, remove_lines
 
 # Define root domain to crawl
 # domain = "talentdao.mirror.xyz/"
@@ -32,135 +26,192 @@ HTTP_URL_PATTERN = r'^http[s]*://.+'
 domain = "talentdao.substack.com/"
 full_url = "https://talentdao.substack.com/p/nodw-13-qualitative-insights-from"
 
-# Create a class to parse the HTML and get the hyperlinks
-class HyperlinkParser(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        # Create a list to store the hyperlinks
-        self.hyperlinks = []
-
-    # Override the HTMLParser's handle_starttag method to get the hyperlinks
-    def handle_starttag(self, tag, attrs):
-        attrs = dict(attrs)
-
-        # If the tag is an anchor tag and it has an href attribute, add the href attribute to the list of hyperlinks
-        if tag == "a" and "href" in attrs:
-            self.hyperlinks.append(attrs["href"])
-
-################################################################################
-### Step 2
-################################################################################
-
-# Function to get the hyperlinks from a URL
-def get_hyperlinks(url):
-    
-    # Try to open the URL and read the HTML
-    try:
-        # Open the URL and read the HTML
-        with urllib.request.urlopen(url) as response:
-
-            # If the response is not HTML, return an empty list
-            if not response.info().get('Content-Type').startswith("text/html"):
-                return []
-            
-            # Decode the HTML
-            html = response.read().decode('utf-8')
-    except Exception as e:
-        print(e)
-        return []
-
-    # Create the HTML Parser and then Parse the HTML to get hyperlinks
-    parser = HyperlinkParser()
-    parser.feed(html)
-
-    return parser.hyperlinks
-
-################################################################################
-### Step 3
-################################################################################
-
-# Function to get the hyperlinks from a URL that are within the same domain
-def get_domain_hyperlinks(local_domain, url):
-    clean_links = []
-    for link in set(get_hyperlinks(url)):
-        clean_link = None
-
-        # If the link is a URL, check if it is within the same domain
-        if re.search(HTTP_URL_PATTERN, link):
-            # Parse the URL and check if the domain is the same
-            url_obj = urlparse(link)
-            if url_obj.netloc == local_domain:
-                clean_link = link
-
-        # If the link is not a URL, check if it is a relative link
-        else:
-            if link.startswith("/"):
-                link = link[1:]
-            elif link.startswith("#") or link.startswith("mailto:"):
-                continue
-            clean_link = "https://" + local_domain + "/" + link
-
-        if clean_link is not None:
-            if clean_link.endswith("/"):
-                clean_link = clean_link[:-1]
-            clean_links.append(clean_link)
-
-    # Return the list of hyperlinks that are within the same domain
-    return list(set(clean_links))
-
-
-################################################################################
-### Step 4
-################################################################################
-
-def crawl(url):
-    # Parse the URL and get the domain
-    local_domain = urlparse(url).netloc
-
-    # Create a queue to store the URLs to crawl
-    queue = deque([url])
-
-    # Create a set to store the URLs that have already been seen (no duplicates)
-    seen = set([url])
-
-    # Create a directory to store the text files
-    if not os.path.exists("text/"):
-            os.mkdir("text/")
-
-    if not os.path.exists("text/"+local_domain+"/"):
-            os.mkdir("text/" + local_domain + "/")
-
-    # Create a directory to store the csv files
-    if not os.path.exists("processed"):
-            os.mkdir("processed")
-
-    # While the queue is not empty, continue crawling
-    while queue:
-
-        # Get the next URL from the queue
-        url = queue.pop()
-        print(url) # for debugging and to see the progress
-
-        # Save text from the url to a <url>.txt file
-        with open('text/'+local_domain+'/'+url[8:].replace("/", "_") + ".txt", "w", encoding="UTF-8") as f:
-
-            # Get the text from the URL using BeautifulSoup
-            soup = BeautifulSoup(requests.get(url).text, "html.parser")
-
-            # Get the text but remove the tags
-            text = soup.get_text()
-
-            # If the crawler gets to a page that requires JavaScript, it will stop the crawl
-            if ("You need to enable JavaScript to run this app." in text):
-                print("Unable to parse page " + url + " due to JavaScript being required")
-            
-            # Otherwise, write the text to the file in the text directory
+JAVASCRIPT_REQUIRED = "You need to enable JavaScript to run this app."
+
+# Page elements whose text is never content
+BOILERPLATE_TAGS = ["script", "style", "noscript", "nav", "header", "footer", "aside", "form"]
+# Elements that start a new line of text, so repeated lines can be recognized across pages
+BLOCK_TAGS = ["p", "div", "li", "br", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "blockquote", "pre"]
+
+
+def clean_link(local_domain: str, page_url: str, link: str) -> Optional[str]:
+    # returns the absolute URL of a link if it is within the same domain, without fragment or trailing slash
+    if link.startswith("mailto:") or link.startswith("#"):
+        return None
+    url, _ = urldefrag(urljoin(page_url, link))
+    url_obj = urlparse(url)
+    if url_obj.scheme not in ("http", "https") or url_obj.netloc != local_domain:
+        return None
+    return url[:-1] if url.endswith("/") else url
+
+
+def parse_page(html: str, page_url: str, local_domain: str) -> Tuple[str, List[str]]:
+    """Parses a page once and returns its text and the links within the same domain."""
+    soup = BeautifulSoup(html, "html.parser")
+    # links are taken before removing the navigation, it links to most of the site
+    links = {clean_link(local_domain, page_url, a["href"]) for a in soup.find_all("a", href=True)}
+    for element in soup.find_all(BOILERPLATE_TAGS):
+        element.decompose()
+    for element in soup.find_all(BLOCK_TAGS):
+        # on lines of their own, even after inline text, so repeated blocks are whole lines
+        element.insert_before("\n")
+        element.insert_after("\n")
+    return soup.get_text(), sorted(link for link in links if link)
+
+
+def page_path(out: str, local_domain: str, url: str) -> str:
+    # Save text from the url to a <url>.txt file
+    return os.path.join(out, local_domain, url.split("://", 1)[1].replace("/", "_") + ".txt")
+
+
+class Crawler:
+    def __init__(self, start_url: str, out: str = "text/", cache_path: Optional[str] = None, concurrency: int = 10, per_host: int = 2, timeout: float = 30, verbose: bool = False):
+        self.start_url = start_url
+        self.local_domain = urlparse(start_url).netloc
+        self.out = out
+        # url -> {"etag", "last_modified", "links"} of the last crawl
+        self.cache_path = cache_path or os.path.join("data", "crawl", f"{self.local_domain.replace(':', '_')}.json")
+        self.cache: Dict[str, dict] = {}
+        # boilerplate lines found by the previous crawls, the pages saved then no longer contain them
+        self.boilerplate: Set[str] = set()
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                saved = json.load(f)
+            self.cache = saved["pages"]
+            self.boilerplate = set(saved["boilerplate"])
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        # print every URL as it is crawled
+        self.verbose = verbose
+        self._hosts: Dict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+        self.stats = {"fetched": 0, "unchanged": 0, "failed": 0, "skipped": 0, "duplicates": 0, "bytes": 0}
+
+    def _conditional_headers(self, url: str) -> Dict[str, str]:
+        # only ask for a 304 if we still have the text saved by the last crawl
+        cached = self.cache.get(url)
+        if not cached or not (cached.get("duplicate_of") or os.path.exists(page_path(self.out, self.local_domain, url))):
+            return {}
+        headers = {}
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+        return headers
+
+    async def fetch(self, session: aiohttp.ClientSession, url: str) -> List[str]:
+        """Downloads a page, saves its text, and returns its links."""
+        async with self._hosts[urlparse(url).netloc]:
+            async with session.get(url, headers=self._conditional_headers(url)) as response:
+                if response.status == 304:
+                    self.stats["unchanged"] += 1
+                    return self.cache[url].get("links", [])
+                response.raise_for_status()
+                # If the response is not HTML, skip it
+                if not response.headers.get("Content-Type", "").startswith("text/html"):
+                    self.stats["skipped"] += 1
+                    return []
+                body = await response.read()
+                html = body.decode(response.charset or "utf-8", errors="replace")
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        self.stats["fetched"] += 1
+        self.stats["bytes"] += len(body)
+
+        # parse in a thread, so large pages don't hold up the other downloads
+        loop = asyncio.get_running_loop()
+        text, links = await loop.run_in_executor(None, parse_page, html, url, self.local_domain)
+
+        # If the crawler gets to a page that requires JavaScript, it can't get its text
+        if JAVASCRIPT_REQUIRED in text:
+            print("Unable to parse page " + url + " due to JavaScript being required")
+        path = page_path(self.out, self.local_domain, url)
+        with open(path, "w", encoding="UTF-8") as f:
             f.write(text)
-
-        # Get the hyperlinks from the URL and add them to the queue
-        for link in get_domain_hyperlinks(local_domain, url):
-            if link not in seen:
-                queue.append(link)
-                seen.add(link)
-
-crawl(full_url)
\ No newline at end of file
+        self.cache[url] = {"etag": etag, "last_modified": last_modified, "links": links}
+        return links
+
+    async def crawl(self) -> Dict[str, int]:
+        """Crawls every page of the start URL's domain reachable from it, returns the crawl statistics."""
+        os.makedirs(os.path.join(self.out, self.local_domain), exist_ok=True)
+        queue: asyncio.Queue = asyncio.Queue()
+        # normalized like the links, so the links back to the start page don't fetch it again
+        start_url = clean_link(self.local_domain, self.start_url, self.start_url) or self.start_url
+        seen = {start_url}
+        queue.put_nowait(start_url)
+
+        async def worker(session: aiohttp.ClientSession):
+            while True:
+                url = await queue.get()
+                try:
+                    if self.verbose:
+                        print(url)
+                    for link in await self.fetch(session, url):
+                        if link not in seen:
+                            seen.add(link)
+                            queue.put_nowait(link)
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    print(f"Failed to crawl {url}: {e}")
+                finally:
+                    queue.task_done()
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            workers = [asyncio.create_task(worker(session)) for _ in range(self.concurrency)]
+            await queue.join()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        self.clean_pages()
+        self.save_cache()
+        return self.stats
+
+    def clean_pages(self) -> None:
+        """Strips the boilerplate lines shared by the crawled pages and deletes the pages that are near-duplicates of another."""
+        folder = os.path.join(self.out, self.local_domain)
+        paths = {page_path(self.out, self.local_domain, url): url for url in self.cache}
+        texts = {}
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            if name.endswith(".txt") and path in paths:
+                with open(path, encoding="UTF-8") as f:
+                    texts[path] = f.read()
+
+        self.boilerplate |= find_boilerplate(texts.values())
+        index = SimHashIndex()
+        for path, original in texts.items():
+            text = remove_lines(original, self.boilerplate)
+            url = paths[path]
+            duplicate_of = index.add_if_new(text, url)
+            if duplicate_of is not None:
+                # keep it in the cache, so a recrawl still follows its links and skips it while unchanged
+                self.cache[url]["duplicate_of"] = duplicate_of
+                self.stats["duplicates"] += 1
+                os.remove(path)
+                continue
+            self.cache[url].pop("duplicate_of", None)
+            if text != original:
+                with open(path, "w", encoding="UTF-8") as f:
+                    f.write(text)
+
+    def save_cache(self) -> None:
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp = self.cache_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"pages": self.cache, "boilerplate": sorted(self.boilerplate)}, f)
+        os.replace(tmp, self.cache_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl a website into text files")
+    parser.add_argument("url", nargs="?", default=full_url, help="page to start from, only pages of its domain are crawled")
+    parser.add_argument("--out", default="text/", help="folder to write the text files to")
+    parser.add_argument("--cache", default=None, help="file the ETag/Last-Modified of each page are saved to")
+    parser.add_argument("--concurrency", type=int, default=10, help="pages downloaded at once")
+    parser.add_argument("--per-host", type=int, default=2, help="pages downloaded at once from the same host")
+    parser.add_argument("--verbose", action="store_true", help="print every URL as it is crawled")
+    args = parser.parse_args()
+    crawler = Crawler(args.url, out=args.out, cache_path=args.cache, concurrency=args.concurrency, per_host=args.per_host, verbose=args.verbose)
+    stats = asyncio.run(crawler.crawl())
+    print(f"Fetched {stats['fetched']} pages ({stats['bytes'] / 1e6:.1f}MB), {stats['unchanged']} unchanged, {stats['duplicates']} near-duplicates removed, {stats['failed']} failed")
@@ -0,0 +1,245 @@
+# this evaluates document search (QA) retrieval quality and speed for each retriever configuration
+# the questions come from a hand-labelled file (data/eval/example.jsonl: a question, the document it is answered by
+# and snippets of the answer) and are seeded from the sentences of a document (text/example.txt by default: a
+# sentence's words are shuffled and half of them dropped to make the question, the sentence is the answer).
+# A chunk answers a question if it contains one of its snippets, or the first or second half of one for snippets
+# split between two chunks.
+# each configuration (chunk size and overlap, vector dtype, candidates, context token budget, MMR lambda) indexes the
+# documents like src/index.py and retrieves like the /ask retriever of src/base.py, and it reports side by side:
+# recall@k (questions with an answering chunk in the top k), MRR, the questions whose answer made it into the
+# prompt's context, the prompt tokens, the retrieval latency (search and context building) and the index memory
+# it runs offline: the default --embeddings fake uses hashed bags of words (see utils/fakes.py), --embeddings openai
+# embeds with the real model once and reuses the vectors cached in EMBEDDING_CACHE_DIR on later runs
+# usage: python -m utils.eval_retrieval --chunk-tokens 150,250,400 --dtypes float32,int8 --k 1,3,5,10
+# compare with an earlier run: python -m utils.eval_retrieval --baseline data/bench/retrieval-20230601-120000.json
+
+import os
+import re
+import json
+import time
+import random
+import argparse
+import datetime
+import itertools
+from pathlib import Path
+from typing import List, Sequence
+
+import numpy as np
+
+from src import constants
+from src.base import QA_PROMPT_TEMPLATE
+from src.index import Chunk, VectorIndex
+from src.chunking import chunk_file
+from src.dedup import drop_near_duplicates
+from src.context import build_context
+from src.embeddings import count_tokens, cached_embed_texts
+from utils.fakes import hashed_embedding
+from utils.bench_bot import LEO_DIR, latency_summary, git_commit
+
+LABELLED_QUESTIONS = os.path.join(LEO_DIR, "data", "eval", "example.jsonl")
+# Seeded questions are made from sentences of this many words
+SEED_SENTENCE_WORDS = (12, 40)
+# Left out of the seeded questions, so they keep the words that identify the sentence
+STOP_WORDS = set("a an the and or but of to in on at by for with from as is are was were be been it its this that these those which who whom".split())
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def load_labelled(path: str) -> List[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def seed_questions(docs_dir: str, source: str, n: int, rng: random.Random) -> List[dict]:
+    """Makes n questions from sentences of a document, each answered by the sentence it came from."""
+    with open(os.path.join(docs_dir, source), "r", encoding="utf-8", errors="replace") as f:
+        text = " ".join(f.read().split())
+    sentences = [s for s in re.split(r"(?<=[.!?])\s+", text) if SEED_SENTENCE_WORDS[0] <= len(s.split()) <= SEED_SENTENCE_WORDS[1]]
+    questions = []
+    for sentence in rng.sample(sentences, min(n, len(sentences))):
+        words = [w for w in re.findall(r"\w+", sentence) if w.lower() not in STOP_WORDS]
+        question = rng.sample(words, max(1, len(words) // 2))
+        questions.append({"question": " ".join(question) + "?", "source": source, "expected": [sentence], "seeded": True})
+    return questions
+
+
+def matches(text: str, expected: Sequence[str]) -> bool:
+    # snippets split at a chunk boundary still match the chunk holding either half of them
+    text = normalize(text)
+    for snippet in map(normalize, expected):
+        words = snippet.split()
+        half = (len(words) + 1) // 2
+        if snippet in text or (len(words) >= 4 and (" ".join(words[:half]) in text or " ".join(words[half:]) in text)):
+            return True
+    return False
+
+
+def embed(texts: List[str], name: str, embeddings: str) -> np.ndarray:
+    if embeddings == "fake":
+        return np.stack([hashed_embedding(t) for t in texts]) if texts else np.zeros((0, 1536), dtype=np.float32)
+    return cached_embed_texts(texts, name)
+
+
+def load_chunks(docs_dir: str, chunk_tokens: int, overlap_tokens: int) -> List[Chunk]:
+    # the same chunks VectorIndex.from_directory indexes
+    chunks = []
+    for path in sorted(Path(docs_dir).glob("**/*.txt")):
+        source = os.path.relpath(path, docs_dir)
+        chunks.extend(Chunk(text=text, source=source, tokens=tokens) for text, tokens in chunk_file(str(path), chunk_tokens, overlap_tokens))
+    return drop_near_duplicates(chunks, text=lambda c: c.text)
+
+
+def evaluate(index: VectorIndex, questions: List[dict], query_vectors: np.ndarray, ks: List[int], candidates: int, context_tokens: int, lambda_mult: float) -> dict:
+    """Retrieves the context of every question from an index like the /ask retriever, and scores the rankings."""
+    hits = {k: 0 for k in ks}
+    reciprocal_ranks, context_hits, prompt_tokens, latencies, misses = [], 0, [], [], []
+    for question, query_vector in zip(questions, query_vectors):
+        start = time.perf_counter()
+        rows, _ = index.search_rows(query_vector, k=max(candidates, max(ks)))
+        context = build_context(
+            query_vector,
+            chunks=[index.chunks[row] for row in rows[:candidates]],
+            vectors=np.asarray(index.vectors[rows[:candidates]]),
+            max_tokens=context_tokens,
+            lambda_mult=lambda_mult,
+            max_similarity=constants.QA_DUPLICATE_SIMILARITY,
+        )
+        latencies.append(time.perf_counter() - start)
+
+        relevant = [i for i, row in enumerate(rows) if index.chunks[row].source == question["source"] and matches(index.chunks[row].text, question["expected"])]
+        rank = relevant[0] + 1 if relevant else None
+        for k in ks:
+            hits[k] += rank is not None and rank <= k
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+        context_hits += matches(context, question["expected"])
+        prompt_tokens.append(count_tokens(QA_PROMPT_TEMPLATE.format(context=context, question=question["question"])))
+        if rank is None or rank > max(ks):
+            misses.append(question["question"])
+
+    n = len(questions)
+    return {
+        **{f"recall@{k}": hits[k] / n for k in ks},
+        "mrr": float(np.mean(reciprocal_ranks)),
+        "context_recall": context_hits / n,
+        "prompt_tokens": float(np.mean(prompt_tokens)),
+        **{f"latency_{key}": value for key, value in latency_summary(latencies).items() if key in ("p50_ms", "p95_ms")},
+        "misses": misses,
+    }
+
+
+def run(args, questions: List[dict]) -> List[dict]:
+    query_vectors = embed([q["question"] for q in questions], "eval-questions", args.embeddings)
+    results = []
+    for chunk_tokens, overlap in itertools.product(args.chunk_tokens, args.overlap):
+        start = time.perf_counter()
+        chunks = load_chunks(args.docs, chunk_tokens, overlap)
+        vectors = embed([c.text for c in chunks], f"eval-{chunk_tokens}-{overlap}", args.embeddings)
+        embed_seconds = time.perf_counter() - start
+        # answers that no chunk contains (e.g. a snippet with a typo) can't be found by any configuration
+        answerable = [i for i, q in enumerate(questions) if any(c.source == q["source"] and matches(c.text, q["expected"]) for c in chunks)]
+        for dtype in args.dtypes:
+            start = time.perf_counter()
+            index = VectorIndex(chunks, vectors, dtype=dtype)
+            build_seconds = embed_seconds + time.perf_counter() - start
+            for candidates, context_tokens, lambda_mult in itertools.product(args.candidates, args.context_tokens, args.lambdas):
+                config = {"chunk_tokens": chunk_tokens, "overlap": overlap, "dtype": dtype, "candidates": candidates, "context_tokens": context_tokens, "lambda": lambda_mult}
+                scores = evaluate(index, [questions[i] for i in answerable], query_vectors[answerable], args.k, candidates, context_tokens, lambda_mult)
+                results.append({
+                    **config,
+                    "chunks": len(chunks),
+                    "questions": len(answerable),
+                    "unanswerable": len(questions) - len(answerable),
+                    "index_mb": index.nbytes / 1e6,
+                    "build_s": build_seconds,
+                    **scores,
+                })
+                print_result(results[-1], args.k)
+            del index
+    return results
+
+
+def print_header(ks: List[int]) -> None:
+    recalls = " ".join(f"{'R@' + str(k):>5}" for k in ks)
+    print(f"{'chunk':>5} {'ovl':>4} {'dtype':<7} {'cand':>4} {'ctx':>5} {'lam':>4} {'chunks':>6} {'MB':>7} {'build s':>7} {recalls} {'MRR':>5} {'ctxR':>5} {'prompt':>6} {'p50 ms':>7} {'p95 ms':>7}")
+
+
+def print_result(r: dict, ks: List[int]) -> None:
+    recalls = " ".join(f"{r[f'recall@{k}']:>5.2f}" for k in ks)
+    print(
+        f"{r['chunk_tokens']:>5} {r['overlap']:>4} {r['dtype']:<7} {r['candidates']:>4} {r['context_tokens']:>5} {r['lambda']:>4} "
+        f"{r['chunks']:>6} {r['index_mb']:>7.2f} {r['build_s']:>7.2f} {recalls} {r['mrr']:>5.2f} {r['context_recall']:>5.2f} "
+        f"{r['prompt_tokens']:>6.0f} {r['latency_p50_ms']:>7.2f} {r['latency_p95_ms']:>7.2f}"
+    )
+
+
+def config_key(r: dict) -> tuple:
+    return tuple(r[key] for key in ("chunk_tokens", "overlap", "dtype", "candidates", "context_tokens", "lambda"))
+
+
+def compare(results: List[dict], baseline_path: str, ks: List[int]) -> None:
+    """Prints the change of each configuration's quality and latency since an earlier run."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {config_key(r): r for r in json.load(f)["results"]}
+    keys = [f"recall@{k}" for k in ks] + ["mrr", "context_recall", "prompt_tokens", "latency_p95_ms", "index_mb"]
+    print(f"\nChange since {baseline_path}:")
+    print(f"{'chunk':>5} {'ovl':>4} {'dtype':<7} {'cand':>4} {'ctx':>5} {'lam':>4} " + " ".join(f"{key:>14}" for key in keys))
+    for r in results:
+        old = baseline.get(config_key(r))
+        if old is None:
+            continue
+        change = lambda key: f"{r[key] - old[key]:+.3f}" if key in old else "-"
+        print(f"{r['chunk_tokens']:>5} {r['overlap']:>4} {r['dtype']:<7} {r['candidates']:>4} {r['context_tokens']:>5} {r['lambda']:>4} " + " ".join(f"{change(key):>14}" for key in keys))
+
+
+def main():
+    ints = lambda value: [int(v) for v in value.split(",")]
+    floats = lambda value: [float(v) for v in value.split(",")]
+    parser = argparse.ArgumentParser(description="Evaluate document search retrieval quality and latency")
+    parser.add_argument("--docs", default=constants.DEFAULT_DOCS_DIR, help="documents folder to index")
+    parser.add_argument("--questions", default=LABELLED_QUESTIONS, help="hand-labelled questions (JSON lines with question, source and expected)")
+    parser.add_argument("--seed-source", default="example.txt", help="document of the documents folder to seed questions from")
+    parser.add_argument("--seeded", type=int, default=50, help="number of questions seeded from its sentences, 0 for none")
+    parser.add_argument("--embeddings", choices=("fake", "openai"), default="fake", help="fake: hashed bags of words, offline; openai: the embedding model, cached on disk")
+    parser.add_argument("--chunk-tokens", type=ints, default=[constants.CHUNK_TOKENS])
+    parser.add_argument("--overlap", type=ints, default=[constants.CHUNK_OVERLAP_TOKENS], help="tokens each chunk repeats from the previous one")
+    parser.add_argument("--dtypes", type=lambda value: value.split(","), default=[constants.INDEX_VECTOR_DTYPE], help="vector storage modes, among float32,float16,int8")
+    parser.add_argument("--candidates", type=ints, default=[constants.QA_CANDIDATE_CHUNKS], help="chunks retrieved before building the context")
+    parser.add_argument("--context-tokens", type=ints, default=[constants.QA_CONTEXT_MAX_TOKENS], help="token budget of the context")
+    parser.add_argument("--lambdas", type=floats, default=[constants.QA_MMR_LAMBDA], help="MMR relevance/diversity trade-off")
+    parser.add_argument("--k", type=ints, default=[1, 3, 5, 10], help="ranks recall is measured at")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the seeded questions")
+    parser.add_argument("--show-misses", action="store_true", help="print the questions each configuration didn't find in the top k")
+    parser.add_argument("--out", help="JSON file to save the results to, data/bench/retrieval-<time>.json by default")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    questions = load_labelled(args.questions) if args.questions else []
+    if args.seeded:
+        questions += seed_questions(args.docs, args.seed_source, args.seeded, random.Random(args.seed))
+    if not questions:
+        parser.error("no questions, pass --questions or --seeded")
+    started = datetime.datetime.now()
+    out = os.path.abspath(args.out or os.path.join(LEO_DIR, "data", "bench", f"retrieval-{started:%Y%m%d-%H%M%S}.json"))
+
+    print(f"{len(questions)} questions ({sum(not q.get('seeded') for q in questions)} labelled), {args.embeddings} embeddings, documents from {args.docs}")
+    print_header(args.k)
+    results = run(args, questions)
+    if args.show_misses:
+        for r in results:
+            if r["misses"]:
+                print(f"\nNot in the top {max(args.k)} with chunk_tokens={r['chunk_tokens']} overlap={r['overlap']} dtype={r['dtype']}:")
+                print("\n".join(f"  {q}" for q in r["misses"]))
+
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        config = {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "show_misses")}
+        json.dump({"time": started.isoformat(timespec="seconds"), "commit": git_commit(), "config": config, "results": results}, f, indent=2)
+    print(f"Saved results to {out}")
+    if args.baseline:
+        compare(results, args.baseline, args.k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,467 @@
+# this contains the local stand-ins for OpenAI and Discord the benchmarks run the bot's handlers against
+# FakeOpenAI is a real HTTP server on localhost speaking the OpenAI API (chat completions with or without streaming,
+# completions, embeddings, moderations), with a configurable latency per request and per generated token and a
+# fraction of requests answered with 429 rate limit errors. Point openai at it with OPENAI_API_BASE=<its url>.
+# FakeDiscord builds in-memory guilds, channels, threads, messages and interactions with the attributes and methods
+# the handlers in src/main.py use, and counts the Discord requests they make.
+# embeddings are hashed bags of words, so texts sharing words are close and retrieval still ranks sensibly offline
+
+import re
+import json
+import types
+import random
+import asyncio
+import hashlib
+import itertools
+import threading
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import discord
+
+# Filler the fake models answer with, repeated up to the reply length
+REPLY_WORDS = "Sure, here is a detailed answer to your question with a few ideas you could try next".split()
+MODERATION_CATEGORIES = ["hate", "hate/threatening", "self-harm", "sexual", "sexual/minors", "violence", "violence/graphic"]
+
+
+def hashed_embedding(text: str, dim: int = 1536) -> np.ndarray:
+    """Unit vector of the text's words hashed into dim buckets with a random sign, like a bag of words."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in re.findall(r"\w+", text.lower()):
+        h = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+        vector[h % dim] += 1.0 if (h >> 32) & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        # texts without words still get a valid unit vector
+        vector[0] = 1.0
+        return vector
+    return vector / norm
+
+
+#### OPENAI ####
+
+class FakeOpenAI:
+    def __init__(self, latency_ms: float = 300, token_ms: float = 10, reply_words: int = 60, rate_limit: float = 0.0, dim: int = 1536, seed: int = 0):
+        """
+            Args:
+                latency_ms: time before the response (or the first streamed token) of every request
+                token_ms: time to generate each word of a chat or completion reply
+                reply_words: length of the chat and completion replies
+                rate_limit: fraction of the requests answered with a 429
+                dim: dimension of the embeddings
+        """
+        self.latency = latency_ms / 1000
+        self.token_delay = token_ms / 1000
+        self.reply_words = reply_words
+        self.rate_limit = rate_limit
+        self.dim = dim
+        self._random = random.Random(seed)
+        # (endpoint, HTTP status) -> number of requests, e.g. ("embeddings", 200)
+        self.requests: Counter = Counter()
+        self.url: Optional[str] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner = None
+
+    def start(self) -> str:
+        """Starts the server in its own thread and event loop, so it doesn't compete with the bot's loop. Returns its URL."""
+        started = threading.Event()
+        threading.Thread(target=self._serve, args=(started,), name="fake-openai", daemon=True).start()
+        started.wait()
+        return self.url
+
+    def stop(self) -> None:
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def counts(self) -> Dict[str, int]:
+        """Requests by endpoint and status, e.g. {"chat/completions 200": 40, "chat/completions 429": 2}."""
+        return {f"{endpoint} {status}": n for (endpoint, status), n in sorted(self.requests.copy().items())}
+
+    def _serve(self, started: threading.Event) -> None:
+        from aiohttp import web
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self._handle(self._chat, "chat/completions"))
+        app.router.add_post("/v1/completions", self._handle(self._completion, "completions"))
+        app.router.add_post("/v1/engines/{engine}/completions", self._handle(self._completion, "completions"))
+        app.router.add_post("/v1/embeddings", self._handle(self._embeddings, "embeddings"))
+        app.router.add_post("/v1/engines/{engine}/embeddings", self._handle(self._embeddings, "embeddings"))
+        app.router.add_post("/v1/moderations", self._handle(self._moderation, "moderations"))
+        self._runner = web.AppRunner(app, access_log=None)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        self._loop.run_until_complete(site.start())
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/v1"
+        started.set()
+        self._loop.run_forever()
+
+    def _handle(self, handler, endpoint: str):
+        from aiohttp import web
+
+        async def handle(request):
+            body = await request.json()
+            await asyncio.sleep(self.latency)
+            if self._random.random() < self.rate_limit:
+                self.requests[endpoint, 429] += 1
+                error = {"error": {"message": "Rate limit reached for requests", "type": "requests", "param": None, "code": None}}
+                return web.json_response(error, status=429, headers={"Retry-After": "1"})
+            response = await handler(request, body)
+            self.requests[endpoint, response.status] += 1
+            return response
+        return handle
+
+    def _reply(self) -> List[str]:
+        return list(itertools.islice(itertools.cycle(REPLY_WORDS), self.reply_words))
+
+    def _usage(self, prompt: str, reply: List[str]) -> dict:
+        prompt_tokens = len(prompt.split())
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": len(reply), "total_tokens": prompt_tokens + len(reply)}
+
+    async def _chat(self, request, body: dict):
+        from aiohttp import web
+        reply = self._reply()
+        prompt = " ".join(m.get("content") or "" for m in body.get("messages", []))
+        model = body.get("model", "gpt-3.5-turbo")
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_delay * len(reply))
+            return web.json_response({
+                "id": "chatcmpl-fake", "object": "chat.completion", "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(reply)}, "finish_reason": "stop"}],
+                "usage": self._usage(prompt, reply),
+            })
+        # server-sent events, one word per chunk as it is "generated"
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for i, word in enumerate(reply):
+            await asyncio.sleep(self.token_delay)
+            chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def _completion(self, request, body: dict):
+        from aiohttp import web
+        prompts = body.get("prompt", "")
+        prompts = [prompts] if isinstance(prompts, str) else list(prompts)
+        choices = []
+        for i, prompt in enumerate(prompts):
+            # the intro detector's few-shot prompt ends with "class:", every message is classified as an intro
+            # so the whole /onboard path runs
+            reply = ["true"] if prompt.rstrip().endswith("class:") else self._reply()
+            choices.append({"index": i, "text": " " + " ".join(reply), "logprobs": None, "finish_reason": "stop"})
+        await asyncio.sleep(self.token_delay * max(len(c["text"].split()) for c in choices))
+        reply_words = sum(len(c["text"].split()) for c in choices)
+        return web.json_response({
+            "id": "cmpl-fake", "object": "text_completion", "model": body.get("model", "text-davinci-003"),
+            "choices": choices,
+            "usage": self._usage(" ".join(prompts), ["w"] * reply_words),
+        })
+
+    async def _embeddings(self, request, body: dict):
+        from aiohttp import web
+        texts = body.get("input", [])
+        texts = [texts] if isinstance(texts, str) else list(texts)
+        data = [{"object": "embedding", "index": i, "embedding": hashed_embedding(text, self.dim).tolist()} for i, text in enumerate(texts)]
+        tokens = sum(len(text.split()) for text in texts)
+        return web.json_response({
+            "object": "list", "data": data, "model": body.get("model", "text-embedding-ada-002"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    async def _moderation(self, request, body: dict):
+        from aiohttp import web
+        texts = body.get("input", "")
+        texts = [texts] if isinstance(texts, str) else list(texts)
+        results = [{
+            "flagged": False,
+            "categories": {c: False for c in MODERATION_CATEGORIES},
+            "category_scores": {c: 0.0001 for c in MODERATION_CATEGORIES},
+        } for _ in texts]
+        return web.json_response({"id": "modr-fake", "model": body.get("model", "text-moderation-latest"), "results": results})
+
+
+#### DISCORD ####
+
+class FakeUser:
+    def __init__(self, id: int, name: str, roles: List[str] = ()):
+        self.id = id
+        self.name = name
+        self.mention = f"<@{id}>"
+        # only the role names are checked, see has_any_role
+        self.roles = [types.SimpleNamespace(name=role) for role in roles]
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeTyping:
+    def __init__(self, fake: "FakeDiscord"):
+        self.fake = fake
+
+    async def __aenter__(self):
+        await self.fake.request("typing")
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeMessage:
+    def __init__(self, fake: "FakeDiscord", channel, author: FakeUser, content: Optional[str] = None, embed: Optional[discord.Embed] = None, reference: Optional["FakeMessage"] = None):
+        self.fake = fake
+        self.id = next(fake.ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content or ""
+        self.embeds = [embed] if embed is not None else []
+        self.type = discord.MessageType.default
+        # replies point at the message they answer, like discord.MessageReference
+        self.reference = discord.MessageReference(message_id=reference.id, channel_id=channel.id) if reference else None
+        self.jump_url = f"https://discord.com/channels/{channel.guild.id}/{channel.id}/{self.id}"
+
+    async def reply(self, content: Optional[str] = None, **kwargs) -> "FakeMessage":
+        return await self.channel.send(content, reference=self, **kwargs)
+
+    async def delete(self) -> None:
+        await self.fake.request("delete")
+        self.channel.messages.remove(self)
+
+    async def edit(self, content: Optional[str] = None, **kwargs) -> "FakeMessage":
+        await self.fake.request("edit")
+        self.content = content
+        return self
+
+    async def create_thread(self, name: str, **kwargs) -> "FakeThread":
+        await self.fake.request("create_thread")
+        return self.fake.thread(self.channel, name)
+
+
+class FakeChannelMixin:
+    # messages of the channel, oldest first, and the wait_for_message calls waiting for the next ones
+    messages: List[FakeMessage]
+    _waiters: List[tuple]
+
+    async def send(self, content: Optional[str] = None, *, embed: Optional[discord.Embed] = None, reference: Optional[FakeMessage] = None, **kwargs) -> FakeMessage:
+        await self.fake.request("send")
+        return self.add_message(self.fake.bot, content, embed=embed, reference=reference)
+
+    def add_message(self, author: FakeUser, content: Optional[str], embed: Optional[discord.Embed] = None, reference: Optional[FakeMessage] = None) -> FakeMessage:
+        """Adds a message without a request, e.g. one sent by a user that the gateway would deliver."""
+        message = FakeMessage(self.fake, self, author, content, embed=embed, reference=reference)
+        self.messages.append(message)
+        for check, future in list(self._waiters):
+            if not future.done() and check(message):
+                future.set_result(message)
+        return message
+
+    async def wait_for_message(self, check: Callable[[FakeMessage], bool], timeout: Optional[float] = None) -> FakeMessage:
+        """Waits for the next message added to the channel passing check, like client.wait_for("message")."""
+        waiter = (check, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter[1], timeout)
+        finally:
+            self._waiters.remove(waiter)
+
+    async def history(self, limit: Optional[int] = 100, around: Optional[FakeMessage] = None):
+        await self.fake.request("history")
+        messages = self.messages[::-1]
+        if around is not None:
+            middle = messages.index(around) if around in messages else 0
+            messages = messages[max(middle - (limit or 0) // 2, 0):]
+        for message in messages[:limit]:
+            yield message
+
+    async def fetch_message(self, message_id: int) -> FakeMessage:
+        await self.fake.request("fetch_message")
+        for message in self.messages:
+            if message.id == message_id:
+                return message
+        raise discord.NotFound(type("Response", (), {"status": 404, "reason": "Not Found"})(), "Unknown Message")
+
+    def typing(self) -> FakeTyping:
+        return FakeTyping(self.fake)
+
+
+# subclasses of the discord.py classes, the handlers check isinstance(channel, discord.TextChannel / discord.Thread).
+# Their __init__ doesn't call discord.py's, which needs a gateway connection state
+class FakeTextChannel(FakeChannelMixin, discord.TextChannel):
+    # plain attributes instead of discord.py's properties
+    jump_url = None
+    mention = None
+    threads = None
+
+    def __init__(self, fake: "FakeDiscord", guild: "FakeGuild", name: str):
+        self.fake = fake
+        self.id = next(fake.ids)
+        self.guild = guild
+        self.name = name
+        self.messages = []
+        self._waiters = []
+        self.threads: List["FakeThread"] = []
+        self.mention = f"<#{self.id}>"
+        self.jump_url = f"https://discord.com/channels/{guild.id}/{self.id}"
+
+
+class FakeThread(FakeChannelMixin, discord.Thread):
+    # plain attributes instead of discord.py's properties
+    jump_url = None
+    last_message = None
+
+    def __init__(self, fake: "FakeDiscord", parent: FakeTextChannel, name: str, owner_id: int):
+        self.fake = fake
+        self.id = next(fake.ids)
+        self.guild = parent.guild
+        self.parent_id = parent.id
+        self.name = name
+        self.owner_id = owner_id
+        self.archived = False
+        self.locked = False
+        self.messages = []
+        self._waiters = []
+        self.jump_url = f"https://discord.com/channels/{parent.guild.id}/{self.id}"
+
+    @property
+    def message_count(self) -> int:
+        return len(self.messages)
+
+    def add_message(self, author: FakeUser, content: Optional[str], embed: Optional[discord.Embed] = None, reference: Optional[FakeMessage] = None) -> FakeMessage:
+        message = super().add_message(author, content, embed=embed, reference=reference)
+        self.last_message = message
+        return message
+
+    async def edit(self, name: Optional[str] = None, archived: Optional[bool] = None, locked: Optional[bool] = None, **kwargs) -> "FakeThread":
+        await self.fake.request("edit")
+        if name is not None:
+            self.name = name
+        if archived is not None:
+            self.archived = archived
+        if locked is not None:
+            self.locked = locked
+        return self
+
+
+class FakeGuild:
+    def __init__(self, fake: "FakeDiscord", id: int):
+        self.fake = fake
+        self.id = id
+        self.name = f"guild-{id}"
+
+    def get_channel(self, channel_id: int):
+        return self.fake.get_channel(channel_id)
+
+    def get_thread(self, thread_id: int):
+        return self.fake.get_channel(thread_id)
+
+    async def fetch_channel(self, channel_id: int):
+        await self.fake.request("fetch_channel")
+        return self.fake.get_channel(channel_id)
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeInteractionResponse:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def send_message(self, content: Optional[str] = None, *, embed: Optional[discord.Embed] = None, ephemeral: bool = False, **kwargs) -> None:
+        if self._done:
+            raise discord.InteractionResponded(self.interaction)
+        self._done = True
+        await self.interaction.fake.request("interaction_response")
+        self.interaction.original = self.interaction.channel.add_message(self.interaction.fake.bot, content, embed=embed)
+
+    async def defer(self, ephemeral: bool = False, **kwargs) -> None:
+        self._done = True
+        await self.interaction.fake.request("interaction_response")
+        self.interaction.original = self.interaction.channel.add_message(self.interaction.fake.bot, None)
+
+
+class FakeFollowup:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+
+    async def send(self, content: Optional[str] = None, *, ephemeral: bool = False, **kwargs) -> FakeMessage:
+        await self.interaction.fake.request("followup")
+        return self.interaction.channel.add_message(self.interaction.fake.bot, content)
+
+
+class FakeInteraction:
+    def __init__(self, fake: "FakeDiscord", user: FakeUser, channel: FakeTextChannel):
+        self.fake = fake
+        self.user = user
+        self.channel = channel
+        self.channel_id = channel.id
+        self.guild = channel.guild
+        self.guild_id = channel.guild.id
+        self.response = FakeInteractionResponse(self)
+        self.followup = FakeFollowup(self)
+        # the message sent by response.send_message
+        self.original: Optional[FakeMessage] = None
+
+    async def original_response(self) -> FakeMessage:
+        await self.fake.request("original_response")
+        return self.original
+
+    async def edit_original_response(self, content: Optional[str] = None, **kwargs) -> FakeMessage:
+        if self.original is None:
+            raise discord.NotFound(type("Response", (), {"status": 404, "reason": "Not Found"})(), "Unknown interaction")
+        return await self.original.edit(content=content)
+
+
+class FakeDiscord:
+    def __init__(self, guild_id: int, latency_ms: float = 50):
+        """
+            Args:
+                guild_id: ID of the fake guild, must be in ALLOWED_SERVER_IDS
+                latency_ms: time every Discord request (send, edit, history...) takes
+        """
+        self.latency = latency_ms / 1000
+        self.ids = itertools.count(10 ** 17)
+        # request kind -> number of requests, e.g. {"send": 40, "history": 20}
+        self.requests: Counter = Counter()
+        self._channels: Dict[int, object] = {}
+        self.bot = self.user("leo-bot")
+        self.guild = FakeGuild(self, guild_id)
+
+    async def request(self, kind: str) -> None:
+        self.requests[kind] += 1
+        await asyncio.sleep(self.latency)
+
+    def user(self, name: str, roles: List[str] = ()) -> FakeUser:
+        return FakeUser(next(self.ids), name, roles)
+
+    def text_channel(self, name: str) -> FakeTextChannel:
+        channel = FakeTextChannel(self, self.guild, name)
+        self._channels[channel.id] = channel
+        return channel
+
+    def thread(self, parent: FakeTextChannel, name: str) -> FakeThread:
+        """A thread in parent, created by the bot like the /chat threads."""
+        thread = FakeThread(self, parent, name, owner_id=self.bot.id)
+        parent.threads.append(thread)
+        self._channels[thread.id] = thread
+        return thread
+
+    def interaction(self, user: FakeUser, channel: FakeTextChannel) -> FakeInteraction:
+        return FakeInteraction(self, user, channel)
+
+    def get_channel(self, channel_id: int):
+        # keyed by int like discord.py's cache, so a lookup with a str ID misses there too
+        return self._channels.get(channel_id)
+
+    def install(self, client: discord.Client) -> None:
+        """Makes the bot's client see the fake bot user and channels instead of a gateway connection."""
+        client._connection.user = self.bot
+        client.get_channel = self.get_channel
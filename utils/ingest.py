@@ -1,41 +1,134 @@
 # this will be the file we use to process the data in text/ for question and answering
-# it will produce a doc.index file and a faiss_store.pkl file
-# these files are currently not being tracked by git
+# it writes chunks-*.jsonl and vectors-*.npy shards plus a checkpoint.json to the output folder. The bot loads
+# data/index (INGESTED_INDEX_DIR) with src.index.VectorIndex.load_ingested instead of embedding the documents
+# folder itself, as long as every document in it was ingested and none changed since
+# files are read lazily and chunked by tokens in a process pool, chunks are embedded in size-capped
+# batches with retries, and a checkpoint is saved after every batch so an interrupted run resumes
+# where it stopped
+# chunks that are near-duplicates of a chunk already ingested (repeated footers, reposted pages) are skipped
+# before they are embedded
+# usage: python -m utils.ingest --docs text/ --out data/index
 
-"""This is the logic for ingesting doc data into LangChain."""
+"""This is the logic for ingesting doc data into the document index."""
+import os
+import json
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from langchain.text_splitter import CharacterTextSplitter
-import faiss
-from langchain.vectorstores import FAISS
-from langchain.embeddings import OpenAIEmbeddings
-import pickle
-
-
-# List all .txt files in the text/ folder and its subdirectories
-ps = list(Path("text/").glob("**/*.txt"))
-
-# Read the content of each markdown file and store the content and the file path
-data = []
-sources = []
-for p in ps:
-    with open(p) as f:
-        data.append(f.read())
-    sources.append(p)
-
-# Here we split the documents, as needed, into smaller chunks.
-# We do this due to the context limits of the LLMs.
-text_splitter = CharacterTextSplitter(chunk_size=1500, separator="\n")
-docs = []
-metadatas = []
-for i, d in enumerate(data):
-    splits = text_splitter.split_text(d)
-    docs.extend(splits)
-    metadatas.extend([{"source": sources[i]}] * len(splits))
-
-
-# Here we create a vector store from the documents and save it to disk.
-store = FAISS.from_texts(docs, OpenAIEmbeddings(), metadatas=metadatas)
-faiss.write_index(store.index, "docs.index")
-store.index = None
-with open("faiss_store.pkl", "wb") as f:
-    pickle.dump(store, f)
\ No newline at end of file
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from src.chunking import chunk_file
+from src.constants import CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS, EMBEDDING_MODEL
+from src.dedup import SimHashIndex
+from src.embeddings import embed_texts_with_retries
+
+CHECKPOINT_FILE = "checkpoint.json"
+
+
+def write_atomic(path: Path, write) -> None:
+    # write to a temporary file and rename it, so a crash never leaves a half written file behind
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(out: Path, settings: dict) -> dict:
+    path = out / CHECKPOINT_FILE
+    if path.exists():
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint["settings"] != settings:
+            raise SystemExit(f"{out} was ingested with {checkpoint['settings']}, use another --out folder for {settings}")
+    else:
+        checkpoint = {"settings": settings, "done_files": [], "shards": 0}
+    # remove shards written after the last checkpoint, their files will be ingested again
+    for shard_path in list(out.glob("chunks-*.jsonl")) + list(out.glob("vectors-*.npy")):
+        if int(shard_path.stem.split("-")[1]) >= checkpoint["shards"]:
+            shard_path.unlink()
+    return checkpoint
+
+
+def chunk_files(paths: Iterable[Path], workers: int, chunk_tokens: int, overlap_tokens: int) -> Iterator[Tuple[Path, List[Tuple[str, int]]]]:
+    """Chunks files in a process pool, yielding them in order.
+        At most two files per worker are chunked ahead of the embedding, so memory stays flat
+        however many files there are.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for path in paths:
+            in_flight.append((path, pool.submit(chunk_file, str(path), chunk_tokens, overlap_tokens)))
+            if len(in_flight) >= 2 * workers:
+                path, future = in_flight.popleft()
+                yield path, future.result()
+        while in_flight:
+            path, future = in_flight.popleft()
+            yield path, future.result()
+
+
+def ingest(docs: Path, out: Path, workers: int, batch_size: int, chunk_tokens: int, overlap_tokens: int, max_retries: int) -> None:
+    out.mkdir(parents=True, exist_ok=True)
+    settings = {"chunk_tokens": chunk_tokens, "overlap_tokens": overlap_tokens, "model": EMBEDDING_MODEL}
+    checkpoint = load_checkpoint(out, settings)
+    # the bot only loads the index for the folder it was ingested from
+    if checkpoint.setdefault("docs", os.path.realpath(docs)) != os.path.realpath(docs):
+        raise SystemExit(f"{out} was ingested from {checkpoint['docs']}, use another --out folder for {docs}")
+    done_files = set(checkpoint["done_files"])
+    if done_files:
+        print(f"Resuming, {len(done_files)} files were already ingested")
+
+    # fingerprints of the chunks ingested so far, including the ones in the shards of an interrupted run
+    fingerprints = SimHashIndex()
+    for chunks_path in sorted(out.glob("chunks-*.jsonl")):
+        with open(chunks_path, encoding="utf-8") as f:
+            for line in f:
+                fingerprints.add_if_new(json.loads(line)["text"], fingerprints.size)
+    duplicates = 0
+
+    paths = (p for p in sorted(docs.glob("**/*.txt")) if os.path.relpath(p, docs) not in done_files)
+    pending_chunks: List[dict] = []
+    pending_files: List[str] = []
+
+    def flush():
+        if pending_files:
+            vectors = embed_texts_with_retries([c["text"] for c in pending_chunks], max_retries=max_retries) if pending_chunks else np.zeros((0, 0), dtype=np.float32)
+            shard = f"{checkpoint['shards']:05d}"
+            write_atomic(out / f"vectors-{shard}.npy", lambda f: np.save(f, vectors))
+            lines = "".join(json.dumps(c) + "\n" for c in pending_chunks).encode("utf-8")
+            write_atomic(out / f"chunks-{shard}.jsonl", lambda f: f.write(lines))
+            # the checkpoint is saved last, a crash before this line only redoes this batch
+            checkpoint["shards"] += 1
+            checkpoint["done_files"].extend(pending_files)
+            write_atomic(out / CHECKPOINT_FILE, lambda f: f.write(json.dumps(checkpoint).encode("utf-8")))
+            print(f"Shard {shard}: {len(pending_chunks)} chunks from {len(pending_files)} files")
+        pending_chunks.clear()
+        pending_files.clear()
+
+    for path, file_chunks in chunk_files(paths, workers, chunk_tokens, overlap_tokens):
+        source = os.path.relpath(path, docs)
+        for text, tokens in file_chunks:
+            if fingerprints.add_if_new(text, fingerprints.size) is not None:
+                duplicates += 1
+                continue
+            pending_chunks.append({"text": text, "source": source, "tokens": tokens})
+        pending_files.append(source)
+        if len(pending_chunks) >= batch_size:
+            flush()
+    flush()
+    print(f"Ingested {len(checkpoint['done_files'])} files into {out}, skipped {duplicates} near-duplicate chunks")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chunk and embed the documents in a folder")
+    parser.add_argument("--docs", default="text/", help="folder with the .txt documents")
+    parser.add_argument("--out", default="data/index", help="folder to write the index to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes used to chunk the files")
+    parser.add_argument("--batch-size", type=int, default=1000, help="chunks embedded and written per shard")
+    parser.add_argument("--chunk-tokens", type=int, default=CHUNK_TOKENS)
+    parser.add_argument("--overlap-tokens", type=int, default=CHUNK_OVERLAP_TOKENS)
+    parser.add_argument("--max-retries", type=int, default=5, help="retries per embeddings request")
+    args = parser.parse_args()
+    ingest(Path(args.docs), Path(args.out), args.workers, args.batch_size, args.chunk_tokens, args.overlap_tokens, args.max_retries)
@@ -0,0 +1,105 @@
+# this is the file we use to index a server's Discord history (exported by data/bigquery.py) for question and answering
+# the archive is read a page at a time (Parquet row groups, or CSV chunks), messages are grouped into conversation
+# windows per channel, and the windows are embedded in batches into chunks-*.jsonl and vectors-*.npy shards with their
+# channel and start time, in the same format as utils/ingest.py so src.index.VectorIndex.load reads them back
+# by default the shards go to text/_archive, where the retriever searches them together with the documents in text/
+# each archive file is checkpointed once indexed, so an interrupted run resumes with the file it stopped in and
+# rerunning after an incremental export only indexes the new files
+# with --guild, the windows are only searched by /ask in that server, even if other servers share the documents folder
+# usage: python -m utils.ingest_archive --archive data/archive/talentDAO --guild 123456789
+#        python -m utils.ingest_archive --archive data/csv/talentDAO.csv --out servers/talentDAO/_archive
+
+"""This is the logic for ingesting the Discord message archive into the document index."""
+import os
+import json
+import argparse
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+from src.archive import archive_files, conversation_windows, read_pages
+from src.constants import (
+    DEFAULT_DOCS_DIR,
+    ARCHIVE_INDEX_DIRNAME,
+    ARCHIVE_WINDOW_GAP_MINUTES,
+    ARCHIVE_WINDOW_TOKENS,
+    ARCHIVE_WINDOW_MIN_TOKENS,
+    EMBEDDING_MODEL,
+)
+from src.embeddings import embed_texts_with_retries, get_encoding
+from utils.ingest import CHECKPOINT_FILE, load_checkpoint, write_atomic
+
+
+def ingest_archive(archive: str, out: Path, page_size: int, batch_size: int, gap_minutes: float, window_tokens: int, min_tokens: int, max_retries: int, guild: Optional[int] = None) -> None:
+    out.mkdir(parents=True, exist_ok=True)
+    settings = {"gap_minutes": gap_minutes, "window_tokens": window_tokens, "min_tokens": min_tokens, "model": EMBEDDING_MODEL, "guild": guild}
+    checkpoint = load_checkpoint(out, settings)
+    done_files = set(checkpoint["done_files"])
+    if done_files:
+        print(f"Resuming, {len(done_files)} archive files were already indexed")
+
+    # a single CSV export, or the folder of Parquet files written by data/bigquery.py
+    single_file = os.path.isfile(archive)
+    files = [archive] if single_file else archive_files(archive)
+    encoding = get_encoding()
+    # shards written for the current file, they are only checkpointed once the whole file is indexed
+    shards = checkpoint["shards"]
+    pending: List[dict] = []
+    windows = skipped = 0
+
+    def flush():
+        nonlocal shards
+        if pending:
+            vectors = embed_texts_with_retries([c["text"] for c in pending], max_retries=max_retries)
+            shard = f"{shards:05d}"
+            write_atomic(out / f"vectors-{shard}.npy", lambda f: np.save(f, vectors))
+            lines = "".join(json.dumps(c) + "\n" for c in pending).encode("utf-8")
+            write_atomic(out / f"chunks-{shard}.jsonl", lambda f: f.write(lines))
+            shards += 1
+            print(f"Shard {shard}: {len(pending)} conversation windows")
+        pending.clear()
+
+    for path in files:
+        name = os.path.basename(path) if single_file else os.path.relpath(path, archive)
+        if name in done_files:
+            continue
+        # windows don't span files: a conversation crossing a partition boundary is indexed as two windows
+        for window in conversation_windows(read_pages(path, page_size), gap_minutes, window_tokens):
+            text = window.text
+            tokens = len(encoding.encode(text, disallowed_special=()))
+            if tokens < min_tokens:
+                skipped += 1
+                continue
+            pending.append({
+                "text": text,
+                "source": f"#{window.channel}",
+                "tokens": tokens,
+                "channel": window.channel,
+                "time_stamp": window.start.strftime("%Y-%m-%dT%H:%M:%S"),
+                "guild": guild,
+            })
+            windows += 1
+            if len(pending) >= batch_size:
+                flush()
+        flush()
+        # the checkpoint is saved last, a crash before this line only redoes this file
+        checkpoint["shards"] = shards
+        checkpoint["done_files"].append(name)
+        write_atomic(out / CHECKPOINT_FILE, lambda f: f.write(json.dumps(checkpoint).encode("utf-8")))
+    print(f"Indexed {windows} conversation windows into {out}, skipped {skipped} shorter than {min_tokens} tokens")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index a server's Discord message archive for document search")
+    parser.add_argument("--archive", required=True, help="archive folder written by data/bigquery.py, or a CSV export")
+    parser.add_argument("--out", default=os.path.join(DEFAULT_DOCS_DIR, ARCHIVE_INDEX_DIRNAME), help="folder to write the index to, the _archive folder of the server's documents folder")
+    parser.add_argument("--guild", type=int, default=None, help="ID of the server the archive belongs to, only that server searches it")
+    parser.add_argument("--page-size", type=int, default=50_000, help="messages read at a time")
+    parser.add_argument("--batch-size", type=int, default=1000, help="conversation windows embedded and written per shard")
+    parser.add_argument("--gap-minutes", type=float, default=ARCHIVE_WINDOW_GAP_MINUTES)
+    parser.add_argument("--window-tokens", type=int, default=ARCHIVE_WINDOW_TOKENS)
+    parser.add_argument("--min-tokens", type=int, default=ARCHIVE_WINDOW_MIN_TOKENS)
+    parser.add_argument("--max-retries", type=int, default=5, help="retries per embeddings request")
+    args = parser.parse_args()
+    ingest_archive(args.archive, Path(args.out), args.page_size, args.batch_size, args.gap_minutes, args.window_tokens, args.min_tokens, args.max_retries, guild=args.guild)
@@ -0,0 +1,265 @@
+# this finds how many active chat threads one bot process can serve before its replies slow down
+# it simulates N users each chatting in their own /chat thread: a message every few seconds (exponential think
+# times), sometimes a burst of messages in a row, on top of a long thread history. Each message goes through the real
+# on_message handler of src/main.py, dispatched in its own task like discord.py does, against the fakes of
+# utils/fakes.py. N is swept, and for each N it records the reply latency (from a user's last message to the bot's
+# reply), the event loop lag and stalls (with the call site that blocked, see src/watchdog.py), the process memory
+# and the OpenAI and Discord requests made
+# usage: python -m utils.load_threads --threads 10,50,100,200 --duration 60
+# the reply latency includes the SECONDS_DELAY_RECEIVING_MSG wait for follow-up messages, pass --reply-delay 0 to
+# leave it out. The fake channels' messages live in the same process, so they count towards its memory
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import datetime
+import resource
+import tempfile
+from collections import Counter
+from typing import List, Optional
+
+import numpy as np
+
+from utils.fakes import FakeDiscord, FakeOpenAI
+from utils.bench_bot import LEO_DIR, QUESTIONS, point_at_fakes, warm_up, latency_summary, stage_totals, stage_means, counter_delta, git_commit
+
+# Words the simulated messages are made of
+WORDS = " ".join(QUESTIONS).split()
+STALLS_METRIC = "leo_event_loop_stalls_total"
+
+
+def rss_mb() -> float:
+    """Current resident memory of the process, or its peak where /proc isn't available."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        # kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+class LagProbe:
+    """Samples how late the event loop wakes up a coroutine sleeping for interval seconds."""
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(loop.time() - start - self.interval, 0.0))
+
+    def take(self) -> List[float]:
+        samples, self.samples = self.samples, []
+        return samples
+
+
+def stall_counts() -> Counter:
+    """Event loop stalls counted by the watchdog so far, by call site."""
+    from src.metrics import metrics
+    counter = metrics.counter(STALLS_METRIC, "Event loop stalls longer than LOOP_STALL_THRESHOLD_MS, by the call site that blocked")
+    return Counter({dict(labels)["call_site"]: n for labels, n in list(counter.values.items())})
+
+
+class ThreadUsers:
+    """Simulated users, each chatting in a thread of their own until the time is up."""
+    def __init__(self, fake: FakeDiscord, args, seed: int = 0):
+        from src import main as bot
+        from src.constants import ACTIVATE_THREAD_PREFX, MAX_THREAD_MESSAGES
+        self.bot = bot
+        self.fake = fake
+        self.args = args
+        self.thread_prefix = ACTIVATE_THREAD_PREFX
+        self.max_thread_messages = MAX_THREAD_MESSAGES
+        self.random = random.Random(seed)
+        self.latencies: List[float] = []
+        self.turns = 0
+        self.timeouts = 0
+        # on_message tasks, kept so they aren't garbage collected while running
+        self._handlers = set()
+
+    def _message(self) -> str:
+        return " ".join(self.random.choices(WORDS, k=max(1, int(self.random.expovariate(1 / self.args.message_words)))))
+
+    def _new_thread(self, user):
+        thread = self.fake.thread(self.fake.text_channel(f"chat-{user.name}"), f"{self.thread_prefix} {user.name} - load")
+        for turn in range(min(self.args.history, self.max_thread_messages // 2)):
+            thread.add_message(user if turn % 2 == 0 else self.fake.bot, self._message())
+        return thread
+
+    def _dispatch(self, message) -> None:
+        # discord.py runs every event handler in a task of its own
+        task = asyncio.create_task(self.bot.on_message(message))
+        self._handlers.add(task)
+        task.add_done_callback(self._handlers.discard)
+
+    async def converse(self, n: int, until: float) -> None:
+        user = self.fake.user(f"user{n}")
+        thread = self._new_thread(user)
+        while True:
+            await asyncio.sleep(self.random.expovariate(1 / self.args.think_seconds))
+            if time.monotonic() >= until:
+                return
+            burst = self.args.burst_size if self.random.random() < self.args.burst_probability else 1
+            if thread.message_count + 2 * burst >= self.max_thread_messages:
+                # the bot closes threads over MAX_THREAD_MESSAGES, the user starts a new /chat
+                thread = self._new_thread(user)
+            for i in range(burst):
+                if i:
+                    await asyncio.sleep(self.random.uniform(0.3, 1.5))
+                message = thread.add_message(user, self._message())
+                sent = time.perf_counter()
+                self._dispatch(message)
+            # the bot only answers the last message of a burst
+            self.turns += 1
+            try:
+                await thread.wait_for_message(lambda m: m.author is self.fake.bot and bool(m.content), timeout=self.args.timeout)
+                self.latencies.append(time.perf_counter() - sent)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+
+    async def drain(self) -> None:
+        if self._handlers:
+            await asyncio.wait(list(self._handlers))
+
+
+async def sweep(args, openai: FakeOpenAI) -> List[dict]:
+    from src import main as bot
+    from src.constants import ALLOWED_SERVER_IDS
+    from src.watchdog import LoopWatchdog
+    from src.workers import worker_pool
+    import openai as openai_client
+    # in case openai was imported before OPENAI_API_BASE was set
+    openai_client.api_base = openai.url
+    if args.verbose:
+        logging.getLogger("leo_logger").setLevel(logging.INFO)
+    else:
+        # lost replies show up as timeouts and stalls with their call site in the results
+        logging.getLogger("leo_logger").setLevel(logging.CRITICAL)
+    bot.SECONDS_DELAY_RECEIVING_MSG = args.reply_delay
+
+    fake = FakeDiscord(guild_id=ALLOWED_SERVER_IDS[0], latency_ms=args.discord_latency_ms)
+    fake.install(bot.client)
+    # with worker processes the chat completions run in the workers, which send each reply back once it is complete
+    await warm_up([])
+    LoopWatchdog(threshold_ms=args.stall_ms).start()
+    probe = LagProbe()
+    probe_task = asyncio.create_task(probe.run())
+
+    results = []
+    for threads in args.threads:
+        users = ThreadUsers(fake, args, seed=threads)
+        stages, stalls = stage_totals(), stall_counts()
+        upstream, discord_requests = openai.requests.copy(), fake.requests.copy()
+        probe.take()
+        start = time.perf_counter()
+        until = time.monotonic() + args.duration
+        await asyncio.gather(*(users.converse(n, until) for n in range(threads)))
+        await users.drain()
+        seconds = time.perf_counter() - start
+        lags = 1000 * np.asarray(probe.take() or [0.0])
+        result = {
+            "threads": threads,
+            "seconds": seconds,
+            "turns": users.turns,
+            "replies": len(users.latencies),
+            "timeouts": users.timeouts,
+            "replies_per_s": len(users.latencies) / seconds,
+            **(latency_summary(users.latencies) if users.latencies else {}),
+            "loop_lag_mean_ms": float(lags.mean()),
+            "loop_lag_p99_ms": float(np.percentile(lags, 99)),
+            "loop_lag_max_ms": float(lags.max()),
+            "loop_stalls": dict(stall_counts() - stalls),
+            "rss_mb": rss_mb(),
+            "stages_ms": stage_means(stages, stage_totals(), "thread_message"),
+            "openai_requests": counter_delta(upstream, openai.requests),
+            "discord_requests": counter_delta(discord_requests, fake.requests),
+        }
+        results.append(result)
+        print_result(result)
+    probe_task.cancel()
+    if worker_pool.running:
+        worker_pool.close()
+    return results
+
+
+def print_result(r: dict) -> None:
+    latency = f"{r['p50_ms']:>9.0f} {r['p95_ms']:>9.0f} {r['p99_ms']:>9.0f}" if "p50_ms" in r else f"{'-':>9} {'-':>9} {'-':>9}"
+    print(
+        f"{r['threads']:>7} {r['replies']:>8} {r['timeouts']:>8} {r['replies_per_s']:>9.2f} {latency} "
+        f"{r['loop_lag_p99_ms']:>9.1f} {sum(r['loop_stalls'].values()):>7} {r['rss_mb']:>8.0f}"
+    )
+
+
+def saturation(results: List[dict], degradation: float) -> Optional[int]:
+    """The fewest threads at which the p95 reply latency is over degradation times the lightest load's, or replies time out."""
+    measured = [r for r in results if "p95_ms" in r]
+    if not measured:
+        return None
+    base = min(measured, key=lambda r: r["threads"])["p95_ms"]
+    for r in sorted(results, key=lambda r: r["threads"]):
+        if "p95_ms" not in r or r["p95_ms"] > degradation * base or r["timeouts"] > 0.01 * max(r["turns"], 1):
+            return r["threads"]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find how many concurrent chat threads the bot can serve")
+    parser.add_argument("--threads", default="10,50,100,200", help="active threads, one run per value")
+    parser.add_argument("--duration", type=float, default=60, help="seconds each run sends messages for")
+    parser.add_argument("--think-seconds", type=float, default=20, help="mean time between a user's messages")
+    parser.add_argument("--burst-probability", type=float, default=0.2, help="chance a user sends several messages in a row")
+    parser.add_argument("--burst-size", type=int, default=3, help="messages in a burst")
+    parser.add_argument("--history", type=int, default=50, help="earlier messages in each thread when it starts")
+    parser.add_argument("--message-words", type=float, default=20, help="mean length of the users' messages")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for a reply before counting it as lost")
+    parser.add_argument("--latency-ms", type=float, default=300, help="OpenAI response time, before the first token")
+    parser.add_argument("--token-ms", type=float, default=10, help="OpenAI time per generated token")
+    parser.add_argument("--reply-words", type=int, default=60, help="length of the fake model replies")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fraction of OpenAI requests answered with a 429")
+    parser.add_argument("--discord-latency-ms", type=float, default=50, help="time each Discord request takes")
+    parser.add_argument("--reply-delay", type=float, help="seconds the bot waits for follow-ups (SECONDS_DELAY_RECEIVING_MSG by default)")
+    parser.add_argument("--stall-ms", type=float, default=100, help="event loop lag counted as a stall and attributed to its call site")
+    parser.add_argument("--degradation", type=float, default=2.0, help="p95 latency increase over the lightest load counted as saturated")
+    parser.add_argument("--workers", type=int, default=0, help="worker processes, as WORKER_PROCESSES")
+    parser.add_argument("--out", help="JSON file to save the results to, data/bench/threads-<time>.json by default")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's logs")
+    args = parser.parse_args()
+    args.threads = [int(n) for n in args.threads.split(",")]
+    started = datetime.datetime.now()
+    out = os.path.abspath(args.out or os.path.join(LEO_DIR, "data", "bench", f"threads-{started:%Y%m%d-%H%M%S}.json"))
+
+    openai = FakeOpenAI(latency_ms=args.latency_ms, token_ms=args.token_ms, reply_words=args.reply_words, rate_limit=args.rate_limit)
+    url = openai.start()
+    with tempfile.TemporaryDirectory(prefix="leo-load-") as workdir:
+        point_at_fakes(url, workdir, workers=args.workers)
+        if args.reply_delay is None:
+            from src.constants import SECONDS_DELAY_RECEIVING_MSG
+            args.reply_delay = SECONDS_DELAY_RECEIVING_MSG
+        print(f"Fake OpenAI on {url}, {args.duration:.0f}s per run, a message every {args.think_seconds:.0f}s per thread")
+        print(f"{'threads':>7} {'replies':>8} {'timeouts':>8} {'replies/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'lag p99':>9} {'stalls':>7} {'RSS MB':>8}")
+        results = asyncio.run(sweep(args, openai))
+    openai.stop()
+
+    saturated_at = saturation(results, args.degradation)
+    if saturated_at is None:
+        print(f"Not saturated up to {max(args.threads)} threads")
+    else:
+        print(f"Saturated at {saturated_at} threads (p95 reply latency over {args.degradation}x the lightest load's, or replies lost)")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        config = {k: v for k, v in vars(args).items() if k not in ("out", "verbose")}
+        json.dump({"time": started.isoformat(timespec="seconds"), "commit": git_commit(), "config": config, "saturated_at": saturated_at, "results": results}, f, indent=2)
+    print(f"Saved results to {out}")
+
+
+if __name__ == "__main__":
+    main()